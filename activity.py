@@ -0,0 +1,518 @@
+import os
+import sys
+import json
+import gzip
+import bisect
+import logging
+import argparse
+import threading
+from datetime import date, datetime, timedelta
+from records import timestamp_key, decode_timestamp
+import store
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are still O_APPEND, just not flock-guarded
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Interaction activity store:
+#   data/activity/2026-10-19.log      one day's interactions, one JSON row per line
+#   data/activity/2026-10-01.log.gz   an older day, compressed by archive()
+# Interactions are partitioned by the day they started. Partitions are only
+# ever appended to, until archive() compresses a day once it is
+# ARCHIVE_AFTER_DAYS old; a late row for an archived day starts a new .log
+# beside the archive and is merged in by the next archive().
+#
+# Each worker keeps a timeline index of the latest TIMELINE_SIZE
+# interactions per customer, so a customer's recent interactions never
+# touch the disk, plus the day partition of each interaction from the days
+# not yet old enough to archive, for lookups and deduplication. Older
+# interactions are read back from their partitions when asked for, and an
+# interaction recorded again for an archive-age day is checked against that
+# day's partition. The index catches up on rows other workers appended by
+# reading each .log from where it left off, and reads each new or rewritten
+# archive once, outside its lock.
+ACTIVITY_DIR = 'data/activity'
+LOG_SUFFIX = '.log'
+ARCHIVE_SUFFIX = '.log.gz'
+
+# Rows are stored as JSON arrays of these fields, in this order
+FIELDS = ('interaction_id', 'customer_id', 'started_at', 'ended_at', 'direction', 'duration', 'recorded_at')
+DIRECTIONS = ('inbound', 'outbound')
+
+# Days a partition stays uncompressed (today counts as day 0)
+ARCHIVE_AFTER_DAYS = int(os.environ.get('CRM_ACTIVITY_ARCHIVE_DAYS', 7))
+COMPRESSION_LEVEL = 6
+# Interactions per customer each worker keeps in memory
+TIMELINE_SIZE = int(os.environ.get('CRM_ACTIVITY_TIMELINE_SIZE', 50))
+
+def _to_dict(row):
+    return dict(zip(FIELDS, row))
+
+def _partition_path(day, suffix=LOG_SUFFIX):
+    return os.path.join(ACTIVITY_DIR, day + suffix)
+
+def _partitions():
+    """Get the day partitions on disk.
+
+    Returns:
+        tuple: ({day: log path}, {day: archive path})
+    """
+    logs, archives = {}, {}
+    try:
+        entries = list(os.scandir(ACTIVITY_DIR))
+    except FileNotFoundError:
+        return logs, archives
+    for entry in entries:
+        if entry.name.endswith(ARCHIVE_SUFFIX):
+            archives[entry.name[:-len(ARCHIVE_SUFFIX)]] = entry.path
+        elif entry.name.endswith(LOG_SUFFIX):
+            logs[entry.name[:-len(LOG_SUFFIX)]] = entry.path
+    return logs, archives
+
+def _parse_rows(data, source):
+    """Parse complete JSON lines, skipping malformed ones.
+
+    Returns:
+        tuple: (rows, bytes consumed up to the last complete line)
+    """
+    rows = []
+    consumed = 0
+    for line in data.splitlines(keepends=True):
+        # A line without its newline is still being written by another worker
+        if not line.endswith(b'\n'):
+            break
+        consumed += len(line)
+        try:
+            rows.append(tuple(json.loads(line)))
+        except (json.JSONDecodeError, TypeError):
+            logger.warning(f"Skipping malformed interaction row in {source}")
+    return rows, consumed
+
+def _read_archive(path):
+    try:
+        with gzip.open(path, 'rb') as f:
+            return _parse_rows(f.read(), path)[0]
+    except FileNotFoundError:
+        return []
+
+def _read_log(path, offset=0):
+    """Read the complete rows of a log from offset.
+
+    Returns:
+        tuple: (rows, offset past the last complete row, inode)
+    """
+    try:
+        with open(path, 'rb') as f:
+            inode = os.fstat(f.fileno()).st_ino
+            f.seek(offset)
+            rows, consumed = _parse_rows(f.read(), path)
+    except FileNotFoundError:
+        return [], 0, None
+    return rows, offset + consumed, inode
+
+def _read_partition(day):
+    """Read a day's rows, archived first, without duplicate interactions."""
+    rows = _read_archive(_partition_path(day, ARCHIVE_SUFFIX)) + _read_log(_partition_path(day))[0]
+    seen = set()
+    return [row for row in rows if row[0] not in seen and not seen.add(row[0])]
+
+def _start_key(row):
+    return timestamp_key(row[2]) or 0
+
+def _archive_cutoff(today=None, older_than_days=ARCHIVE_AFTER_DAYS):
+    """Get the latest day old enough to archive."""
+    return ((today or date.today()) - timedelta(days=older_than_days)).isoformat()
+
+def _locked_append(path, data):
+    """Append to a partition log, reopening it if archive() removed it meanwhile."""
+    while True:
+        with open(path, 'ab') as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_nlink == 0:
+                    continue
+                f.write(data)
+                f.flush()
+                if store.FSYNC:
+                    os.fsync(f.fileno())
+                return
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+class _Timeline:
+    """The latest interactions by customer, and the day partition of each recent interaction"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._days = {}  # interaction_id -> day partition holding it, for days after _cutoff
+        self._ids = {}  # day -> interaction_ids in _days from that day
+        self._cutoff = _archive_cutoff()
+        self._rows = {}  # interaction_id -> row, for rows held in _by_customer
+        self._by_customer = {}  # customer_id -> ([start keys], [rows]) in start order
+        self._older = {}  # customer_id -> latest start key among its rows not held
+        self._offsets = {}  # log path -> (inode, offset read up to)
+        self._archives = {}  # archive path -> (mtime_ns, size) when read
+        self._directory = None  # ACTIVITY_DIR mtime_ns when last scanned
+        self._logs = []
+
+    def add(self, row):
+        """Index a row unless its interaction is already indexed.
+
+        Interactions from archive-age days aren't remembered by ID, so one
+        of those is only skipped if it is held in a customer's timeline.
+
+        Returns:
+            bool: Whether it was new
+        """
+        if row[0] in self._days or row[0] in self._rows:
+            return False
+        day = sys.intern(str(row[2])[:10])
+        if day > self._cutoff:
+            self._days[row[0]] = day
+            self._ids.setdefault(day, []).append(row[0])
+        customer_id = row[1]
+        if customer_id is None:
+            return True
+        keys, rows = self._by_customer.setdefault(customer_id, ([], []))
+        key = _start_key(row)
+        if len(rows) >= TIMELINE_SIZE:
+            if key <= keys[0]:
+                # Older than every row held, so it stays on disk
+                self._older[customer_id] = max(self._older.get(customer_id, key), key)
+                return True
+            dropped = keys.pop(0)
+            del self._rows[rows.pop(0)[0]]
+            self._older[customer_id] = max(self._older.get(customer_id, dropped), dropped)
+        position = bisect.bisect_right(keys, key)
+        keys.insert(position, key)
+        rows.insert(position, row)
+        self._rows[row[0]] = row
+        return True
+
+    def _forget_old_days(self):
+        """Stop remembering the IDs of days that have become old enough to archive."""
+        cutoff = _archive_cutoff()
+        if cutoff == self._cutoff:
+            return
+        self._cutoff = cutoff
+        for day in [day for day in self._ids if day <= cutoff]:
+            for interaction_id in self._ids.pop(day):
+                del self._days[interaction_id]
+
+    def catch_up(self):
+        """Index rows written since the last call, by this or any other worker."""
+        try:
+            directory = os.stat(ACTIVITY_DIR).st_mtime_ns
+        except FileNotFoundError:
+            return
+        # Partitions only appear, disappear or get replaced by renames, which
+        # change the directory; appends alone don't, so most calls skip the scan
+        changed = []
+        with self.lock:
+            self._forget_old_days()
+            if directory != self._directory:
+                logs, archives = _partitions()
+                for path in archives.values():
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    if self._archives.get(path) != (stat.st_mtime_ns, stat.st_size):
+                        changed.append((path, (stat.st_mtime_ns, stat.st_size)))
+                self._logs = sorted(logs.values())
+                self._offsets = {path: self._offsets[path] for path in self._logs if path in self._offsets}
+                if not changed:
+                    self._directory = directory
+
+        if changed:
+            # Mostly rows we already followed in the day's log, but late rows
+            # from other workers may only be in the archive. A day is a lot
+            # to decompress, so other threads carry on meanwhile.
+            loaded = [(path, signature, _read_archive(path)) for path, signature in changed]
+            with self.lock:
+                for path, signature, rows in loaded:
+                    for row in rows:
+                        self.add(row)
+                    self._archives[path] = signature
+                self._directory = directory
+
+        with self.lock:
+            for path in self._logs:
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Archived since the scan, into an archive we haven't read yet
+                    self._directory = None
+                    break
+                inode, offset = self._offsets.get(path, (None, 0))
+                if stat.st_ino != inode:
+                    # A new log, or one archived and started again by a late row
+                    offset = 0
+                elif stat.st_size == offset:
+                    continue
+                rows, end, inode = _read_log(path, offset)
+                for row in rows:
+                    self.add(row)
+                self._offsets[path] = (inode, end)
+            else:
+                return
+        return self.catch_up()
+
+    def indexed(self, interaction_id):
+        return interaction_id in self._days or interaction_id in self._rows
+
+    def recent(self, day):
+        """Whether a day is recent enough for its interactions to be indexed by ID."""
+        return day > self._cutoff
+
+    def find(self, interaction_id):
+        """Get an interaction's row, reading its partition if it isn't held.
+
+        An interaction from an archive-age day is searched for on disk, newest
+        day first.
+        """
+        with self.lock:
+            row = self._rows.get(interaction_id)
+            day = self._days.get(interaction_id)
+            cutoff = self._cutoff
+        if row is not None:
+            return row
+        if day is not None:
+            days = [day]
+        else:
+            logs, archives = _partitions()
+            days = sorted((day for day in set(logs) | set(archives) if day <= cutoff), reverse=True)
+        for day in days:
+            row = next((row for row in _read_partition(day) if row[0] == interaction_id), None)
+            if row is not None:
+                return row
+        return None
+
+    def for_customer(self, customer_id, limit, before=None):
+        """Get a customer's latest rows that started before a start key, newest first."""
+        with self.lock:
+            keys, rows = self._by_customer.get(customer_id, ((), ()))
+            end = len(rows) if before is None else bisect.bisect_left(keys, before)
+            older = self._older.get(customer_id)
+            # Rows held are only complete after the latest one not held
+            held_from = 0 if older is None else bisect.bisect_right(keys, older)
+            found = rows[max(0, end - limit, held_from):end][::-1]
+        if len(found) == limit or older is None:
+            return found
+        newest = older if before is None else min(older, before - 1)
+        return found + self._read_older(customer_id, limit - len(found), newest)
+
+    def _read_older(self, customer_id, limit, newest):
+        """Read up to limit of a customer's rows starting at or before a key from their partitions, newest first."""
+        logs, archives = _partitions()
+        last_day = decode_timestamp(newest)[:10]
+        found = []
+        for day in sorted(set(logs) | set(archives), reverse=True):
+            if day > last_day:
+                continue
+            # A row stored twice on different recent days counts where it was indexed
+            rows = [row for row in _read_partition(day)
+                    if row[1] == customer_id and _start_key(row) <= newest and self._days.get(row[0], day) == day]
+            rows.sort(key=_start_key, reverse=True)
+            found.extend(rows)
+            if len(found) >= limit:
+                break
+        return found[:limit]
+
+    def counts(self):
+        """Get (interactions indexed by ID, customers, interactions held in memory)."""
+        with self.lock:
+            return len(self._days), len(self._by_customer), len(self._rows)
+
+_timeline = _Timeline()
+_archived_on = None
+
+def _normalize_time(value, name):
+    if value is None:
+        return None
+    key = timestamp_key(value)
+    if key is None:
+        raise ValueError(f"{name} must be an ISO timestamp")
+    return decode_timestamp(key)
+
+def record(interaction_id, customer_id=None, started_at=None, ended_at=None, direction=None, duration=None):
+    """Record an interaction in the day partition it started on.
+
+    Recording an interaction again returns the row already stored.
+
+    Args:
+        interaction_id (str): The Genesys Cloud conversation ID
+        customer_id (str): The CRM customer it was with, if known
+        started_at (str): ISO start time (defaults to now)
+        ended_at (str): ISO end time, if it has ended
+        direction (str): 'inbound' or 'outbound', if known
+        duration (float): Seconds (defaults to ended_at - started_at)
+
+    Returns:
+        tuple: (interaction dict, True if it was recorded by this call)
+
+    Raises:
+        ValueError: If a field is invalid
+    """
+    if not interaction_id or not isinstance(interaction_id, str):
+        raise ValueError("interaction_id is required")
+    now = datetime.now().isoformat()
+    started_at = _normalize_time(started_at, 'started_at') or now
+    ended_at = _normalize_time(ended_at, 'ended_at')
+    if direction is not None:
+        direction = str(direction).lower()
+        if direction not in DIRECTIONS:
+            raise ValueError(f"direction must be one of {', '.join(DIRECTIONS)}")
+    if duration is None and ended_at is not None:
+        duration = round((timestamp_key(ended_at) - timestamp_key(started_at)) / 1e6, 3)
+    if duration is not None and (isinstance(duration, bool) or not isinstance(duration, (int, float)) or duration < 0):
+        raise ValueError("duration must be a non-negative number of seconds")
+
+    row = (interaction_id, customer_id, started_at, ended_at, direction, duration, now)
+    _timeline.catch_up()
+    day = started_at[:10]
+    if not _timeline.recent(day) and any(stored[0] == interaction_id for stored in _read_partition(day)):
+        # Already in an archive-age day, which the index doesn't cover
+        return get(interaction_id), False
+    with _timeline.lock:
+        created = not _timeline.indexed(interaction_id)
+        if created:
+            os.makedirs(ACTIVITY_DIR, exist_ok=True)
+            _locked_append(_partition_path(day),
+                           (json.dumps(row, separators=(',', ':')) + '\n').encode('utf-8'))
+            _timeline.add(row)
+    if not created:
+        return get(interaction_id), False
+
+    _archive_daily()
+    return _to_dict(row), True
+
+def get(interaction_id):
+    """Get a recorded interaction by ID, or None."""
+    _timeline.catch_up()
+    row = _timeline.find(interaction_id)
+    return _to_dict(row) if row else None
+
+def customer_timeline(customer_id, limit=20, before=None):
+    """Get a customer's most recent interactions, newest first.
+
+    Args:
+        customer_id (str): The customer ID
+        limit (int): The most interactions to return
+        before (str): Only interactions that started before this ISO time
+
+    Raises:
+        ValueError: If before is not a timestamp
+    """
+    bound = None
+    if before is not None:
+        bound = timestamp_key(before)
+        if bound is None:
+            raise ValueError("before must be an ISO timestamp")
+    _timeline.catch_up()
+    return [_to_dict(row) for row in _timeline.for_customer(customer_id, limit, bound)]
+
+def interactions_on(day):
+    """Get every interaction that started on a day, in start order.
+
+    Reads the day's partition directly, archived or not.
+
+    Args:
+        day (str): YYYY-MM-DD
+
+    Raises:
+        ValueError: If day is not a date
+    """
+    rows = _read_partition(date.fromisoformat(day).isoformat())
+    rows.sort(key=_start_key)
+    return [_to_dict(row) for row in rows]
+
+def archive(older_than_days=ARCHIVE_AFTER_DAYS, today=None):
+    """Compress the partitions of days at least older_than_days old.
+
+    A day that is already archived has any late rows merged into its
+    archive. Safe to run from several workers at once.
+
+    Returns:
+        list: The days archived
+    """
+    cutoff = _archive_cutoff(today, older_than_days)
+    logs, _ = _partitions()
+    archived = []
+    for day, path in sorted(logs.items()):
+        if day > cutoff:
+            continue
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            continue
+        with f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            # Another worker archived it while we waited for the lock
+            if os.fstat(f.fileno()).st_nlink == 0:
+                continue
+            archive_path = _partition_path(day, ARCHIVE_SUFFIX)
+            rows = _read_archive(archive_path) + _parse_rows(f.read(), path)[0]
+            data = b''.join((json.dumps(row, separators=(',', ':')) + '\n').encode('utf-8') for row in rows)
+            temp_path = f'{archive_path}.tmp-{os.getpid()}'
+            with gzip.open(temp_path, 'wb', compresslevel=COMPRESSION_LEVEL) as out:
+                out.write(data)
+            os.replace(temp_path, archive_path)
+            # Unlinked while locked, so appenders waiting on it start a new log
+            os.remove(path)
+        archived.append(day)
+    if archived:
+        logger.info(f"Archived interaction partitions: {', '.join(archived)}")
+    return archived
+
+def _archive_daily():
+    """Archive old partitions in the background, once a day per worker."""
+    global _archived_on
+    today = date.today()
+    if _archived_on == today:
+        return
+    _archived_on = today
+
+    def run():
+        try:
+            archive(today=today)
+        except OSError as e:
+            logger.error(f"Failed to archive interaction partitions: {str(e)}")
+    threading.Thread(target=run, daemon=True).start()
+
+def stats():
+    """Get partition and index counts for monitoring."""
+    logs, archives = _partitions()
+    _timeline.catch_up()
+    interactions, customers, held = _timeline.counts()
+    return {
+        'interactions_indexed': interactions,
+        'customers': customers,
+        'interactions_in_memory': held,
+        'timeline_size': TIMELINE_SIZE,
+        'open_partitions': len(logs),
+        'archived_partitions': len(archives),
+        'archive_after_days': ARCHIVE_AFTER_DAYS
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the CRM interaction activity store")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    archive_parser = subparsers.add_parser('archive', help="Compress old day partitions")
+    archive_parser.add_argument('--older-than', type=int, default=ARCHIVE_AFTER_DAYS,
+                                help=f"Archive days at least this many days old (default: {ARCHIVE_AFTER_DAYS})")
+    subparsers.add_parser('stats', help="Show partition and index counts")
+    args = parser.parse_args()
+
+    if args.command == 'archive':
+        days = archive(args.older_than)
+        print(f"Archived {len(days)} partitions" + (f": {', '.join(days)}" if days else ""))
+    else:
+        print(json.dumps(stats(), indent=2))
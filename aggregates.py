@@ -0,0 +1,186 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from decimal import Decimal, InvalidOperation
+from mapped import KEY_SIZE, record_key
+from records import decode_id, timestamp_key
+
+# Running summaries kept alongside a collection (see store.Collection.aggregate).
+#
+# An aggregate is built once by feeding every record to add(), then kept
+# current by calling remove() with the old version and add() with the new
+# version of each changed record. Amounts are summed as Decimal so that
+# repeatedly adding and removing the same values never drifts.
+
+_ZERO = Decimal(0)
+
+def _amount(value):
+    """Parse a deal amount, counting anything that isn't a finite number as 0."""
+    if value is None or isinstance(value, bool):
+        return _ZERO
+    try:
+        amount = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        return _ZERO
+    return amount if amount.is_finite() else _ZERO
+
+def _totals(count, amount):
+    return {'count': count, 'amount': float(amount)}
+
+class DealTotals:
+    """Deal count and amount sum per status and per customer"""
+
+    def __init__(self):
+        self.by_status = {}
+        self.by_customer = {}
+
+    def _change(self, record, sign):
+        amount = _amount(record.get('amount')) * sign
+        status = record.raw('status')
+        for table, key in ((self.by_status, status if isinstance(status, str) else ''),
+                           (self.by_customer, record.raw('customer_id'))):
+            entry = table.setdefault(key, [0, _ZERO])
+            entry[0] += sign
+            entry[1] += amount
+            if not entry[0]:
+                del table[key]
+
+    def add(self, record):
+        self._change(record, 1)
+
+    def remove(self, record):
+        self._change(record, -1)
+
+    def status_totals(self):
+        """Get {status: {'count', 'amount'}} for every status in use."""
+        return {status: _totals(*entry) for status, entry in self.by_status.items()}
+
+    def customer_totals(self, customer_key):
+        """Get the totals for one customer, given its encoded ID."""
+        return _totals(*self.by_customer.get(customer_key, (0, _ZERO)))
+
+    def all_customer_totals(self):
+        """Get {customer_id: {'count', 'amount'}} for every customer with deals."""
+        return {'' if key is None else str(decode_id(key)): _totals(*entry) for key, entry in self.by_customer.items()}
+
+class ReferenceIndex:
+    """Keys of the records that refer to each value of a field, such as customer_id
+
+    Records are grouped under the field's encoded value. Each group is a
+    tuple rather than a set: groups are small (a customer's contacts or
+    deals), and a tuple of a few keys takes a fraction of a set's memory.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.groups = {}
+
+    def add(self, record):
+        value = record.raw(self.field)
+        self.groups[value] = self.groups.get(value, ()) + (record_key(record.raw('id')),)
+
+    def remove(self, record):
+        value = record.raw(self.field)
+        key = record_key(record.raw('id'))
+        remaining = tuple(member for member in self.groups.get(value, ()) if member != key)
+        if remaining:
+            self.groups[value] = remaining
+        else:
+            self.groups.pop(value, None)
+
+    def get(self, value):
+        """Get the keys of the records whose field has this encoded value."""
+        return self.groups.get(value, ())
+
+class ValueIndex:
+    """Keys of the records holding each value of a field with few distinct values, such as status
+
+    Each value is shared by a large part of the collection, so groups are
+    sets rather than ReferenceIndex's tuples, which would be copied on every
+    add.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.groups = {}
+
+    def add(self, record):
+        self.groups.setdefault(record.raw(self.field), set()).add(record_key(record.raw('id')))
+
+    def remove(self, record):
+        value = record.raw(self.field)
+        group = self.groups.get(value)
+        if group is not None:
+            group.discard(record_key(record.raw('id')))
+            if not group:
+                del self.groups[value]
+
+    def get(self, value):
+        """Get the keys of the records whose field has this encoded value."""
+        return self.groups.get(value, frozenset())
+
+# Time under which TimeIndex files records without a readable timestamp
+UNTIMED = -2 ** 63
+
+class TimeIndex:
+    """Record keys in order of a timestamp field, such as updated_at
+
+    The index is two flat arrays in time order: the times as 64-bit
+    microseconds and the keys as one byte string of KEY_SIZE-byte keys, so
+    it costs 24 bytes a record. A change is inserted with a binary search;
+    records added in bulk (as when the index is first built) are kept aside
+    and sorted in together when next needed. Records without a readable
+    time sort first, at UNTIMED.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.times = array('q')
+        self.keys = bytearray()
+        self._pending = []
+
+    def _entry(self, record):
+        time = timestamp_key(record.raw(self.field))
+        return UNTIMED if time is None else time, record_key(record.raw('id'))
+
+    def _settle(self):
+        pending, self._pending = self._pending, []
+        if len(pending) * 16 < len(self.times):
+            for time, key in pending:
+                position = bisect_right(self.times, time)
+                self.times.insert(position, time)
+                self.keys[position * KEY_SIZE:position * KEY_SIZE] = key
+            return
+        keys = self.keys
+        entries = [(time, bytes(keys[number * KEY_SIZE:(number + 1) * KEY_SIZE]))
+                   for number, time in enumerate(self.times)]
+        entries.extend(pending)
+        entries.sort()
+        self.times = array('q', [time for time, _ in entries])
+        self.keys = bytearray(b''.join(key for _, key in entries))
+
+    def add(self, record):
+        self._pending.append(self._entry(record))
+
+    def remove(self, record):
+        if self._pending:
+            self._settle()
+        time, key = self._entry(record)
+        keys = self.keys
+        for position in range(bisect_left(self.times, time), bisect_right(self.times, time)):
+            if keys[position * KEY_SIZE:(position + 1) * KEY_SIZE] == key:
+                del self.times[position]
+                del keys[position * KEY_SIZE:(position + 1) * KEY_SIZE]
+                return
+
+    def between(self, start=None, end=None):
+        """Get the keys of the records timed from start up to but not including end, oldest first.
+
+        Returns:
+            bytes: The keys joined together, KEY_SIZE bytes each; a copy, so
+            it can be read after letting go of the collection lock
+        """
+        if self._pending:
+            self._settle()
+        low = 0 if start is None else bisect_left(self.times, start)
+        high = len(self.times) if end is None else bisect_left(self.times, end)
+        return bytes(self.keys[low * KEY_SIZE:max(low, high) * KEY_SIZE])
@@ -0,0 +1,202 @@
+import math
+import weakref
+import threading
+from functools import lru_cache
+import data_manager
+import metrics
+from records import Customer, Deal
+
+# Pipeline analytics over the deals.
+#
+# The deals are flattened once per data generation into columns: an amount
+# per deal plus integer codes for its close month, status and customer
+# industry, held as NumPy arrays. Every report is then a handful of
+# vectorized group-by sums (numpy.bincount) over those columns. Columns and
+# finished reports are cached until the deal or customer collection changes.
+
+# Chance that a deal in each stage closes; stages not listed count as 0
+STAGE_PROBABILITIES = {
+    'New': 0.1,
+    'Qualified': 0.25,
+    'Proposal': 0.5,
+    'Negotiation': 0.75,
+    'Closed Won': 1.0,
+    'Closed Lost': 0.0
+}
+WON_STATUSES = frozenset(['Closed Won'])
+CLOSED_STATUSES = frozenset(['Closed Won', 'Closed Lost'])
+
+DIMENSIONS = ('month', 'status', 'industry')
+
+@lru_cache(maxsize=None)
+def _numpy():
+    """Import NumPy on first use, so starting the app doesn't pay for it."""
+    import numpy
+    return numpy
+
+def _amount(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        amount = float(value)
+    elif isinstance(value, str):
+        try:
+            amount = float(value)
+        except ValueError:
+            return 0.0
+    else:
+        return 0.0
+    # Skip nan and inf so one bad record can't poison every total
+    return amount if math.isfinite(amount) else 0.0
+
+def _month(value):
+    """Get 'YYYY-MM' from an ISO date, or None."""
+    if (isinstance(value, str) and len(value) >= 7 and value[:4].isdigit() and
+            value[4] == '-' and value[5:7].isdigit()):
+        return value[:7]
+    return None
+
+class _Codes:
+    """Assign consecutive integer codes to values in order of first appearance"""
+
+    def __init__(self):
+        self.codes = {}
+        self.labels = []
+
+    def __call__(self, value):
+        if value is Ellipsis:
+            value = None
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.labels)
+            self.labels.append(value)
+        return code
+
+class _Columns:
+    """Deals as parallel columns of amounts and group codes"""
+
+    def __init__(self, customers, deals):
+        # Read the encoded fields straight from the record tuples; absent
+        # fields come back as Ellipsis, which _month and _Codes treat as None
+        months, statuses, industries = _Codes(), _Codes(), _Codes()
+        no_industry = industries(None)
+        industry_of = {customer_id: industries(value or None)
+                       for customer_id, value in map(Customer.getter('id', 'industry'), customers)}
+        deal_fields = Deal.getter('expected_close_date', 'status', 'customer_id', 'amount')
+        # Stored close dates and statuses repeat across deals, so code each
+        # distinct value once
+        month_of, status_of = {}, {}
+        month, status, industry, amount = [], [], [], []
+        isfinite = math.isfinite
+        for close_date, stage, customer_id, value in map(deal_fields, deals):
+            code = month_of.get(close_date)
+            if code is None:
+                code = month_of[close_date] = months(_month(close_date))
+            month.append(code)
+            code = status_of.get(stage)
+            if code is None:
+                code = status_of[stage] = statuses(stage)
+            status.append(code)
+            industry.append(industry_of.get(customer_id, no_industry))
+            amount.append(value if type(value) is float and isfinite(value) else _amount(value))
+
+        self.labels = {'month': months.labels, 'status': statuses.labels, 'industry': industries.labels}
+        self.count = len(amount)
+
+        # Per-status factors, looked up per deal through its status code
+        probability = [STAGE_PROBABILITIES.get(label, 0.0) for label in statuses.labels]
+        is_open = [0.0 if label in CLOSED_STATUSES else 1.0 for label in statuses.labels]
+        is_won = [1.0 if label in WON_STATUSES else 0.0 for label in statuses.labels]
+
+        np = _numpy()
+        status = np.asarray(status, dtype=np.intp)
+        self.codes = {'month': np.asarray(month, dtype=np.intp), 'status': status,
+                      'industry': np.asarray(industry, dtype=np.intp)}
+        self.amount = np.asarray(amount, dtype=np.float64)
+        self.weighted = self.amount * np.asarray(probability, dtype=np.float64)[status]
+        self.open = self.amount * np.asarray(is_open, dtype=np.float64)[status]
+        self.won = self.amount * np.asarray(is_won, dtype=np.float64)[status]
+
+    def group(self, dimension, *columns):
+        """Sum columns per group of a dimension.
+
+        Returns:
+            tuple: (deal counts, one list of sums per column), indexed by group code
+        """
+        codes = self.codes[dimension]
+        size = len(self.labels[dimension])
+        np = _numpy()
+        return (np.bincount(codes, minlength=size).tolist(),
+                [np.bincount(codes, weights=column, minlength=size).tolist() for column in columns])
+
+def _sort_key(row, dimension):
+    # Groups without a value (no close date, no industry) sort last
+    return (row[dimension] is None, row[dimension] or '')
+
+def _revenue(columns, dimension):
+    counts, (amounts, weighted) = columns.group(dimension, columns.amount, columns.weighted)
+    rows = [
+        {dimension: label, 'count': counts[code], 'amount': amounts[code], 'weighted_amount': weighted[code]}
+        for code, label in enumerate(columns.labels[dimension]) if counts[code]
+    ]
+    rows.sort(key=lambda row: _sort_key(row, dimension))
+    return {'dimension': dimension, 'groups': rows}
+
+def _forecast(columns):
+    counts, (pipeline, weighted, won) = columns.group('month', columns.open, columns.weighted, columns.won)
+    rows = []
+    for code, label in enumerate(columns.labels['month']):
+        if counts[code]:
+            rows.append({
+                'month': label,
+                'deals': counts[code],
+                'pipeline_amount': pipeline[code],
+                'weighted_amount': weighted[code],
+                'won_amount': won[code]
+            })
+    rows.sort(key=lambda row: _sort_key(row, 'month'))
+    totals = {
+        'deals': columns.count,
+        'pipeline_amount': sum(row['pipeline_amount'] for row in rows),
+        'weighted_amount': sum(row['weighted_amount'] for row in rows),
+        'won_amount': sum(row['won_amount'] for row in rows)
+    }
+    return {'stage_probabilities': STAGE_PROBABILITIES, 'months': rows, 'totals': totals}
+
+# Results for the data generation in _generation, weak references to a
+# (customers, deals) pair of views. Views are immutable and replaced on every
+# change, so comparing them by identity tells exactly when the cache is
+# stale; holding them weakly lets an old version be reclaimed as soon as no
+# request is reading it, instead of lingering until the next report.
+_lock = threading.Lock()
+_generation = None
+_columns = None
+_results = {}
+
+def _cached(name, compute):
+    global _generation, _columns
+    generation = data_manager.get_views()
+    with _lock:
+        if _generation is None or any(ref() is not view for ref, view in zip(_generation, generation)):
+            with metrics.timer('crm_datastore_operation_seconds', collection='deals', op='scan'):
+                _columns = _Columns(*generation)
+            _generation = tuple(weakref.ref(view) for view in generation)
+            _results.clear()
+        if name not in _results:
+            _results[name] = compute(_columns)
+        return _results[name]
+
+def revenue(dimension):
+    """Get deal count, amount and weighted amount per month, status or industry.
+
+    Args:
+        dimension (str): One of DIMENSIONS; month is the month of expected_close_date
+
+    Returns:
+        dict: The dimension and one row per group in use
+    """
+    if dimension not in DIMENSIONS:
+        raise ValueError(f"Unknown dimension {dimension}")
+    return _cached(f'revenue:{dimension}', lambda columns: _revenue(columns, dimension))
+
+def forecast():
+    """Get the open pipeline, its probability-weighted amount and won amounts per close month."""
+    return _cached('forecast', _forecast)
@@ -1,27 +1,82 @@
 import os
+import json
+import math
+import time
 import logging
+import threading
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
+from flask import Flask, Response, g, render_template, request, jsonify, session, redirect, url_for, flash, stream_with_context
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.security import check_password_hash
-from auth import get_user_by_username, register_user, authenticate_user
+from auth import get_user_by_username, register_user, authenticate_user, get_user_roles
 from data_manager import (
-    get_all_customers, get_customer, create_customer, update_customer, delete_customer,
-    get_all_contacts, get_contact, create_contact, update_contact, delete_contact,
-    get_all_deals, get_deal, create_deal, update_deal, delete_deal,
-    search_customers, search_contacts, search_deals, backup_data
+    get_all_customers, get_customer, get_customers, get_customer_full, create_customer, update_customer,
+    delete_customer, get_all_contacts, get_contacts_for_customer, get_contact, get_contacts, create_contact,
+    update_contact, delete_contact, get_all_deals, get_deals_for_customer, get_deal, get_deals, create_deal,
+    update_deal, delete_deal,
+    search_customers, search_contacts, search_deals, get_stats, backup_data, init_storage,
+    find_duplicate_customers, find_duplicate_clusters, DuplicateCustomerError, suggest_customers, query_records,
+    list_customers, list_contacts, list_deals, advanced_search
 )
+from query import QueryError
 from genesys_integration import GenesysCloudIntegration
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import events
+import activity
+import analytics
+import suggest
+import backup
+import metrics
+import profiler
+import webhooks
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "default-dev-secret-key")
 
+# Application initialization
+def create_app():
+    """Initialize the application and return it.
+    
+    Importing this module only defines routes. Anything that configures the
+    process or touches the filesystem happens here, once per process, so
+    workers boot quickly and tools can import the module without side effects.
+    """
+    logging.basicConfig(level=logging.DEBUG)
+    init_storage()
+    return app
+
 # API authentication
 auth = HTTPBasicAuth()
 
+# Request instrumentation
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def start_webhook_delivery():
+    # Started from a request rather than create_app() so that under a
+    # preloading server each worker starts its own after the fork
+    webhooks.start()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = {'route': route, 'method': request.method}
+    metrics.observe('crm_http_request_duration_seconds', time.perf_counter() - g.get('request_started', time.perf_counter()),
+                    status=str(response.status_code), **labels)
+    metrics.inc('crm_http_request_bytes_total', request.content_length or 0, **labels)
+    # Streamed responses (e.g. /api/stream) have no length up front
+    metrics.inc('crm_http_response_bytes_total', response.content_length or 0, **labels)
+    metrics.flush()
+    return response
+
+@app.after_request
+def count_profiled_request(response):
+    # Profiling control requests don't count towards "the next N requests"
+    if not request.path.startswith('/api/admin/profile'):
+        profiler.request_finished()
+    return response
+
 @auth.verify_password
 def verify_password(username, password):
     user = get_user_by_username(username)
@@ -29,6 +84,10 @@ def verify_password(username, password):
         return username
     return None
 
+@auth.get_user_roles
+def user_roles(username):
+    return get_user_roles(username)
+
 # Web Routes
 @app.route('/')
 def index():
@@ -81,11 +140,59 @@ def logout():
 def api_docs():
     return render_template('api_docs.html')
 
+def _allow_duplicate():
+    """Whether the client asked to create a customer even if it looks like a duplicate"""
+    return request.args.get('allow_duplicate', '').lower() in ('1', 'true', 'yes')
+
+def _duplicate_response(error):
+    return jsonify({"error": str(error), "duplicates": error.matches}), 409
+
+# Most IDs accepted by one ?ids= multi-get
+MAX_IDS = 500
+
+def _requested_ids():
+    """The IDs from a comma-separated ?ids= parameter, or None if it wasn't given"""
+    if 'ids' not in request.args:
+        return None
+    return [record_id.strip() for record_id in request.args['ids'].split(',') if record_id.strip()]
+
+def _multi_get(get_many, ids):
+    if len(ids) > MAX_IDS:
+        return jsonify({"error": f"At most {MAX_IDS} IDs can be requested at once"}), 400
+    return jsonify(get_many(ids))
+
+# Parameters that make a list endpoint list by recency from the time indexes
+TIME_LISTING_PARAMS = ('updated_since', 'created_between', 'sort')
+
+def _time_listing():
+    """The recency options given to a list endpoint, or None if there were none"""
+    if not any(request.args.get(name) for name in TIME_LISTING_PARAMS):
+        return None
+    options = {name: request.args.get(name) for name in TIME_LISTING_PARAMS}
+    options['limit'] = request.args.get('limit', type=int)
+    return options
+
+def _list_by_time(list_records, **filters):
+    if filters['limit'] is not None and filters['limit'] < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    try:
+        return jsonify(list_records(**filters))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
 # API Routes for Customers
 @app.route('/api/customers', methods=['GET'])
 @auth.login_required
 def api_get_customers():
+    ids = _requested_ids()
+    if ids is not None:
+        return _multi_get(get_customers, ids)
+    
     search_term = request.args.get('search', '')
+    listing = _time_listing()
+    if listing is not None:
+        return _list_by_time(list_customers, search_term=search_term, **listing)
+    
     if search_term:
         customers = search_customers(search_term)
     else:
@@ -100,6 +207,30 @@ def api_get_customer(customer_id):
         return jsonify(customer)
     return jsonify({"error": "Customer not found"}), 404
 
+@app.route('/api/customers/<customer_id>/full', methods=['GET'])
+@auth.login_required
+def api_get_customer_full(customer_id):
+    """Get a customer with its contacts, deals and deal totals in one response"""
+    customer = get_customer_full(customer_id)
+    if customer:
+        return jsonify(customer)
+    return jsonify({"error": "Customer not found"}), 404
+
+@app.route('/api/customers/<customer_id>/interactions', methods=['GET'])
+@auth.login_required
+def api_get_customer_interactions(customer_id):
+    """Get a customer's most recent recorded interactions, newest first"""
+    if not get_customer(customer_id):
+        return jsonify({"error": "Customer not found"}), 404
+    
+    limit = request.args.get('limit', 20, type=int)
+    if not 1 <= limit <= MAX_IDS:
+        return jsonify({"error": f"limit must be between 1 and {MAX_IDS}"}), 400
+    try:
+        return jsonify(activity.customer_timeline(customer_id, limit=limit, before=request.args.get('before')))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
 @app.route('/api/customers', methods=['POST'])
 @auth.login_required
 def api_add_customer():
@@ -116,8 +247,46 @@ def api_add_customer():
         }), 400
     
     try:
-        customer = create_customer(data)
+        customer = create_customer(data, check_duplicates=not _allow_duplicate())
         return jsonify(customer), 201
+    except DuplicateCustomerError as e:
+        return _duplicate_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/customers/suggest', methods=['GET'])
+@auth.login_required
+def api_suggest_customers():
+    """Autocomplete customer names for pickers, without loading every customer"""
+    query = request.args.get('q', '')
+    limit = max(1, min(request.args.get('limit', suggest.DEFAULT_LIMIT, type=int), suggest.MAX_LIMIT))
+    
+    try:
+        return jsonify(suggest_customers(query, limit))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/customers/duplicates/check', methods=['POST'])
+@auth.login_required
+def api_check_duplicate_customers():
+    """Find existing customers that look like the posted one, without creating it"""
+    data = request.json
+    if not data:
+        return jsonify({"error": "Invalid data"}), 400
+    
+    try:
+        return jsonify({"duplicates": find_duplicate_customers(data, exclude_id=data.get('id'))})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/customers/duplicates', methods=['GET'])
+@auth.login_required
+def api_duplicate_customer_clusters():
+    """Report groups of likely duplicate customers across the whole customer base"""
+    limit = request.args.get('limit', 100, type=int)
+    
+    try:
+        return jsonify(find_duplicate_clusters(limit))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -155,16 +324,25 @@ def api_delete_customer(customer_id):
 @app.route('/api/contacts', methods=['GET'])
 @auth.login_required
 def api_get_contacts():
+    ids = _requested_ids()
+    if ids is not None:
+        return _multi_get(get_contacts, ids)
+    
     search_term = request.args.get('search', '')
     customer_id = request.args.get('customer_id', '')
     
+    listing = _time_listing()
+    if listing is not None:
+        return _list_by_time(list_contacts, search_term=search_term, customer_id=customer_id, **listing)
+    
     if search_term:
         contacts = search_contacts(search_term)
+        if customer_id:
+            contacts = [c for c in contacts if c.get('customer_id') == customer_id]
+    elif customer_id:
+        contacts = get_contacts_for_customer(customer_id)
     else:
         contacts = get_all_contacts()
-    
-    if customer_id:
-        contacts = [c for c in contacts if c.get('customer_id') == customer_id]
         
     return jsonify(contacts)
 
@@ -231,16 +409,25 @@ def api_delete_contact(contact_id):
 @app.route('/api/deals', methods=['GET'])
 @auth.login_required
 def api_get_deals():
+    ids = _requested_ids()
+    if ids is not None:
+        return _multi_get(get_deals, ids)
+    
     search_term = request.args.get('search', '')
     customer_id = request.args.get('customer_id', '')
     
+    listing = _time_listing()
+    if listing is not None:
+        return _list_by_time(list_deals, search_term=search_term, customer_id=customer_id, **listing)
+    
     if search_term:
         deals = search_deals(search_term)
+        if customer_id:
+            deals = [d for d in deals if d.get('customer_id') == customer_id]
+    elif customer_id:
+        deals = get_deals_for_customer(customer_id)
     else:
         deals = get_all_deals()
-    
-    if customer_id:
-        deals = [d for d in deals if d.get('customer_id') == customer_id]
         
     return jsonify(deals)
 
@@ -303,7 +490,107 @@ def api_delete_deal(deal_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Backup Route
+# Query Routes
+@app.route('/api/query', methods=['GET'])
+@auth.login_required
+def api_query():
+    """Find customers, contacts or deals matching a filter expression, e.g.
+    ?entity=deals&where=status = "Closed Won" and amount > 10000 and customer.industry = Retail
+    """
+    limit = request.args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    
+    try:
+        return jsonify(query_records(request.args.get('entity', ''), request.args.get('where', ''), limit))
+    except QueryError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Advanced search limits: matches per request, and seconds per request
+MAX_SEARCH_RESULTS = 1000
+MAX_SEARCH_SECONDS = 30
+
+@app.route('/api/search', methods=['GET'])
+@auth.login_required
+def api_advanced_search():
+    """Search notes and deal descriptions by regex (?pattern=) and/or terms (?terms=),
+    streaming matches as newline-delimited JSON as they are found
+    """
+    entities = [entity for entity in request.args.get('entity', '').split(',') if entity]
+    limit = request.args.get('limit', 100, type=int)
+    timeout = request.args.get('timeout', 10, type=float)
+    if not 1 <= limit <= MAX_SEARCH_RESULTS:
+        return jsonify({"error": f"limit must be between 1 and {MAX_SEARCH_RESULTS}"}), 400
+    if not 0 < timeout <= MAX_SEARCH_SECONDS:
+        return jsonify({"error": f"timeout must be between 0 and {MAX_SEARCH_SECONDS} seconds"}), 400
+    
+    try:
+        results = advanced_search(entities, pattern=request.args.get('pattern') or None,
+                                  terms=request.args.get('terms', '').split(), limit=limit, timeout=timeout)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    def generate():
+        for result in results:
+            yield json.dumps(result) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Interaction Activity Routes
+@app.route('/api/interactions', methods=['GET'])
+@auth.login_required
+def api_get_interactions():
+    """Get the interactions that started on one day (?date=YYYY-MM-DD, default today)"""
+    day = request.args.get('date') or datetime.now().date().isoformat()
+    try:
+        return jsonify(activity.interactions_on(day))
+    except ValueError:
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+
+@app.route('/api/interactions/<interaction_id>', methods=['GET'])
+@auth.login_required
+def api_get_interaction(interaction_id):
+    interaction = activity.get(interaction_id)
+    if interaction:
+        return jsonify(interaction)
+    return jsonify({"error": "Interaction not found"}), 404
+
+# Statistics Routes
+@app.route('/api/stats', methods=['GET'])
+@auth.login_required
+def api_get_stats():
+    customer_id = request.args.get('customer_id', '')
+    per_customer = request.args.get('per_customer', '').lower() in ('1', 'true', 'yes')
+    
+    try:
+        return jsonify(get_stats(customer_id or None, per_customer))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Analytics Routes
+@app.route('/api/analytics/revenue/<dimension>', methods=['GET'])
+@auth.login_required
+def api_analytics_revenue(dimension):
+    if dimension not in analytics.DIMENSIONS:
+        return jsonify({"error": f"Unknown dimension, expected one of: {', '.join(analytics.DIMENSIONS)}"}), 404
+    
+    try:
+        return jsonify(analytics.revenue(dimension))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/analytics/forecast', methods=['GET'])
+@auth.login_required
+def api_analytics_forecast():
+    try:
+        return jsonify(analytics.forecast())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Backup Routes
 @app.route('/api/backup', methods=['POST'])
 @auth.login_required
 def api_backup():
@@ -314,7 +601,120 @@ def api_backup():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/backups', methods=['GET'])
+@auth.login_required
+def api_list_backups():
+    try:
+        return jsonify(backup.list_snapshots())
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/backups/<timestamp>/verify', methods=['POST'])
+@auth.login_required
+def api_verify_backup(timestamp):
+    try:
+        result = backup.verify_snapshot(timestamp)
+        return jsonify(result), 200 if result['ok'] else 409
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/backups/<timestamp>/restore', methods=['POST'])
+@auth.login_required(role='admin')
+def api_restore_backup(timestamp):
+    try:
+        restored = backup.restore_snapshot(timestamp)
+        return jsonify({"message": f"Backup {timestamp} restored successfully", "files": restored})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/restore', methods=['POST'])
+@auth.login_required(role='admin')
+def api_restore_point_in_time():
+    """Rebuild customers, contacts and deals as of a point in time"""
+    data = request.get_json(silent=True) or {}
+    if not data.get('target'):
+        return jsonify({"error": "Field 'target' is required"}), 400
+    
+    try:
+        target = backup.parse_target_time(data['target'])
+        result = backup.restore_to_point_in_time(target)
+        return jsonify({"message": f"Data restored to {result['target']}", **result})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/backups/prune', methods=['POST'])
+@auth.login_required(role='admin')
+def api_prune_backups():
+    data = request.get_json(silent=True) or {}
+    try:
+        # Zero for both would delete every snapshot
+        keep_last = _positive_option(data, 'keep_last', integer=True)
+        keep_daily = _positive_option(data, 'keep_daily', integer=True)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        result = backup.prune_snapshots(
+            keep_last=backup.KEEP_LAST if keep_last is None else keep_last,
+            keep_daily=backup.KEEP_DAILY if keep_daily is None else keep_daily
+        )
+        return jsonify(result)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Live update stream
+# Streams are closed after this many seconds so a thread is never held
+# indefinitely; EventSource reconnects and resumes from Last-Event-ID.
+STREAM_MAX_SECONDS = int(os.environ.get('CRM_STREAM_MAX_SECONDS', 300))
+# A stream holds a request thread for as long as it is open, so each worker
+# serves at most this many at once and refuses the rest, keeping the other
+# threads (gunicorn.conf.py) free for ordinary requests
+MAX_STREAMS = int(os.environ.get('CRM_MAX_STREAMS', '4'))
+STREAM_RETRY_SECONDS = 30
+_stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+@app.route('/api/stream', methods=['GET'])
+@auth.login_required
+def api_stream():
+    """Push customer/contact/deal change events as Server-Sent Events"""
+    # On a worker serving one request at a time a stream would block every other request
+    if not request.environ.get('wsgi.multithread'):
+        return (jsonify({"error": "Live updates need a threaded server"}), 503,
+                {'Retry-After': str(STREAM_RETRY_SECONDS)})
+    if not _stream_slots.acquire(blocking=False):
+        return (jsonify({"error": "Too many live update streams open; try again later"}), 503,
+                {'Retry-After': str(STREAM_RETRY_SECONDS)})
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('since', '')
+    offset = int(last_event_id) if last_event_id.isdigit() else events.current_offset()
+    
+    def generate():
+        yield 'retry: 3000\n\n'
+        for event_id, event in events.follow(offset, max_seconds=STREAM_MAX_SECONDS):
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield f"id: {event_id}\nevent: change\ndata: {json.dumps(event)}\n\n"
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # Called once the stream ends, however it ends
+    response.call_on_close(_stream_slots.release)
+    return response
+
 # Genesys Cloud Integration Routes
+def _genesys_response(result):
+    """Respond with a Genesys result, or 503 with Retry-After while its circuit breaker is open"""
+    if isinstance(result, dict) and 'retry_after' in result:
+        return jsonify(result), 503, {'Retry-After': str(result['retry_after'])}
+    return jsonify(result)
+
 @app.route('/api/genesys/status', methods=['GET'])
 @auth.login_required
 def api_genesys_status():
@@ -339,7 +739,7 @@ def api_genesys_users():
     
     try:
         result = genesys.get_users(limit=limit, page_number=page)
-        return jsonify(result)
+        return _genesys_response(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -354,7 +754,7 @@ def api_genesys_user(user_id):
     
     try:
         result = genesys.get_user(user_id)
-        return jsonify(result)
+        return _genesys_response(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -371,7 +771,7 @@ def api_genesys_contacts():
     
     try:
         result = genesys.get_contacts(limit=limit, page_number=page)
-        return jsonify(result)
+        return _genesys_response(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -386,7 +786,7 @@ def api_genesys_contact(contact_id):
     
     try:
         result = genesys.get_contact(contact_id)
-        return jsonify(result)
+        return _genesys_response(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -422,7 +822,7 @@ def api_genesys_interactions():
     
     try:
         result = genesys.get_interactions(limit=limit, page_number=page)
-        return jsonify(result)
+        return _genesys_response(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -437,7 +837,7 @@ def api_genesys_interaction(interaction_id):
     
     try:
         result = genesys.get_interaction(interaction_id)
-        return jsonify(result)
+        return _genesys_response(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -454,10 +854,16 @@ def api_genesys_queues():
     
     try:
         result = genesys.get_queues(limit=limit, page_number=page)
-        return jsonify(result)
+        return _genesys_response(result)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/genesys/cache', methods=['GET'])
+@auth.login_required
+def api_genesys_cache_stats():
+    """Get hit/miss counters for the Genesys caches and the state of its circuit breaker"""
+    return jsonify(GenesysCloudIntegration.cache_stats())
+
 # Sync contacts between CRM and Genesys
 @app.route('/api/genesys/sync/contacts', methods=['POST'])
 @auth.login_required
@@ -588,16 +994,21 @@ def api_genesys_import_all_contacts():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-# Create/update interaction record in CRM based on Genesys interaction
+# Record a Genesys interaction in the CRM's activity store
 @app.route('/api/genesys/interactions/<interaction_id>/record', methods=['POST'])
 @auth.login_required
 def api_genesys_record_interaction(interaction_id):
-    """Record a Genesys interaction in the CRM as a deal or note"""
+    """Record a Genesys interaction in the customer's activity timeline"""
     genesys = GenesysCloudIntegration()
     
     if not genesys.is_configured():
         return jsonify({"error": "Genesys Cloud integration not configured"}), 400
     
+    data = request.json or {}
+    customer_id = data.get('customer_id')
+    if customer_id and not get_customer(customer_id):
+        return jsonify({"error": "Customer not found"}), 404
+    
     try:
         # Get interaction details from Genesys
         interaction = genesys.get_interaction(interaction_id)
@@ -605,21 +1016,20 @@ def api_genesys_record_interaction(interaction_id):
         if 'error' in interaction:
             return jsonify({"error": f"Failed to retrieve interaction: {interaction['error']}"}), 400
         
-        # Get customer info if available
-        customer_id = request.json.get('customer_id')
-        
-        # Create a deal record from this interaction
-        deal_data = {
-            "title": f"Interaction {interaction_id}",
-            "description": f"Call recorded on {datetime.now().strftime('%Y-%m-%d %H:%M')}",
-            "status": "New",
-            "value": 0,
-            "customer_id": customer_id,
-            "genesys_interaction_id": interaction_id
-        }
-        
-        new_deal = create_deal(deal_data)
-        return jsonify({"message": "Interaction recorded as deal", "deal": new_deal}), 201
+        # Fields given in the request override what Genesys reports
+        row, created = activity.record(
+            interaction_id,
+            customer_id=customer_id,
+            started_at=data.get('started_at', interaction.get('conversationStart')),
+            ended_at=data.get('ended_at', interaction.get('conversationEnd')),
+            direction=data.get('direction', interaction.get('originatingDirection')),
+            duration=data.get('duration')
+        )
+        if not created:
+            return jsonify({"message": "Interaction already recorded", "interaction": row})
+        return jsonify({"message": "Interaction recorded", "interaction": row}), 201
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -737,17 +1147,108 @@ def api_genesys_quick_add_customer():
             return jsonify({"error": f"Field '{field}' is required"}), 400
     
     try:
-        # Create the customer in the CRM
-        new_customer = create_customer(data)
+        # Create the customer in the CRM, unless it's already there
+        new_customer = create_customer(data, check_duplicates=not _allow_duplicate())
         
         # Return success response with the new customer data
         return jsonify({
             "message": "Customer created successfully",
             "customer": new_customer
         }), 201
+    except DuplicateCustomerError as e:
+        return _duplicate_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Monitoring
+@app.route('/metrics', methods=['GET'])
+@auth.login_required
+def prometheus_metrics():
+    """Expose request, data store and Genesys metrics for Prometheus"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+# Webhooks (admin only)
+@app.route('/api/admin/webhooks', methods=['GET'])
+@auth.login_required(role='admin')
+def api_get_webhooks():
+    """List webhook subscriptions with their delivery progress"""
+    return jsonify(webhooks.status())
+
+@app.route('/api/admin/webhooks', methods=['POST'])
+@auth.login_required(role='admin')
+def api_create_webhook():
+    """Subscribe a URL to record changes"""
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({"error": "Invalid data"}), 400
+    
+    try:
+        return jsonify(webhooks.create_subscription(data)), 201
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/api/admin/webhooks/<subscription_id>', methods=['DELETE'])
+@auth.login_required(role='admin')
+def api_delete_webhook(subscription_id):
+    if webhooks.delete_subscription(subscription_id):
+        return jsonify({"message": "Webhook deleted successfully"})
+    return jsonify({"error": "Webhook not found"}), 404
+
+# Profiling (admin only)
+def _positive_option(data, name, integer=False):
+    """A positive number from a JSON body, or None if it wasn't given"""
+    value = data.get(name)
+    if value is None:
+        return None
+    number = None
+    # JSON true/false and 2.5 would otherwise pass as 1/0 and 2
+    if not isinstance(value, bool) and not (integer and isinstance(value, float)):
+        try:
+            number = int(value) if integer else float(value)
+        except (TypeError, ValueError):
+            pass
+    if number is None or not 0 < number < math.inf:
+        raise ValueError(f"{name} must be a positive {'integer' if integer else 'number'}")
+    return number
+
+@app.route('/api/admin/profile/<kind>', methods=['POST'])
+@auth.login_required(role='admin')
+def api_start_profile(kind):
+    """Start a CPU or memory profile for a time window or the next N requests"""
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        options = {}
+        if kind == 'cpu' and data.get('interval_ms') is not None:
+            options['interval'] = _positive_option(data, 'interval_ms') / 1000
+        if kind == 'memory' and data.get('top') is not None:
+            options['top'] = _positive_option(data, 'top', integer=True)
+        status = profiler.start(kind, seconds=_positive_option(data, 'seconds'),
+                                requests=_positive_option(data, 'requests', integer=True), **options)
+        return jsonify(status), 202
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@app.route('/api/admin/profile/<kind>', methods=['GET'])
+@auth.login_required(role='admin')
+def api_profile_status(kind):
+    """Get profiling progress, or the last result (?format=collapsed for flame graphs)"""
+    result = profiler.status(kind)
+    if result is None:
+        return jsonify({"error": f"No {kind} profile has been run"}), 404
+    if request.args.get('format') == 'collapsed' and 'collapsed' in result:
+        return Response(result['collapsed'] + '\n', mimetype='text/plain')
+    return jsonify(result)
+
+@app.route('/api/admin/profile/<kind>', methods=['DELETE'])
+@auth.login_required(role='admin')
+def api_stop_profile(kind):
+    """Stop a running profile early and return its result"""
+    try:
+        return jsonify(profiler.stop(kind))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 404
+
 # Error handlers
 @app.errorhandler(404)
 def page_not_found(e):
@@ -4,11 +4,11 @@ import uuid
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
-# Ensure data directory exists
-os.makedirs('data', exist_ok=True)
-
 USERS_FILE = 'data/users.json'
 
+# Usernames granted the admin role, e.g. CRM_ADMIN_USERS="alice,bob"
+ADMIN_USERS = {name.strip() for name in os.environ.get('CRM_ADMIN_USERS', '').split(',') if name.strip()}
+
 def load_users():
     """Load users from JSON file."""
     if not os.path.exists(USERS_FILE):
@@ -61,3 +61,11 @@ def authenticate_user(username, password):
     if user and check_password_hash(user.get('password'), password):
         return True
     return False
+
+def get_user_roles(username):
+    """Get the roles granted to a user."""
+    user = get_user_by_username(username)
+    roles = list(user.get('roles', [])) if user else []
+    if username in ADMIN_USERS and 'admin' not in roles:
+        roles.append('admin')
+    return roles
@@ -0,0 +1,579 @@
+import json
+import os
+import time
+import shutil
+import zlib
+import hashlib
+import argparse
+from datetime import datetime, timedelta
+import events
+import store
+import webhooks
+
+# Backup layout:
+#   data/backup/chunks/ab/abcdef...      zlib-compressed chunk, named by SHA-256
+#   data/backup/<timestamp>/manifest.json  file -> ordered chunk list
+# Older backups made by plain file copies have no manifest and are still
+# listed, verified and restored as "legacy" snapshots.
+DATA_DIR = 'data'
+BACKUP_DIR = 'data/backup'
+CHUNKS_DIR = 'data/backup/chunks'
+DATA_FILES = ['customers.json', 'contacts.json', 'deals.json', 'users.json']
+
+# Collections rebuilt by replaying the change log (users are not logged)
+EVENT_FILES = {
+    'customer': 'customers.json',
+    'contact': 'contacts.json',
+    'deal': 'deals.json'
+}
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Chunks are cut on line boundaries chosen by a hash of the line itself, so
+# inserting or deleting a record only changes the chunks around it instead of
+# shifting every later chunk like fixed-size chunking would.
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+BOUNDARY_MASK = 0x3FF  # about one boundary per 1024 lines
+
+COMPRESSION_LEVEL = 6
+
+# Chunks touched more recently than this may belong to a snapshot whose
+# manifest has not been written yet, so garbage collection leaves them alone
+GC_GRACE_SECONDS = 3600
+
+# Default retention policy applied after every backup
+KEEP_LAST = int(os.environ.get('BACKUP_KEEP_LAST', 24))
+KEEP_DAILY = int(os.environ.get('BACKUP_KEEP_DAILY', 30))
+
+def _file_lines(file_path):
+    """Read a file as lines of at most MAX_CHUNK_SIZE bytes."""
+    with open(file_path, 'rb') as f:
+        yield from iter(lambda: f.readline(MAX_CHUNK_SIZE), b'')
+
+def _stream_lines(pieces):
+    """Split a stream of bytes into lines exactly as _file_lines splits a file."""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        start = 0
+        while True:
+            end = buffer.find(b'\n', start, start + MAX_CHUNK_SIZE)
+            if end != -1:
+                end += 1
+            elif len(buffer) - start >= MAX_CHUNK_SIZE:
+                end = start + MAX_CHUNK_SIZE
+            else:
+                break
+            yield bytes(buffer[start:end])
+            start = end
+        del buffer[:start]
+    if buffer:
+        yield bytes(buffer)
+
+def _iter_chunks(lines):
+    """Split a file, given as lines, into content-defined chunks."""
+    chunk = bytearray()
+    for line in lines:
+        chunk += line
+        if len(chunk) >= MAX_CHUNK_SIZE or (
+                len(chunk) >= MIN_CHUNK_SIZE and zlib.crc32(line) & BOUNDARY_MASK == 0):
+            yield bytes(chunk)
+            chunk = bytearray()
+    if chunk:
+        yield bytes(chunk)
+
+def _chunk_path(digest):
+    return os.path.join(CHUNKS_DIR, digest[:2], digest)
+
+def _store_chunk(digest, data):
+    """Write a chunk to the store unless it is already there.
+
+    Returns:
+        int: Compressed bytes written (0 for a deduplicated chunk)
+    """
+    path = _chunk_path(digest)
+    if os.path.exists(path):
+        # Refresh the mtime so a concurrent prune treats the chunk as in use
+        os.utime(path)
+        return 0
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    compressed = zlib.compress(data, COMPRESSION_LEVEL)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(compressed)
+    os.replace(tmp_path, path)
+    return len(compressed)
+
+def _load_chunk(digest):
+    """Read and check a chunk from the store."""
+    with open(_chunk_path(digest), 'rb') as f:
+        data = zlib.decompress(f.read())
+    if hashlib.sha256(data).hexdigest() != digest:
+        raise ValueError(f"Chunk {digest} is corrupt")
+    return data
+
+def _snapshot_dir(timestamp):
+    # Timestamps become directory names; refuse anything that could escape
+    if not timestamp or os.path.basename(timestamp) != timestamp or timestamp in ('.', '..', 'chunks'):
+        raise ValueError(f"Invalid backup timestamp: {timestamp}")
+    return os.path.join(BACKUP_DIR, timestamp)
+
+def load_manifest(timestamp):
+    """Load a snapshot manifest, or None for a legacy full-copy backup."""
+    snapshot_dir = _snapshot_dir(timestamp)
+    if not os.path.isdir(snapshot_dir):
+        raise ValueError(f"Backup {timestamp} not found")
+
+    manifest_path = os.path.join(snapshot_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+def create_snapshot(timestamp, sources=None, events_offset=None):
+    """Create an incremental, deduplicated snapshot of all data files.
+
+    Only chunks that are not already in the chunk store are written, so a
+    snapshot of a mostly unchanged dataset costs little more than its
+    manifest.
+
+    Args:
+        timestamp (str): Snapshot name
+        sources (dict): Optional file name -> iterable of the bytes to back
+            up for that file instead of reading it, such as a consistent
+            snapshot of the collections taken by data_manager
+        events_offset (int): Change log offset that sources reflect every
+            event before; required with sources
+
+    Returns:
+        dict: Snapshot summary with chunk and byte counts
+    """
+    snapshot_dir = _snapshot_dir(timestamp)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    sources = sources or {}
+
+    # Taken before reading any file: every event before this offset is
+    # already in the files, and replaying later ones is idempotent
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'timestamp': timestamp,
+        'created_at': datetime.now().isoformat(),
+        'events_offset': events.current_offset() if events_offset is None else events_offset,
+        'files': {}
+    }
+    new_chunks = reused_chunks = bytes_written = total_size = 0
+
+    for file_name in DATA_FILES:
+        source_path = os.path.join(DATA_DIR, file_name)
+        if file_name in sources:
+            lines = _stream_lines(sources[file_name])
+        elif os.path.exists(source_path):
+            lines = _file_lines(source_path)
+        elif store.stored_files(source_path):
+            # Stored in shards: back up the single file they make up
+            lines = _stream_lines(store.read_json(source_path))
+        else:
+            continue
+
+        file_hash = hashlib.sha256()
+        chunks = []
+        size = 0
+        for data in _iter_chunks(lines):
+            digest = hashlib.sha256(data).hexdigest()
+            written = _store_chunk(digest, data)
+            if written:
+                new_chunks += 1
+                bytes_written += written
+            else:
+                reused_chunks += 1
+            file_hash.update(data)
+            chunks.append(digest)
+            size += len(data)
+
+        manifest['files'][file_name] = {
+            'size': size,
+            'sha256': file_hash.hexdigest(),
+            'chunks': chunks
+        }
+        total_size += size
+
+    # The manifest is written last so a half-finished snapshot is never listed
+    tmp_path = os.path.join(snapshot_dir, f'{MANIFEST_NAME}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(snapshot_dir, MANIFEST_NAME))
+
+    return {
+        'timestamp': timestamp,
+        'files': len(manifest['files']),
+        'total_size': total_size,
+        'new_chunks': new_chunks,
+        'reused_chunks': reused_chunks,
+        'bytes_written': bytes_written
+    }
+
+def list_snapshots():
+    """List all backups, oldest first."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+
+    snapshots = []
+    for name in sorted(os.listdir(BACKUP_DIR)):
+        path = os.path.join(BACKUP_DIR, name)
+        if name == 'chunks' or not os.path.isdir(path):
+            continue
+        if os.path.exists(os.path.join(path, MANIFEST_NAME)):
+            with open(os.path.join(path, MANIFEST_NAME), 'r') as f:
+                manifest = json.load(f)
+            snapshots.append({
+                'timestamp': name,
+                'legacy': False,
+                'created_at': manifest.get('created_at'),
+                'replayable': 'events_offset' in manifest,
+                'files': sorted(manifest['files']),
+                'total_size': sum(entry['size'] for entry in manifest['files'].values())
+            })
+        else:
+            files = sorted(f for f in os.listdir(path) if f in DATA_FILES)
+            if not files:
+                # Either an unfinished snapshot or not a backup at all
+                continue
+            snapshots.append({
+                'timestamp': name,
+                'legacy': True,
+                'created_at': None,
+                'replayable': False,
+                'files': files,
+                'total_size': sum(os.path.getsize(os.path.join(path, f)) for f in files)
+            })
+    return snapshots
+
+def verify_snapshot(timestamp):
+    """Check that every file in a snapshot can be rebuilt intact.
+
+    Returns:
+        dict: {'ok': bool, 'errors': [...]} for the snapshot
+    """
+    manifest = load_manifest(timestamp)
+    errors = []
+
+    if manifest is None:
+        snapshot_dir = _snapshot_dir(timestamp)
+        for file_name in DATA_FILES:
+            path = os.path.join(snapshot_dir, file_name)
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r') as f:
+                    json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                errors.append(f"{file_name}: {str(e)}")
+        return {'timestamp': timestamp, 'ok': not errors, 'errors': errors}
+
+    for file_name, entry in manifest['files'].items():
+        file_hash = hashlib.sha256()
+        size = 0
+        try:
+            for digest in entry['chunks']:
+                data = _load_chunk(digest)
+                file_hash.update(data)
+                size += len(data)
+        except (OSError, zlib.error, ValueError) as e:
+            errors.append(f"{file_name}: {str(e)}")
+            continue
+        if size != entry['size'] or file_hash.hexdigest() != entry['sha256']:
+            errors.append(f"{file_name}: content does not match manifest")
+
+    return {'timestamp': timestamp, 'ok': not errors, 'errors': errors}
+
+def _mark_restored(restored_to):
+    """Record a restore of the live data directory.
+
+    Publishes a restore event so open browsers reload, then takes a fresh
+    snapshot so later point-in-time restores never replay the history the
+    restore discarded.
+    """
+    events.publish('dataset', 'restore', {'id': None, 'restored_to': restored_to})
+    create_snapshot(datetime.now().strftime('%Y%m%d_%H%M%S'))
+
+def restore_snapshot(timestamp, target_dir=DATA_DIR):
+    """Restore the data files from a snapshot.
+
+    Each file is rebuilt next to its destination and moved into place with an
+    atomic rename, so readers see either the old file or the restored one.
+
+    Returns:
+        list: Names of the restored files
+    """
+    manifest = load_manifest(timestamp)
+    snapshot_dir = _snapshot_dir(timestamp)
+    os.makedirs(target_dir, exist_ok=True)
+    restored = []
+
+    if manifest is None:
+        for file_name in DATA_FILES:
+            source_path = os.path.join(snapshot_dir, file_name)
+            if not os.path.exists(source_path):
+                continue
+            tmp_path = os.path.join(target_dir, f'.{file_name}.restore')
+            shutil.copy2(source_path, tmp_path)
+            os.replace(tmp_path, os.path.join(target_dir, file_name))
+            restored.append(file_name)
+        if target_dir == DATA_DIR:
+            _mark_restored(timestamp)
+        return restored
+
+    # Rebuild and check every file before touching any live data
+    staged = []
+    try:
+        for file_name, entry in manifest['files'].items():
+            tmp_path = os.path.join(target_dir, f'.{file_name}.restore')
+            file_hash = hashlib.sha256()
+            with open(tmp_path, 'wb') as f:
+                staged.append((tmp_path, file_name))
+                for digest in entry['chunks']:
+                    data = _load_chunk(digest)
+                    file_hash.update(data)
+                    f.write(data)
+            if file_hash.hexdigest() != entry['sha256']:
+                raise ValueError(f"Restored {file_name} does not match manifest")
+    except Exception:
+        for tmp_path, _ in staged:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        raise
+
+    for tmp_path, file_name in staged:
+        os.replace(tmp_path, os.path.join(target_dir, file_name))
+        restored.append(file_name)
+    if target_dir == DATA_DIR:
+        _mark_restored(timestamp)
+    return restored
+
+def _parse_timestamp(timestamp):
+    try:
+        return datetime.strptime(timestamp, '%Y%m%d_%H%M%S')
+    except ValueError:
+        return None
+
+def _local_time(moment):
+    """Convert a time with a time zone to naive local time, like the stored timestamps."""
+    if moment.tzinfo is not None:
+        return moment.astimezone().replace(tzinfo=None)
+    return moment
+
+def parse_target_time(value):
+    """Parse a restore target given as ISO 8601 or a backup timestamp.
+
+    A target with a time zone (e.g. ending in Z or +00:00) is converted to
+    local time, which snapshot and event times are recorded in.
+    """
+    target = _parse_timestamp(value)
+    if target is None:
+        try:
+            target = datetime.fromisoformat(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid restore target: {value}")
+    return _local_time(target)
+
+def _replay(records_by_entity, since_offset, target):
+    """Apply logged mutations made at or before target to loaded collections.
+
+    Returns:
+        int: Number of events applied
+    """
+    applied = 0
+    for _, event in events.read_events(since_offset):
+        entity = event.get('entity')
+        if entity not in records_by_entity or datetime.fromisoformat(event['ts']) > target:
+            continue
+        records = records_by_entity[entity]
+        if event['action'] == 'delete':
+            records.pop(event['id'], None)
+        else:
+            records[event['id']] = event['record']
+        applied += 1
+    return applied
+
+def restore_to_point_in_time(target, target_dir=DATA_DIR):
+    """Rebuild customers, contacts and deals as they were at a point in time.
+
+    Loads the newest snapshot taken at or before target into a staging
+    directory, replays the change log up to target, and only then swaps each
+    rebuilt file into place with an atomic rename. Live readers keep seeing
+    the current data until the swap. Users are left untouched.
+
+    Returns:
+        dict: The base snapshot, events applied and files restored
+    """
+    target = _local_time(target)
+    candidates = [
+        s for s in list_snapshots()
+        if s['replayable'] and datetime.fromisoformat(s['created_at']) <= target
+    ]
+    if not candidates:
+        raise ValueError(f"No backup taken at or before {target.isoformat()}")
+    base = max(candidates, key=lambda s: s['created_at'])
+    manifest = load_manifest(base['timestamp'])
+    if manifest['events_offset'] < events.first_offset():
+        raise ValueError(f"The changes since backup {base['timestamp']} are no longer in the change log")
+
+    staging_dir = os.path.join(target_dir, f'.restore-{os.getpid()}')
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    try:
+        restore_snapshot(base['timestamp'], target_dir=staging_dir)
+
+        records_by_entity = {}
+        for entity, file_name in EVENT_FILES.items():
+            path = os.path.join(staging_dir, file_name)
+            records = []
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    records = json.load(f)
+            records_by_entity[entity] = {record.get('id'): record for record in records}
+
+        applied = _replay(records_by_entity, manifest['events_offset'], target)
+
+        for entity, file_name in EVENT_FILES.items():
+            with open(os.path.join(staging_dir, file_name), 'w') as f:
+                json.dump(list(records_by_entity[entity].values()), f, indent=2)
+
+        restored = []
+        for file_name in EVENT_FILES.values():
+            os.replace(os.path.join(staging_dir, file_name), os.path.join(target_dir, file_name))
+            restored.append(file_name)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    if target_dir == DATA_DIR:
+        _mark_restored(target.isoformat())
+
+    return {
+        'target': target.isoformat(),
+        'base_snapshot': base['timestamp'],
+        'events_applied': applied,
+        'files': restored
+    }
+
+def prune_snapshots(keep_last=KEEP_LAST, keep_daily=KEEP_DAILY):
+    """Apply the retention policy and delete chunks no snapshot still uses.
+
+    Keeps the newest keep_last snapshots plus the newest snapshot of each of
+    the last keep_daily days. Snapshots whose name is not a backup timestamp
+    are never pruned.
+
+    Returns:
+        dict: Removed snapshots and chunk counts
+    """
+    snapshots = list_snapshots()
+    dated = [(s['timestamp'], _parse_timestamp(s['timestamp'])) for s in snapshots]
+    dated = sorted(((name, when) for name, when in dated if when), key=lambda item: item[1], reverse=True)
+
+    keep = {name for name, _ in dated[:keep_last]}
+    if dated and keep_daily > 0:
+        cutoff = (dated[0][1] - timedelta(days=keep_daily - 1)).date()
+        seen_days = set()
+        for name, when in dated:
+            if when.date() >= cutoff and when.date() not in seen_days:
+                seen_days.add(when.date())
+                keep.add(name)
+
+    removed = []
+    for name, _ in dated:
+        if name not in keep:
+            shutil.rmtree(_snapshot_dir(name))
+            removed.append(name)
+
+    removed_chunks = collect_garbage()
+    compacted = compact_event_log()
+    return {'removed_snapshots': removed, 'removed_chunks': removed_chunks, 'compacted_event_bytes': compacted}
+
+def compact_event_log():
+    """Drop the change log events that nothing can read any more.
+
+    The log is kept from the oldest of: the offset of the oldest replayable
+    snapshot (a point-in-time restore replays from there), the offset each
+    mapped file was built at (workers replay from there), and each webhook
+    subscription's delivery cursor. Without a replayable snapshot it is left
+    alone.
+
+    Returns:
+        int: Bytes of events dropped
+    """
+    offsets = []
+    for snapshot in list_snapshots():
+        if snapshot['replayable']:
+            offsets.append(load_manifest(snapshot['timestamp'])['events_offset'])
+    if not offsets:
+        return 0
+    offsets.extend(store.mapped_offsets().values())
+    cursor = webhooks.oldest_cursor()
+    if cursor is not None:
+        offsets.append(cursor)
+    return events.truncate(min(min(offsets), events.current_offset()))
+
+def collect_garbage():
+    """Delete chunks that are not referenced by any snapshot manifest.
+
+    Returns:
+        int: Number of chunks deleted
+    """
+    referenced = set()
+    for snapshot in list_snapshots():
+        manifest = load_manifest(snapshot['timestamp'])
+        if manifest:
+            for entry in manifest['files'].values():
+                referenced.update(entry['chunks'])
+
+    removed = 0
+    if not os.path.isdir(CHUNKS_DIR):
+        return removed
+    cutoff = time.time() - GC_GRACE_SECONDS
+    for prefix in os.listdir(CHUNKS_DIR):
+        prefix_dir = os.path.join(CHUNKS_DIR, prefix)
+        for digest in os.listdir(prefix_dir):
+            path = os.path.join(prefix_dir, digest)
+            if digest in referenced or os.path.getmtime(path) > cutoff:
+                continue
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage CRM data backups")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('create', help="Take a snapshot now")
+    commands.add_parser('list', help="List snapshots")
+    verify_parser = commands.add_parser('verify', help="Verify a snapshot")
+    verify_parser.add_argument('timestamp')
+    restore_parser = commands.add_parser('restore', help="Restore a snapshot, or any point in time with --at")
+    restore_parser.add_argument('timestamp', nargs='?')
+    restore_parser.add_argument('--at', help="ISO 8601 time to rebuild the data as of")
+    prune_parser = commands.add_parser('prune', help="Apply the retention policy")
+    prune_parser.add_argument('--keep-last', type=int, default=KEEP_LAST)
+    prune_parser.add_argument('--keep-daily', type=int, default=KEEP_DAILY)
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'create':
+            result = create_snapshot(datetime.now().strftime('%Y%m%d_%H%M%S'))
+        elif args.command == 'list':
+            result = list_snapshots()
+        elif args.command == 'verify':
+            result = verify_snapshot(args.timestamp)
+        elif args.command == 'restore':
+            if args.at:
+                result = restore_to_point_in_time(parse_target_time(args.at))
+            elif args.timestamp:
+                result = restore_snapshot(args.timestamp)
+            else:
+                parser.error("restore needs a snapshot timestamp or --at")
+        else:
+            result = prune_snapshots(keep_last=args.keep_last, keep_daily=args.keep_daily)
+    except ValueError as e:
+        parser.exit(1, f"error: {str(e)}\n")
+    print(json.dumps(result, indent=2))
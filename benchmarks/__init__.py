@@ -0,0 +1,8 @@
+"""Reproducible benchmarks for the CRM data layer and HTTP API.
+
+Run from the repository root, e.g.::
+
+    python -m benchmarks.generate --scale 100k --out /tmp/crm-100k
+    python -m benchmarks.bench_data_manager --scale 1k
+    python -m benchmarks.load_test --scale 1k --duration 30
+"""
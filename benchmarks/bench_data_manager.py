@@ -0,0 +1,84 @@
+import os
+import sys
+import random
+import argparse
+
+from benchmarks.common import prepare_workspace, measure, metadata, report, add_common_arguments
+from benchmarks.generate import scale_to_count, generate_customer, generate_contact, generate_deal
+
+def run(scale, seed, repeat):
+    """Micro-benchmark every data_manager function against a generated dataset."""
+    workspace, counts = prepare_workspace(scale_to_count(scale), seed)
+    os.chdir(workspace)
+    import data_manager as dm
+
+    rng = random.Random(seed)
+    customers = dm.get_all_customers()
+    contacts = dm.get_all_contacts()
+    deals = dm.get_all_deals()
+    customer_ids = [c['id'] for c in customers]
+    sample_customer = rng.choice(customers)
+    digits = ''.join(filter(str.isdigit, sample_customer['phone']))
+
+    def new_customer(_=None):
+        return generate_customer(rng)
+
+    def new_contact(_=None):
+        return generate_contact(rng, rng.choice(customer_ids))
+
+    def new_deal(_=None):
+        return generate_deal(rng, rng.choice(customer_ids))
+
+    benchmarks = {
+        # Reads
+        'get_all_customers': lambda: dm.get_all_customers(),
+        'get_all_contacts': lambda: dm.get_all_contacts(),
+        'get_all_deals': lambda: dm.get_all_deals(),
+        'get_customer': lambda: dm.get_customer(rng.choice(customer_ids)),
+        'get_contact': lambda: dm.get_contact(rng.choice(contacts)['id']),
+        'get_deal': lambda: dm.get_deal(rng.choice(deals)['id']),
+        'get_customer_missing': lambda: dm.get_customer('00000000-0000-4000-8000-000000000000'),
+        'search_customers': lambda: dm.search_customers('acme'),
+        'search_contacts': lambda: dm.search_contacts('garcia'),
+        'search_deals': lambda: dm.search_deals('renewal'),
+        'search_customers_miss': lambda: dm.search_customers('no-such-customer'),
+        'find_customer_by_phone_exact': lambda: dm.find_customer_by_phone(sample_customer['phone']),
+        'find_customer_by_phone_suffix': lambda: dm.find_customer_by_phone('0' + digits[-10:]),
+        'find_customer_by_phone_miss': lambda: dm.find_customer_by_phone('+44 0000 000000'),
+    }
+
+    results = {name: measure(func, repeat) for name, func in benchmarks.items()}
+
+    # Writes: setup runs untimed so each timed call sees a fresh record
+    results['create_customer'] = measure(lambda data: dm.create_customer(data), repeat, setup=new_customer)
+    results['create_contact'] = measure(lambda data: dm.create_contact(data), repeat, setup=new_contact)
+    results['create_deal'] = measure(lambda data: dm.create_deal(data), repeat, setup=new_deal)
+    results['update_customer'] = measure(
+        lambda data: dm.update_customer(rng.choice(customer_ids), data), repeat, setup=new_customer)
+    results['update_contact'] = measure(
+        lambda data: dm.update_contact(rng.choice(contacts)['id'], data), repeat, setup=new_contact)
+    results['update_deal'] = measure(
+        lambda data: dm.update_deal(rng.choice(deals)['id'], data), repeat, setup=new_deal)
+    results['delete_contact'] = measure(
+        lambda contact: dm.delete_contact(contact['id']), repeat, setup=lambda: dm.create_contact(new_contact()))
+    results['delete_deal'] = measure(
+        lambda deal: dm.delete_deal(deal['id']), repeat, setup=lambda: dm.create_deal(new_deal()))
+    results['delete_customer'] = measure(
+        lambda customer: dm.delete_customer(customer['id']), repeat, setup=lambda: dm.create_customer(new_customer()))
+    results['backup_data'] = measure(
+        lambda timestamp: dm.backup_data(timestamp), min(repeat, 3),
+        setup=lambda: f"bench_{rng.getrandbits(32):08x}")
+
+    return {'meta': metadata('data_manager', scale, seed, counts), 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark data_manager")
+    # Best-of-N is far less noisy than the median for sub-millisecond calls
+    add_common_arguments(parser, metric='min')
+    parser.add_argument('--repeat', type=int, default=10, help="Timed runs per benchmark")
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    sys.exit(report(run(args.scale, args.seed, args.repeat), args))
@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.common import prepare_workspace, summarize, metadata, report, add_common_arguments
+from benchmarks.generate import scale_to_count
+from benchmarks.load_test import USERNAME, PASSWORD, _free_port, server_kind, start_server
+
+# start_server's threaded flag for each mode: sync serves one request at a
+# time per worker, so CRM requests queue behind slow Genesys calls
+MODES = {'sync': False, 'threaded': True}
+
+class _SlowGenesys(BaseHTTPRequestHandler):
+    """Stands in for Genesys Cloud: tokens come back at once, API calls after a delay"""
+
+    delay = 1.0
+
+    def _reply(self, body):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self._reply({'access_token': 'bench', 'expires_in': 3600})
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self._reply({'id': self.path.rsplit('/', 2)[-2], 'participants': []})
+
+    def log_message(self, *args):
+        pass
+
+def _client(port, deadline, paths, results):
+    """Request paths() in turn until the deadline, appending (latency, status) to results."""
+    headers = {'Authorization': 'Basic ' + base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()}
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            connection.request('GET', paths(), headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            status = 0
+        results.append((time.perf_counter() - started, status))
+    connection.close()
+
+def _round(port, duration, genesys_clients, crm_clients, customer_ids, seed):
+    """Run Genesys and CRM clients side by side for duration seconds."""
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def interaction():
+        # A fresh id each time, so the live cache never answers for Genesys
+        with lock:
+            return f'/api/genesys/interactions/{rng.getrandbits(64):016x}'
+
+    def customer():
+        with lock:
+            return f'/api/customers/{rng.choice(customer_ids)}'
+
+    genesys, crm = [], []
+    deadline = time.monotonic() + duration
+    threads = [threading.Thread(target=_client, args=(port, deadline, interaction, genesys))
+               for _ in range(genesys_clients)]
+    threads += [threading.Thread(target=_client, args=(port, deadline, customer, crm))
+                for _ in range(crm_clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started, genesys, crm
+
+def run(scale, seed, duration, delay, genesys_clients, crm_clients, workers, modes):
+    """Measure CRM latency while Genesys Cloud calls are slow, per serving mode."""
+    workspace, counts = prepare_workspace(scale_to_count(scale), seed)
+    os.chdir(workspace)
+    from auth import register_user
+    from data_manager import get_all_customers
+    register_user(USERNAME, PASSWORD)
+    customer_ids = [customer['id'] for customer in get_all_customers()]
+
+    _SlowGenesys.delay = delay
+    stub = ThreadingHTTPServer(('127.0.0.1', 0), _SlowGenesys)
+    stub.daemon_threads = True
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    env = {
+        'GENESYS_CLIENT_ID': 'bench',
+        'GENESYS_CLIENT_SECRET': 'bench',
+        'GENESYS_BASE_URL': f'http://127.0.0.1:{stub.server_address[1]}'
+    }
+
+    results = {}
+    try:
+        for mode in modes:
+            port = _free_port()
+            server = start_server(workspace, port, workers, threaded=MODES[mode], env=env)
+            try:
+                elapsed, genesys, crm = _round(port, duration, genesys_clients, crm_clients, customer_ids, seed)
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+
+            for name, observations in (('crm', crm), ('genesys', genesys)):
+                if not observations:
+                    continue
+                summary = summarize([latency for latency, _ in observations])
+                summary['throughput_rps'] = sum(1 for _, status in observations if status == 200) / elapsed
+                summary['refused'] = sum(1 for _, status in observations if status == 503)
+                summary['errors'] = sum(1 for _, status in observations if status not in (200, 503))
+                results[f'{mode}_{name}'] = summary
+    finally:
+        stub.shutdown()
+
+    meta = metadata('genesys', scale, seed, counts)
+    meta.update({'duration': duration, 'genesys_delay': delay, 'genesys_clients': genesys_clients,
+                 'crm_clients': crm_clients, 'server': server_kind(), 'server_workers': workers})
+    return {'meta': meta, 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CRM latency while Genesys Cloud is slow, sync versus threaded serving")
+    add_common_arguments(parser, metric='p95')
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of load per mode")
+    parser.add_argument('--delay', type=float, default=1.0, help="Seconds the stub Genesys takes per API call")
+    parser.add_argument('--genesys-clients', type=int, default=6, help="Clients calling Genesys routes")
+    parser.add_argument('--crm-clients', type=int, default=2, help="Clients calling CRM routes")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--modes', default=','.join(MODES), help="Comma-separated serving modes (default: all)")
+    args = parser.parse_args()
+
+    modes = [mode for mode in args.modes.split(',') if mode]
+    unknown = [mode for mode in modes if mode not in MODES]
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(unknown)}")
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    sys.exit(report(run(args.scale, args.seed, args.duration, args.delay, args.genesys_clients,
+                        args.crm_clients, args.workers, modes), args))
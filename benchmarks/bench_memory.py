@@ -0,0 +1,78 @@
+import os
+import gc
+import json
+import argparse
+import time
+import tracemalloc
+
+from benchmarks.common import prepare_workspace, metadata
+from benchmarks.generate import scale_to_count
+
+def _retained_bytes(build):
+    """Bytes still allocated after build() returns, while its result is alive."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained
+
+def _timed(build):
+    started = time.perf_counter()
+    result = build()
+    return result, time.perf_counter() - started
+
+def run(scale, seed):
+    """Measure per-worker memory and open time for dicts, compact records and mapped files."""
+    workspace, counts = prepare_workspace(scale_to_count(scale), seed)
+    os.chdir(workspace)
+    from records import Customer, Contact, Deal
+    from store import Collection
+
+    results = {}
+    for name, record_class in [('customers', Customer), ('contacts', Contact), ('deals', Deal)]:
+        with open(os.path.join('data', f'{name}.json'), 'rb') as f:
+            raw = f.read()
+        dict_bytes = _retained_bytes(lambda: json.loads(raw))
+        compact_bytes = _retained_bytes(lambda: [record_class.from_dict(r) for r in json.loads(raw)])
+        _, json_seconds = _timed(lambda: json.loads(raw))
+
+        # What a worker holds privately once the mapped file exists: the
+        # records themselves are shared through the page cache
+        file_path = os.path.join('data', f'{name}.json')
+        Collection(file_path, record_class, name[:-1]).records()
+        mapped_bytes = _retained_bytes(lambda: Collection(file_path, record_class, name[:-1]).records())
+        _, mapped_seconds = _timed(lambda: Collection(file_path, record_class, name[:-1]).records())
+
+        count = counts[name]
+        results[name] = {
+            'records': count,
+            'dict_bytes_per_record': round(dict_bytes / count, 1),
+            'compact_bytes_per_record': round(compact_bytes / count, 1),
+            'reduction': round(1 - compact_bytes / dict_bytes, 3),
+            'mapped_private_bytes': mapped_bytes,
+            'json_load_seconds': json_seconds,
+            'mapped_open_seconds': mapped_seconds
+        }
+    return {'meta': metadata('memory', scale, seed, counts), 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure in-memory size of CRM records")
+    parser.add_argument('--scale', default='10k', help="1k, 10k, 100k, 1m or a customer count")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write results JSON here instead of stdout")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    text = json.dumps(run(args.scale, args.seed), indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
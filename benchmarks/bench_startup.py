@@ -0,0 +1,93 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.common import REPO_ROOT, DEFAULT_TOLERANCE, summarize, metadata, report
+
+# Median seconds allowed for `import app` in a fresh interpreter
+DEFAULT_BUDGET = 0.5
+
+# Modules that must only load when the feature using them is first used
+DEFERRED_MODULES = ['requests', 'numpy']
+
+_CHILD = """
+import sys, time, json
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+def _time_import(module, repeat):
+    """Import module in fresh interpreters inside an empty directory.
+
+    Returns:
+        tuple: (seconds per run, deferred modules that got loaded, files created)
+    """
+    samples, loaded, created = [], set(), set()
+    for _ in range(repeat):
+        workspace = tempfile.mkdtemp(prefix='crm-startup-')
+        try:
+            output = subprocess.run(
+                [sys.executable, '-c', _CHILD.format(module=module, deferred=DEFERRED_MODULES)],
+                cwd=workspace, env=dict(os.environ, PYTHONPATH=REPO_ROOT),
+                capture_output=True, text=True, check=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            samples.append(result['seconds'])
+            loaded.update(result['loaded'])
+            created.update(os.listdir(workspace))
+        finally:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return samples, sorted(loaded), sorted(created)
+
+def run(repeat):
+    """Measure cold import time of the app module and of the initialized app."""
+    app_samples, app_loaded, app_created = _time_import('app', repeat)
+    main_samples, _, _ = _time_import('main', repeat)
+
+    results = {
+        'import_app': summarize(app_samples),
+        'create_app': summarize(main_samples)
+    }
+    results['import_app'].update({'deferred_modules_loaded': app_loaded, 'files_created': app_created})
+    return {'meta': metadata('startup', 'cold', 0, {}), 'results': results}
+
+def check_budget(results, budget):
+    """List the ways importing the app breaks the startup budget."""
+    startup = results['results']['import_app']
+    problems = []
+    if startup['median'] > budget:
+        problems.append(f"import app took {startup['median']:.3f}s (budget {budget:.3f}s)")
+    if startup['deferred_modules_loaded']:
+        problems.append(f"import app loaded {', '.join(startup['deferred_modules_loaded'])}")
+    if startup['files_created']:
+        problems.append(f"import app created {', '.join(startup['files_created'])}")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure app import time and check the startup budget")
+    parser.add_argument('--output', help="Write results JSON here instead of stdout")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown versus baseline before flagging (0.5 = 50%%)")
+    parser.add_argument('--metric', default='median', choices=['min', 'median', 'p95'],
+                        help="Statistic compared with the baseline (default: median)")
+    parser.add_argument('--update-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--repeat', type=int, default=10, help="Fresh interpreters per measurement")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET,
+                        help=f"Median seconds allowed for `import app` (default: {DEFAULT_BUDGET})")
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    results = run(args.repeat)
+    status = report(results, args)
+    for problem in check_budget(results, args.budget):
+        print(f"BUDGET {problem}", file=sys.stderr)
+        status = 1
+    sys.exit(status)
@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+from benchmarks.common import prepare_workspace, summarize, metadata, report, add_common_arguments
+from benchmarks.generate import scale_to_count, generate_contact
+
+# store.GROUP_COMMIT for each mode: per_request rewrites the JSON file inside
+# every commit, as before group commit
+MODES = {'per_request': False, 'group_commit': True}
+
+def _rewrites(metrics):
+    """Count JSON file rewrites and commits recorded so far in this process."""
+    counters = metrics._process_totals()['counters']
+    writes = sum(value for (name, _), value in counters.items() if name == 'crm_datastore_writes_total')
+    commits = sum(value for (name, _), value in counters.items() if name == 'crm_datastore_commits_total')
+    return writes, commits
+
+def _round(dm, customer_ids, clients, writes, seed):
+    """Create writes contacts from each of clients threads started together.
+
+    Returns:
+        tuple: (seconds until every thread finished, per-write latencies)
+    """
+    latencies = []
+    ready = threading.Barrier(clients + 1)
+
+    def client(number):
+        rng = random.Random(seed * 1000 + number)
+        contacts = [generate_contact(rng, rng.choice(customer_ids)) for _ in range(writes)]
+        own = []
+        ready.wait()
+        for data in contacts:
+            started = time.perf_counter()
+            dm.create_contact(data)
+            own.append(time.perf_counter() - started)
+        latencies.extend(own)
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, latencies
+
+def run(scale, seed, repeat, clients, writes, shards):
+    """Measure concurrent create_contact throughput with and without group commit."""
+    workspace, counts = prepare_workspace(scale_to_count(scale), seed)
+    os.chdir(workspace)
+    os.environ['CRM_SHARDS'] = str(shards)
+    import data_manager as dm
+    import metrics
+    import store
+
+    customer_ids = [customer['id'] for customer in dm.get_all_customers()]
+    dm.get_all_contacts()
+
+    samples = {mode: {'per_write': [], 'latency': [], 'rewrites': 0, 'commits': 0} for mode in MODES}
+    for number in range(repeat):
+        # Alternate modes so both see the same file sizes and machine state
+        for mode, group_commit in MODES.items():
+            store.GROUP_COMMIT = group_commit
+            writes_before, commits_before = _rewrites(metrics)
+            elapsed, latencies = _round(dm, customer_ids, clients, writes, seed + number)
+            writes_after, commits_after = _rewrites(metrics)
+            sample = samples[mode]
+            sample['per_write'].append(elapsed / (clients * writes))
+            sample['latency'].extend(latencies)
+            sample['rewrites'] += writes_after - writes_before
+            sample['commits'] += commits_after - commits_before
+
+    results = {}
+    for mode, sample in samples.items():
+        results[f'{mode}_per_write'] = summarize(sample['per_write'])
+        results[f'{mode}_per_write'].update({
+            'writes_per_second': round(1 / results[f'{mode}_per_write']['median'], 1),
+            'commits_per_rewrite': round(sample['commits'] / max(sample['rewrites'], 1), 2)
+        })
+        results[f'{mode}_latency'] = summarize(sample['latency'])
+
+    meta = metadata('writes', scale, seed, counts)
+    meta.update({'clients': clients, 'writes_per_client': writes, 'shards': shards, 'fsync': store.FSYNC,
+                 'window_ms': store.GROUP_COMMIT_WINDOW * 1000})
+    return {'meta': meta, 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark concurrent writes with and without group commit")
+    add_common_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=5, help="Timed rounds per mode")
+    parser.add_argument('--clients', type=int, default=16, help="Threads writing at once")
+    parser.add_argument('--writes', type=int, default=20, help="Contacts each thread creates per round")
+    parser.add_argument('--shards', type=int, default=1, help="Shards each collection is stored in")
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    sys.exit(report(run(args.scale, args.seed, args.repeat, args.clients, args.writes, args.shards), args))
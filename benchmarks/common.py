@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import statistics
+from datetime import datetime
+
+from benchmarks.generate import write_dataset
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(REPO_ROOT, 'benchmarks', 'baselines')
+
+# Benchmarks chdir into a scratch workspace, so make the CRM modules
+# importable no matter how sys.path[0] was set
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+# A benchmark is flagged when its median is this much slower than baseline
+DEFAULT_TOLERANCE = 0.5
+
+def prepare_workspace(customer_count, seed):
+    """Create a scratch directory holding a generated data/ tree.
+
+    The CRM modules use paths relative to the working directory, so
+    benchmarks chdir here before importing them and never touch real data.
+    """
+    workspace = tempfile.mkdtemp(prefix='crm-bench-')
+    counts = write_dataset(os.path.join(workspace, 'data'), customer_count, seed)
+    os.makedirs(os.path.join(workspace, 'data', 'backup'), exist_ok=True)
+    return workspace, counts
+
+def summarize(samples):
+    """Reduce timing samples (seconds) to summary statistics."""
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'min': ordered[0],
+        'median': statistics.median(ordered),
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        'max': ordered[-1]
+    }
+
+def measure(func, repeat, setup=None):
+    """Time func() repeat times; setup() runs untimed and its result is passed in."""
+    samples = []
+    for _ in range(repeat):
+        argument = setup() if setup else None
+        started = time.perf_counter()
+        func(argument) if setup else func()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def metadata(suite, scale, seed, counts):
+    return {
+        'suite': suite,
+        'scale': scale,
+        'seed': seed,
+        'records': counts,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.now().isoformat()
+    }
+
+def baseline_path(suite, scale):
+    return os.path.join(BASELINE_DIR, f'{suite}-{scale}.json')
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE, key='median'):
+    """Compare results against a baseline.
+
+    Returns:
+        list: One entry per benchmark slower than baseline by more than tolerance
+    """
+    regressions = []
+    for name, current in results['results'].items():
+        previous = baseline['results'].get(name)
+        if not previous or not previous.get(key):
+            continue
+        ratio = current[key] / previous[key]
+        if ratio > 1 + tolerance:
+            regressions.append({'benchmark': name, 'baseline': previous[key], 'current': current[key], 'ratio': round(ratio, 2)})
+    return regressions
+
+def report(results, args):
+    """Write results, compare them with the stored baseline and set the exit code.
+
+    Expects args.output, args.tolerance, args.metric and args.update_baseline.
+    """
+    suite, scale = results['meta']['suite'], results['meta']['scale']
+    text = json.dumps(results, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    path = baseline_path(suite, scale)
+    if args.update_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(text + '\n')
+        print(f"Baseline written to {path}", file=sys.stderr)
+        return 0
+
+    if not os.path.exists(path):
+        print(f"No baseline at {path}; run with --update-baseline to create one", file=sys.stderr)
+        return 0
+
+    with open(path, 'r') as f:
+        regressions = compare(results, json.load(f), args.tolerance, args.metric)
+    for regression in regressions:
+        print(f"REGRESSION {regression['benchmark']}: {regression['baseline']:.6f}s -> "
+              f"{regression['current']:.6f}s ({regression['ratio']}x)", file=sys.stderr)
+    return 1 if regressions else 0
+
+def add_common_arguments(parser, metric='median'):
+    parser.add_argument('--scale', default='1k', help="1k, 10k, 100k, 1m or a customer count")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help="Write results JSON here instead of stdout")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Allowed slowdown versus baseline before flagging (0.5 = 50%%)")
+    parser.add_argument('--metric', default=metric, choices=['min', 'median', 'p95'],
+                        help=f"Statistic compared with the baseline (default: {metric})")
+    parser.add_argument('--update-baseline', action='store_true', help="Store these results as the new baseline")
@@ -0,0 +1,141 @@
+import os
+import json
+import uuid
+import random
+import argparse
+from datetime import datetime, timedelta
+
+# Customers per scale; contacts and deals scale with them
+SCALES = {
+    '1k': 1000,
+    '10k': 10000,
+    '100k': 100000,
+    '1m': 1000000
+}
+CONTACTS_PER_CUSTOMER = 2
+DEALS_PER_CUSTOMER = 1.5
+
+INDUSTRIES = ['Retail', 'Technology', 'Healthcare', 'Finance', 'Manufacturing',
+              'Education', 'Hospitality', 'Logistics', 'Real Estate', '']
+DEAL_STATUSES = ['New', 'Qualified', 'Proposal', 'Negotiation', 'Closed Won', 'Closed Lost']
+POSITIONS = ['CEO', 'CTO', 'Buyer', 'Office Manager', 'Engineer', 'Sales Lead', '']
+FIRST_NAMES = ['Ava', 'Ben', 'Chloe', 'Dan', 'Eve', 'Finn', 'Grace', 'Hugo', 'Iris', 'Jack',
+               'Kara', 'Liam', 'Maya', 'Noah', 'Olga', 'Paul', 'Quinn', 'Rosa', 'Sam', 'Tara']
+LAST_NAMES = ['Smith', 'Jones', 'Garcia', 'Miller', 'Davis', 'Lopez', 'Wilson', 'Clark',
+              'Lewis', 'Walker', 'Young', 'King', 'Wright', 'Scott', 'Green', 'Baker']
+COMPANY_WORDS = ['Acme', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Vandelay', 'Stark',
+                 'Wayne', 'Cyberdyne', 'Soylent', 'Tyrell', 'Wonka', 'Gringotts', 'Oscorp']
+COMPANY_SUFFIXES = ['Inc', 'LLC', 'Group', 'Labs', 'Partners', 'Holdings', 'Co']
+NOTE_WORDS = ['call', 'back', 'renewal', 'pricing', 'discount', 'contract', 'follow', 'up',
+              'demo', 'invoice', 'support', 'escalation', 'quarterly', 'review', 'budget']
+
+# Fixed epoch so every run produces byte-identical files
+BASE_TIME = datetime(2024, 1, 1, 9, 0, 0)
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def _timestamps(rng):
+    created = BASE_TIME + timedelta(seconds=rng.randrange(365 * 24 * 3600), microseconds=rng.randrange(1000000))
+    updated = created + timedelta(seconds=rng.randrange(90 * 24 * 3600))
+    return created.isoformat(), updated.isoformat()
+
+def _phone(rng):
+    return f"+1 ({rng.randrange(200, 999)}) {rng.randrange(200, 999)}-{rng.randrange(10000):04d}"
+
+def _notes(rng, words):
+    return ' '.join(rng.choice(NOTE_WORDS) for _ in range(words))
+
+def generate_customer(rng):
+    """Build a customer shaped exactly like data_manager.create_customer's."""
+    company = f"{rng.choice(COMPANY_WORDS)} {rng.choice(COMPANY_WORDS)} {rng.choice(COMPANY_SUFFIXES)}"
+    domain = company.lower().replace(' ', '') + '.com'
+    created_at, updated_at = _timestamps(rng)
+    return {
+        'id': _uuid(rng),
+        'name': company,
+        'email': f"info@{domain}",
+        'phone': _phone(rng),
+        'address': f"{rng.randrange(1, 9999)} Main St",
+        'website': f"https://{domain}",
+        'industry': rng.choice(INDUSTRIES),
+        'notes': _notes(rng, rng.randrange(0, 40)),
+        'created_at': created_at,
+        'updated_at': updated_at
+    }
+
+def generate_contact(rng, customer_id):
+    """Build a contact shaped exactly like data_manager.create_contact's."""
+    first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+    created_at, updated_at = _timestamps(rng)
+    return {
+        'id': _uuid(rng),
+        'customer_id': customer_id,
+        'name': f"{first} {last}",
+        'email': f"{first.lower()}.{last.lower()}{rng.randrange(1000)}@example.com",
+        'phone': _phone(rng),
+        'position': rng.choice(POSITIONS),
+        'notes': _notes(rng, rng.randrange(0, 20)),
+        'created_at': created_at,
+        'updated_at': updated_at
+    }
+
+def generate_deal(rng, customer_id):
+    """Build a deal shaped exactly like data_manager.create_deal's."""
+    created_at, updated_at = _timestamps(rng)
+    close_date = (BASE_TIME + timedelta(days=rng.randrange(30, 540))).date().isoformat()
+    return {
+        'id': _uuid(rng),
+        'customer_id': customer_id,
+        'title': f"{rng.choice(['Annual', 'Pilot', 'Expansion', 'Renewal'])} {rng.choice(['license', 'support', 'services', 'hardware'])}",
+        'amount': round(rng.lognormvariate(9, 1.2), 2),
+        'status': rng.choice(DEAL_STATUSES),
+        'expected_close_date': close_date,
+        'description': _notes(rng, rng.randrange(0, 60)),
+        'created_at': created_at,
+        'updated_at': updated_at
+    }
+
+def generate_dataset(customer_count, seed=42):
+    """Generate customers, contacts and deals deterministically.
+
+    Returns:
+        tuple: (customers, contacts, deals) lists
+    """
+    rng = random.Random(seed)
+    customers = [generate_customer(rng) for _ in range(customer_count)]
+    customer_ids = [customer['id'] for customer in customers]
+    contacts = [generate_contact(rng, rng.choice(customer_ids))
+                for _ in range(int(customer_count * CONTACTS_PER_CUSTOMER))]
+    deals = [generate_deal(rng, rng.choice(customer_ids))
+             for _ in range(int(customer_count * DEALS_PER_CUSTOMER))]
+    return customers, contacts, deals
+
+def scale_to_count(scale):
+    """Turn '1k', '100k', '1m' or a plain number into a customer count."""
+    if scale.lower() in SCALES:
+        return SCALES[scale.lower()]
+    try:
+        return int(scale)
+    except ValueError:
+        raise ValueError(f"Unknown scale: {scale} (use one of {', '.join(SCALES)} or a number)")
+
+def write_dataset(data_dir, customer_count, seed=42):
+    """Write a generated dataset as the CRM's JSON files into data_dir."""
+    customers, contacts, deals = generate_dataset(customer_count, seed)
+    os.makedirs(data_dir, exist_ok=True)
+    for file_name, records in [('customers.json', customers), ('contacts.json', contacts), ('deals.json', deals)]:
+        with open(os.path.join(data_dir, file_name), 'w') as f:
+            json.dump(records, f, indent=2)
+    return {'customers': len(customers), 'contacts': len(contacts), 'deals': len(deals)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic CRM dataset")
+    parser.add_argument('--scale', default='1k', help="1k, 10k, 100k, 1m or a customer count")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default='data', help="Directory to write the JSON files to")
+    args = parser.parse_args()
+
+    counts = write_dataset(args.out, scale_to_count(args.scale), args.seed)
+    print(json.dumps(counts))
@@ -0,0 +1,174 @@
+import os
+import sys
+import json
+import time
+import base64
+import random
+import socket
+import argparse
+import subprocess
+import http.client
+import importlib.util
+from multiprocessing import Pool
+
+from benchmarks.common import REPO_ROOT, prepare_workspace, summarize, metadata, report, add_common_arguments
+from benchmarks.generate import scale_to_count, generate_customer
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+# name -> (weight, method); paths and bodies are built per request below
+ROUTES = {
+    'list_customers': (1, 'GET'),
+    'search_customers': (2, 'GET'),
+    'get_customer': (4, 'GET'),
+    'contacts_for_customer': (2, 'GET'),
+    'deals_for_customer': (2, 'GET'),
+    'screen_pop_lookup': (3, 'POST'),
+    'create_customer': (1, 'POST')
+}
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def server_kind():
+    return 'gunicorn' if importlib.util.find_spec('gunicorn') else 'werkzeug'
+
+def start_server(workspace, port, workers, threaded=True, env=None):
+    """Start the app against the workspace data, under gunicorn when available.
+
+    threaded=False serves one request at a time per worker; env adds
+    environment variables for the server.
+    """
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT, **(env or {}))
+    if server_kind() == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '--workers', str(workers),
+                   '--bind', f'127.0.0.1:{port}', '--log-level', 'warning', 'main:app']
+        if not threaded:
+            command[-1:-1] = ['--worker-class', 'sync']
+    else:
+        command = [sys.executable, '-c',
+                   f"from main import app; app.run(host='127.0.0.1', port={port}, threaded={threaded})"]
+    server = subprocess.Popen(command, cwd=workspace, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError("Server did not start within 30 seconds")
+
+def _build_request(name, rng, samples):
+    customer = rng.choice(samples)
+    if name == 'list_customers':
+        return '/api/customers', None
+    if name == 'search_customers':
+        return f"/api/customers?search={customer['name'].split()[0].lower()}", None
+    if name == 'get_customer':
+        return f"/api/customers/{customer['id']}", None
+    if name == 'contacts_for_customer':
+        return f"/api/contacts?customer_id={customer['id']}", None
+    if name == 'deals_for_customer':
+        return f"/api/deals?customer_id={customer['id']}", None
+    if name == 'screen_pop_lookup':
+        return '/api/genesys/screen-pop/lookup', {'phone_number': customer['phone']}
+    return '/api/customers', generate_customer(rng)
+
+def _client(args):
+    """Drive requests from one process until the deadline."""
+    port, duration, seed, routes, samples = args
+    rng = random.Random(seed)
+    names = list(routes)
+    weights = [ROUTES[name][0] for name in names]
+    headers = {
+        'Authorization': 'Basic ' + base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode(),
+        'Content-Type': 'application/json'
+    }
+    results = []
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    deadline = time.monotonic() + duration
+
+    while time.monotonic() < deadline:
+        name = rng.choices(names, weights)[0]
+        path, body = _build_request(name, rng, samples)
+        started = time.perf_counter()
+        try:
+            connection.request(ROUTES[name][1], path, body=json.dumps(body) if body else None, headers=headers)
+            response = connection.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            status, payload = 0, b''
+        results.append((name, time.perf_counter() - started, status, len(payload)))
+    connection.close()
+    return results
+
+def run(scale, seed, duration, clients, workers, routes):
+    """Load-test the Flask routes with several client processes."""
+    workspace, counts = prepare_workspace(scale_to_count(scale), seed)
+    os.chdir(workspace)
+    from auth import register_user
+    from data_manager import get_all_customers
+    register_user(USERNAME, PASSWORD)
+
+    rng = random.Random(seed)
+    customers = get_all_customers()
+    samples = [{'id': c['id'], 'name': c['name'], 'phone': c['phone']}
+               for c in rng.sample(customers, min(500, len(customers)))]
+    del customers
+
+    port = _free_port()
+    server = start_server(workspace, port, workers)
+    try:
+        with Pool(clients) as pool:
+            started = time.monotonic()
+            per_client = pool.map(_client, [(port, duration, seed + i, routes, samples) for i in range(clients)])
+            elapsed = time.monotonic() - started
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    observations = [o for client in per_client for o in client]
+    results = {}
+    for name in routes:
+        mine = [o for o in observations if o[0] == name]
+        if not mine:
+            continue
+        summary = summarize([latency for _, latency, _, _ in mine])
+        summary['errors'] = sum(1 for _, _, status, _ in mine if not 200 <= status < 300 and status != 404)
+        summary['throughput_rps'] = len(mine) / elapsed
+        summary['mean_response_bytes'] = sum(size for _, _, _, size in mine) / len(mine)
+        results[name] = summary
+    results['all'] = summarize([latency for _, latency, _, _ in observations])
+    results['all']['throughput_rps'] = len(observations) / elapsed
+
+    meta = metadata('load_test', scale, seed, counts)
+    meta.update({'duration': duration, 'clients': clients, 'server': server_kind(), 'server_workers': workers})
+    return {'meta': meta, 'results': results}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Multi-process HTTP load test of the CRM API")
+    add_common_arguments(parser)
+    parser.add_argument('--duration', type=float, default=20, help="Seconds of load per client")
+    parser.add_argument('--clients', type=int, default=4, help="Concurrent client processes")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--routes', default=','.join(ROUTES),
+                        help="Comma-separated routes to exercise (default: all)")
+    args = parser.parse_args()
+
+    routes = [name for name in args.routes.split(',') if name]
+    unknown = [name for name in routes if name not in ROUTES]
+    if unknown:
+        parser.error(f"Unknown routes: {', '.join(unknown)}")
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    sys.exit(report(run(args.scale, args.seed, args.duration, args.clients, args.workers, routes), args))
@@ -1,50 +1,274 @@
-import json
 import os
+import re
+import time
 import uuid
-import shutil
 from datetime import datetime
-
-# Ensure data directories exist
-os.makedirs('data', exist_ok=True)
-os.makedirs('data/backup', exist_ok=True)
+from functools import partial
+from records import Customer, Contact, Deal, encode_id, timestamp_key
+from store import Collection, snapshot
+from aggregates import DealTotals, ReferenceIndex, ValueIndex, TimeIndex, UNTIMED
+from mapped import KEY_SIZE, record_key
+import dedupe
+import suggest
+import query
+import backup
+import metrics
 
 # File paths
 CUSTOMERS_FILE = 'data/customers.json'
 CONTACTS_FILE = 'data/contacts.json'
 DEALS_FILE = 'data/deals.json'
 
-def ensure_file_exists(file_path, default_data=None):
-    """Ensure that a JSON file exists, creating it with default data if it doesn't."""
-    if not os.path.exists(file_path):
-        with open(file_path, 'w') as f:
-            json.dump(default_data or [], f)
+# Number of hash shards each collection is stored in (see store.py); the
+# files are split or merged to match on startup
+SHARDS = int(os.environ.get('CRM_SHARDS', '1'))
+
+class DuplicateCustomerError(ValueError):
+    """Raised when a new customer looks like one that already exists"""
+
+    def __init__(self, matches):
+        super().__init__("Customer looks like a duplicate of an existing customer")
+        self.matches = matches
+
+def init_storage():
+    """Create the data directories and collection files if they don't exist.
+    
+    Also moves each collection into SHARDS shard files if it is stored in
+    some other layout. Called once from app.create_app() rather than at import time, so
+    importing this module never touches the filesystem.
+    """
+    os.makedirs('data', exist_ok=True)
+    os.makedirs('data/backup', exist_ok=True)
+    for collection in (_customers, _contacts, _deals):
+        collection.prepare()
 
-# Initialize files if they don't exist
-ensure_file_exists(CUSTOMERS_FILE)
-ensure_file_exists(CONTACTS_FILE)
-ensure_file_exists(DEALS_FILE)
+# Indexes every collection keeps by timestamp field, for listing by recency
+_TIME_INDEXES = {'created_at': 'by_created', 'updated_at': 'by_updated'}
+_TIME_AGGREGATES = {name: partial(TimeIndex, field) for field, name in _TIME_INDEXES.items()}
+
+# Collections are served from shared memory-mapped files; records are
+# converted to dicts only for callers
+_customers = Collection(CUSTOMERS_FILE, Customer, 'customer', aggregates={
+    'duplicates': dedupe.DuplicateIndex,
+    'suggest': suggest.SuggestIndex,
+    'by_industry': partial(ValueIndex, 'industry'),
+    **_TIME_AGGREGATES
+}, shards=SHARDS)
+_contacts = Collection(CONTACTS_FILE, Contact, 'contact', aggregates={
+    'by_customer': partial(ReferenceIndex, 'customer_id'),
+    **_TIME_AGGREGATES
+}, shards=SHARDS)
+_deals = Collection(DEALS_FILE, Deal, 'deal', aggregates={
+    'totals': DealTotals,
+    'by_customer': partial(ReferenceIndex, 'customer_id'),
+    'by_status': partial(ValueIndex, 'status'),
+    **_TIME_AGGREGATES
+}, shards=SHARDS)
+
+def _scan_timer(collection):
+    """Time a linear scan over a collection."""
+    return metrics.timer('crm_datastore_operation_seconds', collection=collection, op='scan')
+
+def _put(collection, data, action):
+    """Insert or replace a record and publish the change."""
+    collection.commit([(collection.key(data.get('id')), collection.record_class.from_dict(data))],
+                      [(action, data)])
+
+def _remove(collection, field, value):
+    """Remove every record whose field matches value and publish the deletes.
+    
+    Returns:
+        list: The removed records as dicts
+    """
+    with collection.lock:
+        if field == 'id':
+            record = collection.get(value)
+            deleted = [record] if record else []
+        elif field == 'customer_id':
+            deleted = _for_customer(collection, value)
+        else:
+            key = encode_id(value)
+            with _scan_timer(collection.name):
+                deleted = [record for record in collection.records() if record.raw(field) == key]
+        deleted = [record.to_dict() for record in deleted]
+        if deleted:
+            collection.commit([(collection.key(record.get('id')), None) for record in deleted],
+                              [('delete', record) for record in deleted])
+    return deleted
+
+def _for_customer(collection, customer_id):
+    """Get a customer's records from a collection's customer_id index, oldest first."""
+    with collection.lock:
+        keys = collection.aggregate('by_customer').get(encode_id(customer_id))
+        view = collection.records()
+        records = [view.get(key) for key in keys]
+    # The index doesn't keep file order; creation order matches it for records made here
+    return sorted(records, key=_created)
+
+def _created(record):
+    created = record.raw('created_at')
+    return created if isinstance(created, int) else 0
+
+def _time_of(record, field):
+    time = timestamp_key(record.raw(field))
+    return UNTIMED if time is None else time
+
+def _time_bound(value):
+    """Parse a timestamp given to a list endpoint, or None if it is empty."""
+    if not value:
+        return None
+    time = timestamp_key(value.strip())
+    if time is None:
+        raise ValueError(f"Invalid timestamp: {value}")
+    return time
+
+def _list_by_time(collection, matches, search_term, customer_id, updated_since, created_between, sort, limit):
+    """List records by recency from the collection's time indexes.
+    
+    Args:
+        matches: The collection's search predicate, used if search_term is set
+        updated_since (str): Only records updated at or after this ISO timestamp
+        created_between (str): 'start,end' ISO timestamps; only records created
+            at or after start and before end, either of which may be empty
+        sort (str): created_at or updated_at, oldest first, or -created_at or
+            -updated_at, newest first; by default the first time filtered on,
+            oldest first
+        limit (int): Maximum number of records to return
+        
+    Raises:
+        ValueError: If a timestamp or the sort order is invalid
+    """
+    ranges = {}
+    if updated_since:
+        ranges['updated_at'] = (_time_bound(updated_since), None)
+    if created_between:
+        bounds = created_between.split(',')
+        if len(bounds) != 2:
+            raise ValueError("created_between must be two timestamps separated by a comma; either may be empty")
+        ranges['created_at'] = tuple(map(_time_bound, bounds))
+    if sort:
+        field = sort[1:] if sort.startswith('-') else sort
+        if field not in _TIME_INDEXES:
+            raise ValueError(f"Invalid sort: {sort}; expected created_at or updated_at, with - for newest first")
+        newest_first = sort.startswith('-')
+    else:
+        field, newest_first = next(iter(ranges), 'created_at'), False
+    # Records without a readable time never pass a time filter
+    ranges = {name: (UNTIMED + 1 if start is None else start, end) for name, (start, end) in ranges.items()}
+    search_term = search_term.lower() if search_term else None
+    
+    def wanted(record):
+        for name, (start, end) in ranges.items():
+            time = _time_of(record, name)
+            if time < start or (end is not None and time >= end):
+                return False
+        return search_term is None or matches(record, search_term)
+    
+    if customer_id:
+        records = [record for record in _for_customer(collection, customer_id) if wanted(record)]
+        records.sort(key=lambda record: _time_of(record, field), reverse=newest_first)
+        return [record.to_dict() for record in records[:limit]]
+    
+    # Walk the index of the sort field, stopping at the limit, unless only
+    # another field is filtered on: then walk that range and sort after
+    walk = field if field in ranges or not ranges else next(iter(ranges))
+    with collection.lock:
+        keys = collection.aggregate(_TIME_INDEXES[walk]).between(*ranges.get(walk, (None, None)))
+        view = collection.records()
+    
+    offsets = range(0, len(keys), KEY_SIZE)
+    if walk == field and newest_first:
+        offsets = reversed(offsets)
+    records = []
+    for offset in offsets:
+        record = view.get(keys[offset:offset + KEY_SIZE])
+        if record is not None and wanted(record):
+            records.append(record)
+            if walk == field and limit and len(records) >= limit:
+                break
+    if walk != field:
+        records.sort(key=lambda record: _time_of(record, field), reverse=newest_first)
+    return [record.to_dict() for record in records[:limit]]
+
+def _get_many(collection, record_ids):
+    """Get the records with the given IDs as dicts, in the order asked, skipping missing ones."""
+    view = collection.records()
+    found = []
+    for record_id in dict.fromkeys(record_ids):
+        record = view.get(collection.key(record_id))
+        if record is not None:
+            found.append(record.to_dict())
+    return found
+
+def warm_up():
+    """Open every collection, building its mapped file if needed.
+    
+    Called in the gunicorn master so workers inherit ready mappings.
+    """
+    for collection in (_customers, _contacts, _deals):
+        collection.records()
+    _customers.aggregate('duplicates')
+    _customers.aggregate('suggest')
+    _contacts.aggregate('by_customer')
+    _deals.aggregate('totals')
+    _deals.aggregate('by_customer')
+
+def get_views():
+    """Get (customers, deals) views current at the same instant, for read-only reporting.
+
+    Views are immutable and replaced on every change, so callers can scan
+    them without locking and compare them by identity to detect changes.
+    """
+    return snapshot(_customers, _deals)
 
 # Customer functions
 def get_all_customers():
     """Get all customers."""
-    try:
-        with open(CUSTOMERS_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+    return [customer.to_dict() for customer in _customers.records()]
+
+def list_customers(search_term='', updated_since=None, created_between=None, sort=None, limit=None):
+    """List customers by recency, optionally filtered by time and search term (see _list_by_time)."""
+    return _list_by_time(_customers, _customer_matches, search_term, None,
+                         updated_since, created_between, sort, limit)
 
 def get_customer(customer_id):
     """Get a customer by ID."""
-    customers = get_all_customers()
-    for customer in customers:
-        if customer.get('id') == customer_id:
-            return customer
-    return None
+    customer = _customers.get(customer_id)
+    return customer.to_dict() if customer else None
+
+def get_customers(customer_ids):
+    """Get several customers by ID, in the order given, skipping any that don't exist."""
+    return _get_many(_customers, customer_ids)
+
+def get_customer_full(customer_id):
+    """Get a customer together with its contacts, deals and deal totals.
+    
+    Returns:
+        dict: {'customer', 'contacts', 'deals', 'deal_totals'}, or None if the customer doesn't exist
+    """
+    customer = _customers.get(customer_id)
+    if customer is None:
+        return None
+    with _deals.lock:
+        deals = _for_customer(_deals, customer_id)
+        totals = _deals.aggregate('totals').customer_totals(encode_id(customer_id))
+    return {
+        'customer': customer.to_dict(),
+        'contacts': [contact.to_dict() for contact in _for_customer(_contacts, customer_id)],
+        'deals': [deal.to_dict() for deal in deals],
+        'deal_totals': totals
+    }
 
-def create_customer(data):
-    """Create a new customer."""
-    customers = get_all_customers()
+def create_customer(data, check_duplicates=False):
+    """Create a new customer.
     
+    Args:
+        data (dict): The customer fields
+        check_duplicates (bool): Refuse to create a likely duplicate
+        
+    Raises:
+        DuplicateCustomerError: If check_duplicates is set and matches were found
+    """
     # Create new customer with additional metadata
     new_customer = {
         'id': str(uuid.uuid4()),
@@ -59,93 +283,144 @@ def create_customer(data):
         'updated_at': datetime.now().isoformat()
     }
     
-    customers.append(new_customer)
-    
-    with open(CUSTOMERS_FILE, 'w') as f:
-        json.dump(customers, f, indent=2)
+    with _customers.lock:
+        if check_duplicates:
+            matches = find_duplicate_customers(new_customer)
+            if matches:
+                raise DuplicateCustomerError(matches)
+        _put(_customers, new_customer, 'create')
     
     return new_customer
 
 def update_customer(customer_id, data):
     """Update an existing customer."""
-    customers = get_all_customers()
-    
-    for i, customer in enumerate(customers):
-        if customer.get('id') == customer_id:
-            # Update customer data while preserving id and created_at
-            customers[i].update({
-                'name': data.get('name', customer['name']),
-                'email': data.get('email', customer['email']),
-                'phone': data.get('phone', customer['phone']),
-                'address': data.get('address', customer.get('address', '')),
-                'website': data.get('website', customer.get('website', '')),
-                'industry': data.get('industry', customer.get('industry', '')),
-                'notes': data.get('notes', customer.get('notes', '')),
-                'updated_at': datetime.now().isoformat()
-            })
-            
-            with open(CUSTOMERS_FILE, 'w') as f:
-                json.dump(customers, f, indent=2)
-            
-            return customers[i]
+    with _customers.lock:
+        existing = _customers.get(customer_id)
+        if existing is None:
+            raise ValueError(f"Customer with ID {customer_id} not found")
+        
+        # Update customer data while preserving id and created_at
+        customer = existing.to_dict()
+        customer.update({
+            'name': data.get('name', customer['name']),
+            'email': data.get('email', customer['email']),
+            'phone': data.get('phone', customer['phone']),
+            'address': data.get('address', customer.get('address', '')),
+            'website': data.get('website', customer.get('website', '')),
+            'industry': data.get('industry', customer.get('industry', '')),
+            'notes': data.get('notes', customer.get('notes', '')),
+            'updated_at': datetime.now().isoformat()
+        })
+        
+        _put(_customers, customer, 'update')
     
-    raise ValueError(f"Customer with ID {customer_id} not found")
+    return customer
 
 def delete_customer(customer_id):
     """Delete a customer."""
-    customers = get_all_customers()
-    
-    initial_count = len(customers)
-    customers = [c for c in customers if c.get('id') != customer_id]
+    deleted = _remove(_customers, 'id', customer_id)
     
-    if len(customers) == initial_count:
+    if not deleted:
         raise ValueError(f"Customer with ID {customer_id} not found")
     
-    with open(CUSTOMERS_FILE, 'w') as f:
-        json.dump(customers, f, indent=2)
-    
     # Also delete associated contacts and deals
     delete_related_contacts(customer_id)
     delete_related_deals(customer_id)
     
     return True
 
+def _customer_matches(customer, search_term):
+    return (search_term in customer.get('name', '').lower() or
+            search_term in customer.get('email', '').lower() or
+            search_term in customer.get('phone', '').lower() or
+            search_term in customer.get('industry', '').lower())
+
 def search_customers(search_term):
     """Search customers by name, email, or phone."""
-    customers = get_all_customers()
-    search_term = search_term.lower()
+    customers = _customers.records()
     
-    results = []
-    for customer in customers:
-        if (search_term in customer.get('name', '').lower() or
-            search_term in customer.get('email', '').lower() or
-            search_term in customer.get('phone', '').lower() or
-            search_term in customer.get('industry', '').lower()):
-            results.append(customer)
+    with _scan_timer('customers'):
+        return [customer.to_dict() for customer in customers.filter(_customer_matches, search_term.lower())]
+
+def suggest_customers(query, limit=suggest.DEFAULT_LIMIT):
+    """Autocomplete customer names, tolerating a few typos.
     
-    return results
+    Args:
+        query (str): The start of one or more words of the name
+        limit (int): Maximum number of suggestions
+        
+    Returns:
+        list: {'customer', 'match'} dicts, best first
+    """
+    with _customers.lock:
+        matches = _customers.aggregate('suggest').suggest(query, limit)
+        view = _customers.records()
+        return [{'customer': view.get(key).to_dict(), 'match': match} for key, match in matches]
+
+def find_duplicate_customers(data, exclude_id=None, limit=5):
+    """Find existing customers that are likely duplicates of the given one.
+    
+    Args:
+        data (dict): Customer fields (name, email, phone)
+        exclude_id (str): ID of a customer to leave out, e.g. the one being edited
+        limit (int): Maximum number of matches to return
+        
+    Returns:
+        list: {'customer', 'score', 'matched'} dicts, best match first
+    """
+    with _customers.lock:
+        index = _customers.aggregate('duplicates')
+        exclude = _customers.key(exclude_id) if exclude_id else None
+        matches = dedupe.find_matches(data, index, _customers.records(), exclude)
+    return [
+        {'customer': record.to_dict(), 'score': round(value, 3), 'matched': reasons}
+        for value, reasons, record in matches[:limit]
+    ]
+
+def find_duplicate_clusters(limit=None):
+    """Find groups of likely duplicate customers across all customers.
+    
+    Runs on a private index over a snapshot, so writes aren't blocked meanwhile.
+    
+    Returns:
+        dict: The total number of clusters and the clusters as lists of customers, largest first
+    """
+    view = _customers.records()
+    with _scan_timer('customers'):
+        index = dedupe.DuplicateIndex()
+        for record in view:
+            index.add(record)
+        clusters = dedupe.find_clusters(index, view)
+    return {
+        'total_clusters': len(clusters),
+        'clusters': [[record.to_dict() for record in cluster] for cluster in clusters[:limit]]
+    }
 
 # Contact functions
 def get_all_contacts():
     """Get all contacts."""
-    try:
-        with open(CONTACTS_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+    return [contact.to_dict() for contact in _contacts.records()]
+
+def list_contacts(search_term='', customer_id='', updated_since=None, created_between=None, sort=None, limit=None):
+    """List contacts by recency, optionally filtered by time, customer and search term (see _list_by_time)."""
+    return _list_by_time(_contacts, _contact_matches, search_term, customer_id,
+                         updated_since, created_between, sort, limit)
 
 def get_contact(contact_id):
     """Get a contact by ID."""
-    contacts = get_all_contacts()
-    for contact in contacts:
-        if contact.get('id') == contact_id:
-            return contact
-    return None
+    contact = _contacts.get(contact_id)
+    return contact.to_dict() if contact else None
+
+def get_contacts_for_customer(customer_id):
+    """Get all contacts belonging to a customer."""
+    return [contact.to_dict() for contact in _for_customer(_contacts, customer_id)]
+
+def get_contacts(contact_ids):
+    """Get several contacts by ID, in the order given, skipping any that don't exist."""
+    return _get_many(_contacts, contact_ids)
 
 def create_contact(data):
     """Create a new contact."""
-    contacts = get_all_contacts()
-    
     # Verify customer exists
     customer_id = data.get('customer_id')
     if not get_customer(customer_id):
@@ -164,102 +439,90 @@ def create_contact(data):
         'updated_at': datetime.now().isoformat()
     }
     
-    contacts.append(new_contact)
-    
-    with open(CONTACTS_FILE, 'w') as f:
-        json.dump(contacts, f, indent=2)
+    _put(_contacts, new_contact, 'create')
     
     return new_contact
 
 def update_contact(contact_id, data):
     """Update an existing contact."""
-    contacts = get_all_contacts()
-    
-    for i, contact in enumerate(contacts):
-        if contact.get('id') == contact_id:
-            # Update contact data while preserving id and created_at
-            contacts[i].update({
-                'name': data.get('name', contact['name']),
-                'email': data.get('email', contact['email']),
-                'phone': data.get('phone', contact['phone']),
-                'position': data.get('position', contact.get('position', '')),
-                'notes': data.get('notes', contact.get('notes', '')),
-                'updated_at': datetime.now().isoformat()
-            })
-            
-            # Only update customer_id if provided and valid
-            if 'customer_id' in data:
-                customer_id = data['customer_id']
-                if not get_customer(customer_id):
-                    raise ValueError(f"Customer with ID {customer_id} not found")
-                contacts[i]['customer_id'] = customer_id
-            
-            with open(CONTACTS_FILE, 'w') as f:
-                json.dump(contacts, f, indent=2)
-            
-            return contacts[i]
+    with _contacts.lock:
+        existing = _contacts.get(contact_id)
+        if existing is None:
+            raise ValueError(f"Contact with ID {contact_id} not found")
+        
+        # Update contact data while preserving id and created_at
+        contact = existing.to_dict()
+        contact.update({
+            'name': data.get('name', contact['name']),
+            'email': data.get('email', contact['email']),
+            'phone': data.get('phone', contact['phone']),
+            'position': data.get('position', contact.get('position', '')),
+            'notes': data.get('notes', contact.get('notes', '')),
+            'updated_at': datetime.now().isoformat()
+        })
+        
+        # Only update customer_id if provided and valid
+        if 'customer_id' in data:
+            customer_id = data['customer_id']
+            if not get_customer(customer_id):
+                raise ValueError(f"Customer with ID {customer_id} not found")
+            contact['customer_id'] = customer_id
+        
+        _put(_contacts, contact, 'update')
     
-    raise ValueError(f"Contact with ID {contact_id} not found")
+    return contact
 
 def delete_contact(contact_id):
     """Delete a contact."""
-    contacts = get_all_contacts()
-    
-    initial_count = len(contacts)
-    contacts = [c for c in contacts if c.get('id') != contact_id]
+    deleted = _remove(_contacts, 'id', contact_id)
     
-    if len(contacts) == initial_count:
+    if not deleted:
         raise ValueError(f"Contact with ID {contact_id} not found")
     
-    with open(CONTACTS_FILE, 'w') as f:
-        json.dump(contacts, f, indent=2)
-    
     return True
 
 def delete_related_contacts(customer_id):
     """Delete all contacts related to a customer."""
-    contacts = get_all_contacts()
-    contacts = [c for c in contacts if c.get('customer_id') != customer_id]
-    
-    with open(CONTACTS_FILE, 'w') as f:
-        json.dump(contacts, f, indent=2)
+    _remove(_contacts, 'customer_id', customer_id)
 
-def search_contacts(search_term):
-    """Search contacts by name, email, or phone."""
-    contacts = get_all_contacts()
-    search_term = search_term.lower()
-    
-    results = []
-    for contact in contacts:
-        if (search_term in contact.get('name', '').lower() or
+def _contact_matches(contact, search_term):
+    return (search_term in contact.get('name', '').lower() or
             search_term in contact.get('email', '').lower() or
             search_term in contact.get('phone', '').lower() or
-            search_term in contact.get('position', '').lower()):
-            results.append(contact)
+            search_term in contact.get('position', '').lower())
+
+def search_contacts(search_term):
+    """Search contacts by name, email, or phone."""
+    contacts = _contacts.records()
     
-    return results
+    with _scan_timer('contacts'):
+        return [contact.to_dict() for contact in contacts.filter(_contact_matches, search_term.lower())]
 
 # Deal functions
 def get_all_deals():
     """Get all deals."""
-    try:
-        with open(DEALS_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+    return [deal.to_dict() for deal in _deals.records()]
+
+def list_deals(search_term='', customer_id='', updated_since=None, created_between=None, sort=None, limit=None):
+    """List deals by recency, optionally filtered by time, customer and search term (see _list_by_time)."""
+    return _list_by_time(_deals, _deal_matches, search_term, customer_id,
+                         updated_since, created_between, sort, limit)
 
 def get_deal(deal_id):
     """Get a deal by ID."""
-    deals = get_all_deals()
-    for deal in deals:
-        if deal.get('id') == deal_id:
-            return deal
-    return None
+    deal = _deals.get(deal_id)
+    return deal.to_dict() if deal else None
+
+def get_deals_for_customer(customer_id):
+    """Get all deals belonging to a customer."""
+    return [deal.to_dict() for deal in _for_customer(_deals, customer_id)]
+
+def get_deals(deal_ids):
+    """Get several deals by ID, in the order given, skipping any that don't exist."""
+    return _get_many(_deals, deal_ids)
 
 def create_deal(data):
     """Create a new deal."""
-    deals = get_all_deals()
-    
     # Verify customer exists
     customer_id = data.get('customer_id')
     if not get_customer(customer_id):
@@ -278,80 +541,64 @@ def create_deal(data):
         'updated_at': datetime.now().isoformat()
     }
     
-    deals.append(new_deal)
-    
-    with open(DEALS_FILE, 'w') as f:
-        json.dump(deals, f, indent=2)
+    _put(_deals, new_deal, 'create')
     
     return new_deal
 
 def update_deal(deal_id, data):
     """Update an existing deal."""
-    deals = get_all_deals()
-    
-    for i, deal in enumerate(deals):
-        if deal.get('id') == deal_id:
-            # Update deal data while preserving id and created_at
-            deals[i].update({
-                'title': data.get('title', deal['title']),
-                'amount': data.get('amount', deal['amount']),
-                'status': data.get('status', deal['status']),
-                'expected_close_date': data.get('expected_close_date', deal.get('expected_close_date', '')),
-                'description': data.get('description', deal.get('description', '')),
-                'updated_at': datetime.now().isoformat()
-            })
-            
-            # Only update customer_id if provided and valid
-            if 'customer_id' in data:
-                customer_id = data['customer_id']
-                if not get_customer(customer_id):
-                    raise ValueError(f"Customer with ID {customer_id} not found")
-                deals[i]['customer_id'] = customer_id
-            
-            with open(DEALS_FILE, 'w') as f:
-                json.dump(deals, f, indent=2)
-            
-            return deals[i]
+    with _deals.lock:
+        existing = _deals.get(deal_id)
+        if existing is None:
+            raise ValueError(f"Deal with ID {deal_id} not found")
+        
+        # Update deal data while preserving id and created_at
+        deal = existing.to_dict()
+        deal.update({
+            'title': data.get('title', deal['title']),
+            'amount': data.get('amount', deal['amount']),
+            'status': data.get('status', deal['status']),
+            'expected_close_date': data.get('expected_close_date', deal.get('expected_close_date', '')),
+            'description': data.get('description', deal.get('description', '')),
+            'updated_at': datetime.now().isoformat()
+        })
+        
+        # Only update customer_id if provided and valid
+        if 'customer_id' in data:
+            customer_id = data['customer_id']
+            if not get_customer(customer_id):
+                raise ValueError(f"Customer with ID {customer_id} not found")
+            deal['customer_id'] = customer_id
+        
+        _put(_deals, deal, 'update')
     
-    raise ValueError(f"Deal with ID {deal_id} not found")
+    return deal
 
 def delete_deal(deal_id):
     """Delete a deal."""
-    deals = get_all_deals()
-    
-    initial_count = len(deals)
-    deals = [d for d in deals if d.get('id') != deal_id]
+    deleted = _remove(_deals, 'id', deal_id)
     
-    if len(deals) == initial_count:
+    if not deleted:
         raise ValueError(f"Deal with ID {deal_id} not found")
     
-    with open(DEALS_FILE, 'w') as f:
-        json.dump(deals, f, indent=2)
-    
     return True
 
 def delete_related_deals(customer_id):
     """Delete all deals related to a customer."""
-    deals = get_all_deals()
-    deals = [d for d in deals if d.get('customer_id') != customer_id]
-    
-    with open(DEALS_FILE, 'w') as f:
-        json.dump(deals, f, indent=2)
+    _remove(_deals, 'customer_id', customer_id)
 
-def search_deals(search_term):
-    """Search deals by title, status, or description."""
-    deals = get_all_deals()
-    search_term = search_term.lower()
-    
-    results = []
-    for deal in deals:
-        if (search_term in deal.get('title', '').lower() or
+def _deal_matches(deal, search_term):
+    return (search_term in deal.get('title', '').lower() or
             search_term in deal.get('status', '').lower() or
             search_term in deal.get('description', '').lower() or
-            search_term in str(deal.get('amount', '')).lower()):
-            results.append(deal)
+            search_term in str(deal.get('amount', '')).lower())
+
+def search_deals(search_term):
+    """Search deals by title, status, or description."""
+    deals = _deals.records()
     
-    return results
+    with _scan_timer('deals'):
+        return [deal.to_dict() for deal in deals.filter(_deal_matches, search_term.lower())]
 
 def find_customer_by_phone(phone_number):
     """Find a customer by exact phone number match.
@@ -365,37 +612,270 @@ def find_customer_by_phone(phone_number):
     Returns:
         dict: Customer record if found, None otherwise
     """
-    customers = get_all_customers()
+    customers = _customers.records()
     
     # Clean the phone number (remove non-numeric characters)
     clean_phone = ''.join(filter(str.isdigit, phone_number)) if phone_number else ''
     
-    # First try exact match
-    for customer in customers:
-        customer_phone = ''.join(filter(str.isdigit, customer.get('phone', '')))
-        if clean_phone and customer_phone and clean_phone == customer_phone:
-            return customer
-            
-    # If no exact match, try matching the last 7-10 digits (ignore country codes)
-    if len(clean_phone) >= 7:
-        matching_end = clean_phone[-min(10, len(clean_phone)):]
+    with _scan_timer('customers'):
+        # First try exact match
         for customer in customers:
             customer_phone = ''.join(filter(str.isdigit, customer.get('phone', '')))
-            if len(customer_phone) >= 7 and customer_phone.endswith(matching_end):
-                return customer
+            if clean_phone and customer_phone and clean_phone == customer_phone:
+                return customer.to_dict()
+            
+        # If no exact match, try matching the last 7-10 digits (ignore country codes)
+        if len(clean_phone) >= 7:
+            matching_end = clean_phone[-min(10, len(clean_phone)):]
+            for customer in customers:
+                customer_phone = ''.join(filter(str.isdigit, customer.get('phone', '')))
+                if len(customer_phone) >= 7 and customer_phone.endswith(matching_end):
+                    return customer.to_dict()
                 
     return None
 
+# Query functions
+_QUERY_COLLECTIONS = {'customers': _customers, 'contacts': _contacts, 'deals': _deals}
+# Fields the query planner can look up by value, with the aggregate indexing
+# each; every collection can also look up an id directly
+_QUERY_INDEXES = {
+    'customers': {'industry': 'by_industry'},
+    'contacts': {'customer_id': 'by_customer'},
+    'deals': {'customer_id': 'by_customer', 'status': 'by_status'}
+}
+
+def _lookup_terms(terms, join=None):
+    """Get the terms comparing a field (of the joined record, if join is set) to a string with =."""
+    return [term for term in terms if isinstance(term, query.Comparison) and term.join == join and
+            term.op == '=' and isinstance(term.value, str)]
+
+def _index_keys(collection, entity, term):
+    """Get the keys of the records an index finds for an = term, or None if no index covers its field.
+    
+    Hold collection.lock while calling this and using the keys.
+    """
+    if term.field == 'id':
+        return (collection.key(term.value),)
+    name = _QUERY_INDEXES[entity].get(term.field)
+    if name is None:
+        return None
+    encode = collection.record_class.CODECS.get(term.field, (None, None))[0]
+    return collection.aggregate(name).get(term.value if encode is None else encode(term.value))
+
+def _plan(collection, entity, terms):
+    """Find the records of the most selective index lookup among the terms that must all hold.
+    
+    Returns:
+        tuple: (field looked up, candidate records), or None if no index applies
+    """
+    # Customers for joined terms are found first, so only one lock is held at a time
+    joined = []
+    if 'customer' in query.JOINS.get(entity, {}):
+        for term in _lookup_terms(terms, 'customer'):
+            if term.field == 'id':
+                joined.append((term, [encode_id(term.value)]))
+                continue
+            with _customers.lock:
+                keys = _index_keys(_customers, 'customers', term)
+                if keys is None:
+                    continue
+                view = _customers.records()
+                joined.append((term, [customer.raw('id') for customer in map(view.get, keys) if customer is not None]))
+    
+    with collection.lock:
+        options = []
+        for term in _lookup_terms(terms):
+            keys = _index_keys(collection, entity, term)
+            if keys is not None:
+                options.append((term.field, keys))
+        if joined:
+            by_customer = collection.aggregate('by_customer')
+            for term, customer_ids in joined:
+                keys = [key for customer_id in customer_ids for key in by_customer.get(customer_id)]
+                options.append((f'customer.{term.field}', keys))
+        if not options:
+            return None
+        field, keys = min(options, key=lambda option: len(option[1]))
+        view = collection.records()
+        return field, [record for record in map(view.get, keys) if record is not None]
+
+def query_records(entity, expression, limit=None):
+    """Find the records of one entity matching a filter expression (see query.py).
+    
+    The whole expression is checked against the records found by the most
+    selective index lookup among its = terms (on id, customer_id, deal
+    status or customer industry, directly or on the joined customer), or
+    against every record when no index applies.
+    
+    Args:
+        entity (str): 'customers', 'contacts' or 'deals'
+        expression (str): The filter expression
+        limit (int): Maximum number of records to return
+        
+    Returns:
+        dict: {'entity', 'plan', 'count', 'results'}; count is before the limit, results are oldest first
+        
+    Raises:
+        query.QueryError: If the entity or expression is invalid
+    """
+    tree = query.parse(expression, entity)
+    collection = _QUERY_COLLECTIONS[entity]
+    
+    with metrics.timer('crm_datastore_operation_seconds', collection=collection.name, op='query'):
+        planned = _plan(collection, entity, query.conjuncts(tree))
+        if planned is None:
+            view, customers = snapshot(collection, _customers)
+            field, candidates = None, view
+        else:
+            customers = _customers.records()
+            field, candidates = planned
+        
+        found = {}
+        def customer_of(record):
+            customer_id = record.raw('customer_id')
+            if customer_id not in found:
+                found[customer_id] = customers.get(record_key(customer_id))
+            return found[customer_id]
+        
+        matches = sorted(filter(query.predicate(tree, {'customer': customer_of}), candidates), key=_created)
+    
+    return {
+        'entity': entity,
+        'plan': {'index': field, 'examined': len(candidates)},
+        'count': len(matches),
+        'results': [record.to_dict() for record in matches[:limit]]
+    }
+
+# Advanced search
+# Free-text fields searched by advanced_search, per entity
+_TEXT_FIELDS = {'customers': ('notes',), 'contacts': ('notes',), 'deals': ('description',)}
+MAX_PATTERN_LENGTH = 500
+
+def _text_matches(record, fields, pattern, terms):
+    text = '\n'.join(record.get(field) or '' for field in fields)
+    if pattern is not None and not pattern.search(text):
+        return False
+    if terms:
+        text = text.casefold()
+        return all(term in text for term in terms)
+    return True
+
+def advanced_search(entities=None, pattern=None, terms=None, limit=100, timeout=10):
+    """Search the notes of customers and contacts and the descriptions of deals.
+    
+    Records are matched by a regular expression, by terms that must all
+    appear, or both, ignoring case. Each collection is scanned from one
+    point-in-time snapshot in ranges (see CollectionView.scan), in parallel
+    when CRM_SCAN_WORKERS is set, and matches are yielded as they are found
+    rather than in collection order.
+    
+    Args:
+        entities (list): Any of 'customers', 'contacts' and 'deals' (default all)
+        pattern (str): A regular expression
+        terms (list): Words or phrases that must all appear
+        limit (int): Stop after this many matches
+        timeout (float): Stop after this many seconds
+        
+    Returns:
+        iterator: {'entity', 'record'} for each match, then one
+        {'done': True, 'count', 'truncated', 'timed_out', 'elapsed'} summary
+        
+    Raises:
+        ValueError: If the entities, pattern or terms are invalid (raised
+            at the call, before anything is searched)
+    """
+    entities = list(entities or _TEXT_FIELDS)
+    unknown = [entity for entity in entities if entity not in _TEXT_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown entity {unknown[0]!r}; expected {', '.join(_TEXT_FIELDS)}")
+    terms = [term.casefold() for term in terms or () if term.strip()]
+    if not pattern and not terms:
+        raise ValueError("A pattern or at least one term is required")
+    if pattern and len(pattern) > MAX_PATTERN_LENGTH:
+        raise ValueError(f"Patterns are limited to {MAX_PATTERN_LENGTH} characters")
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE) if pattern else None
+    except re.error as e:
+        raise ValueError(f"Invalid pattern: {e}")
+    
+    return _advanced_search(entities, compiled, terms, limit, timeout)
+
+def _advanced_search(entities, pattern, terms, limit, timeout):
+    started = time.monotonic()
+    collections = [_QUERY_COLLECTIONS[entity] for entity in entities]
+    views = snapshot(*collections)
+    count = 0
+    timed_out = False
+    
+    try:
+        for entity, view in zip(entities, views):
+            remaining = timeout - (time.monotonic() - started)
+            scan = view.scan(_text_matches, _TEXT_FIELDS[entity], pattern, terms, timeout=max(0, remaining))
+            try:
+                for hits in scan:
+                    for record in hits[:limit - count]:
+                        yield {'entity': entity, 'record': record.to_dict()}
+                    count += min(len(hits), limit - count)
+                    if count >= limit:
+                        break
+            finally:
+                scan.close()
+            if count >= limit:
+                break
+    except TimeoutError:
+        timed_out = True
+    
+    yield {
+        'done': True,
+        'count': count,
+        'truncated': count >= limit,
+        'timed_out': timed_out,
+        'elapsed': round(time.monotonic() - started, 3)
+    }
+
+# Dashboard statistics
+def get_stats(customer_id=None, per_customer=False):
+    """Get record counts and deal totals without scanning the deals.
+
+    Deal totals are maintained incrementally as deals change.
+
+    Args:
+        customer_id (str): Also return the deal totals for this customer
+        per_customer (bool): Also return the deal totals for every customer
+
+    Returns:
+        dict: Counts per entity, deal totals per status and any per-customer totals
+    """
+    stats = {
+        'counts': {
+            'customers': len(_customers.records()),
+            'contacts': len(_contacts.records())
+        }
+    }
+    with _deals.lock:
+        totals = _deals.aggregate('totals')
+        stats['counts']['deals'] = len(_deals.records())
+        stats['deals_by_status'] = totals.status_totals()
+        if customer_id:
+            stats['customer'] = dict(totals.customer_totals(encode_id(customer_id)), customer_id=customer_id)
+        if per_customer:
+            stats['deals_by_customer'] = totals.all_customer_totals()
+    return stats
+
 # Backup function
 def backup_data(timestamp):
-    """Create a backup of all data files."""
-    backup_dir = f'data/backup/{timestamp}'
-    os.makedirs(backup_dir, exist_ok=True)
+    """Create an incremental backup of all data files and apply retention.
     
-    # Copy all data files to backup directory
-    for file_name in ['customers.json', 'contacts.json', 'deals.json', 'users.json']:
-        source_path = f'data/{file_name}'
-        if os.path.exists(source_path):
-            shutil.copy2(source_path, f'{backup_dir}/{file_name}')
-    
-    return backup_dir
+    The collections are backed up from one point-in-time snapshot rather
+    than from their files, so the backup never mixes a change to one
+    collection with an older version of another.
+    """
+    collections = (_customers, _contacts, _deals)
+    views = snapshot(*collections)
+    backup.create_snapshot(
+        timestamp,
+        sources={os.path.basename(collection.file_path): view.json() for collection, view in zip(collections, views)},
+        events_offset=min(view.position for view in views)
+    )
+    backup.prune_snapshots()
+    return f'{backup.BACKUP_DIR}/{timestamp}'
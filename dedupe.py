@@ -0,0 +1,265 @@
+import os
+import re
+from collections import Counter
+from mapped import record_key
+
+# Duplicate customer detection.
+#
+# Customers are indexed under blocking keys: their normalized phone number,
+# normalized email address and normalized name, plus each trigram of the
+# name. Only customers sharing a key are ever scored against each other, so
+# checking one new customer touches a few small blocks instead of the whole
+# collection, and the batch report avoids comparing every pair.
+#
+# The index is a collection aggregate (see store.Collection.aggregate): it is
+# built with one scan and kept current as customers change.
+
+# Trigram blocks bigger than this are too common to narrow anything down
+MAX_BLOCK = int(os.environ.get('CRM_DEDUPE_MAX_BLOCK', '200'))
+# Fraction of a name's trigrams a candidate must share to be scored
+MIN_SHARED_TRIGRAMS = 0.5
+
+# Evidence weights; pairs scoring at least LIKELY_DUPLICATE are reported
+PHONE_WEIGHT = 0.5
+EMAIL_WEIGHT = 0.5
+NAME_WEIGHT = 0.6
+LIKELY_DUPLICATE = 0.6
+
+# Suffixes that don't tell two companies apart
+_NAME_NOISE = frozenset(['inc', 'llc', 'ltd', 'co', 'corp', 'corporation', 'company', 'plc', 'gmbh', 'the'])
+_NON_WORD = re.compile(r'[^0-9a-z]+')
+
+def normalize_phone(value):
+    """Get the last 10 digits of a phone number, or None if it has fewer than 7."""
+    digits = ''.join(filter(str.isdigit, value)) if isinstance(value, str) else ''
+    return digits[-10:] if len(digits) >= 7 else None
+
+def normalize_email(value):
+    """Lowercase an email address and drop any +tag, or None if it isn't one."""
+    if not isinstance(value, str) or value.count('@') != 1:
+        return None
+    local, domain = value.strip().lower().split('@')
+    local = local.split('+', 1)[0]
+    return f'{local}@{domain}' if local and domain else None
+
+def normalize_name(value):
+    """Lowercase a name, drop punctuation and legal suffixes, or None if nothing is left."""
+    if not isinstance(value, str):
+        return None
+    words = [word for word in _NON_WORD.split(value.lower()) if word and word not in _NAME_NOISE]
+    return ' '.join(words) or None
+
+def trigrams(name):
+    """Get the set of trigrams of a normalized name, padded so short names still have some."""
+    if not name:
+        return frozenset()
+    padded = f'  {name} '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def features(data):
+    """Get the normalized (phone, email, name, name trigrams) of a customer record or dict."""
+    name = normalize_name(data.get('name'))
+    return normalize_phone(data.get('phone')), normalize_email(data.get('email')), name, trigrams(name)
+
+def score(a, b):
+    """Score how likely two customers are the same, given their features().
+
+    Returns:
+        tuple: (score between 0 and 1, list of the fields that matched)
+    """
+    phone_a, email_a, _, grams_a = a
+    phone_b, email_b, _, grams_b = b
+    total, reasons = 0.0, []
+    if phone_a and phone_a == phone_b:
+        total += PHONE_WEIGHT
+        reasons.append('phone')
+    if email_a and email_a == email_b:
+        total += EMAIL_WEIGHT
+        reasons.append('email')
+    if grams_a and grams_b:
+        similarity = len(grams_a & grams_b) / len(grams_a | grams_b)
+        total += NAME_WEIGHT * similarity
+        if similarity >= 0.5:
+            reasons.append('name')
+    return min(total, 1.0), reasons
+
+def _exact_keys(phone, email, name):
+    return [block_key for block_key in (phone and 'phone:' + phone, email and 'email:' + email,
+                                        name and 'name:' + name) if block_key]
+
+class DuplicateIndex:
+    """Blocking index from normalized keys and name trigrams to customer keys
+
+    exact maps 'phone:<digits>', 'email:<address>' and 'name:<name>' to the
+    key of the one customer with that value, or a set of keys when several
+    share it. grams maps a trigram to the keys of the customers whose name
+    has it, until more than MAX_BLOCK do: from then on only the count is
+    kept, since so common a trigram is never used to find candidates. That
+    keeps the index small when names are built from common words.
+    """
+
+    def __init__(self):
+        self.exact = {}
+        self.grams = {}
+
+    def add(self, record):
+        key = record_key(record.raw('id'))
+        phone, email, name, grams = features(record)
+        for block_key in _exact_keys(phone, email, name):
+            block = self.exact.get(block_key)
+            if block is None:
+                self.exact[block_key] = key
+            elif isinstance(block, bytes):
+                self.exact[block_key] = {block, key}
+            else:
+                block.add(key)
+        for gram in grams:
+            block = self.grams.get(gram)
+            if block is None:
+                self.grams[gram] = {key}
+            elif isinstance(block, int):
+                self.grams[gram] = block + 1
+            else:
+                block.add(key)
+                if len(block) > MAX_BLOCK:
+                    self.grams[gram] = len(block)
+
+    def remove(self, record):
+        key = record_key(record.raw('id'))
+        phone, email, name, grams = features(record)
+        for block_key in _exact_keys(phone, email, name):
+            block = self.exact.get(block_key)
+            if block == key:
+                del self.exact[block_key]
+            elif isinstance(block, set):
+                block.discard(key)
+                if len(block) == 1:
+                    self.exact[block_key] = block.pop()
+        for gram in grams:
+            block = self.grams.get(gram)
+            if isinstance(block, int):
+                if block > 1:
+                    self.grams[gram] = block - 1
+                else:
+                    del self.grams[gram]
+            elif block is not None:
+                block.discard(key)
+                if not block:
+                    del self.grams[gram]
+
+    def exact_blocks(self):
+        """Yield the set of keys of each exact block shared by several customers."""
+        for block in self.exact.values():
+            if isinstance(block, set):
+                yield block
+
+    def similar_names(self, grams):
+        """Get the keys of customers sharing enough of a name's uncommon trigrams."""
+        if not grams:
+            return set()
+        shared = Counter()
+        for gram in grams:
+            block = self.grams.get(gram)
+            if block and not isinstance(block, int):
+                shared.update(block)
+        needed = len(grams) * MIN_SHARED_TRIGRAMS
+        return {key for key, count in shared.items() if count >= needed}
+
+    def candidates(self, features):
+        """Get the keys of customers sharing a block with the given features().
+
+        Customers sharing a phone, email or name are always candidates; by
+        trigrams, only those sharing enough of the name's uncommon trigrams.
+        """
+        phone, email, name, grams = features
+        found = self.similar_names(grams)
+        for block_key in _exact_keys(phone, email, name):
+            block = self.exact.get(block_key)
+            if isinstance(block, bytes):
+                found.add(block)
+            elif block:
+                found.update(block)
+        return found
+
+def find_matches(data, index, view, exclude=None, threshold=LIKELY_DUPLICATE):
+    """Score the indexed customers that could be duplicates of data.
+
+    Args:
+        data (dict): The customer to check
+        index (DuplicateIndex): Index over view
+        view: Current customers view, to fetch candidates by key
+        exclude (bytes): Key of a customer to leave out, such as data itself
+
+    Returns:
+        list: (score, reasons, record) tuples at or above threshold, best first
+    """
+    probe = features(data)
+    matches = []
+    for key in index.candidates(probe):
+        if key == exclude:
+            continue
+        record = view.get(key)
+        if record is None:
+            continue
+        value, reasons = score(probe, features(record))
+        if value >= threshold:
+            matches.append((value, reasons, record))
+    matches.sort(key=lambda match: -match[0])
+    return matches
+
+def find_clusters(index, view, threshold=LIKELY_DUPLICATE):
+    """Group every customer with the candidates it scores as a likely duplicate of.
+
+    Pairs are linked transitively, so a cluster can hold customers that only
+    match through a third one. Within an exact block each customer is scored
+    against one member of each cluster found in the block so far rather than
+    against every member, which keeps big blocks (a shared switchboard number,
+    a generic info@ address) linear.
+
+    Returns:
+        list: Clusters of records, largest first, each with at least two records
+    """
+    records, found = {}, {}
+    for record in view:
+        key = record_key(record.raw('id'))
+        records[key] = record
+        found[key] = features(record)
+
+    parent = {}
+
+    def root(key):
+        while key in parent:
+            # Point every other node on the path at its grandparent, so chains stay short
+            grandparent = parent.get(parent[key])
+            if grandparent is not None:
+                parent[key] = grandparent
+            key = parent[key]
+        return key
+
+    def link(key, other):
+        own_root, other_root = root(key), root(other)
+        if own_root != other_root and score(found[key], found[other])[0] >= threshold:
+            parent[other_root] = own_root
+
+    for block in index.exact_blocks():
+        representatives = {}
+        for key in block:
+            if key not in found:
+                continue
+            for other in list(representatives.values()):
+                link(key, other)
+            representatives = {root(other): other for other in representatives.values()}
+            representatives.setdefault(root(key), key)
+
+    for key, own in found.items():
+        for other in index.similar_names(own[3]):
+            # Each pair is seen from both sides; score it once
+            if other < key and other in found:
+                link(key, other)
+
+    clusters = {}
+    for key in parent:
+        clusters.setdefault(root(key), []).append(records[key])
+    for cluster_root, members in clusters.items():
+        members.append(records[cluster_root])
+    return sorted(clusters.values(), key=len, reverse=True)
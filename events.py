@@ -0,0 +1,256 @@
+import json
+import os
+import time
+import shutil
+import logging
+import threading
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are still O_APPEND, just not flock-guarded
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Append-only change log shared by every worker process
+EVENTS_FILE = 'data/events.log'
+
+# Compaction drops the oldest events but leaves every offset unchanged: the
+# compacted file starts with a header line giving the offset of its first
+# event, and offsets count on from there as though nothing had been dropped.
+HEADER_PREFIX = b'#first '
+HEADER_SIZE = len(HEADER_PREFIX) + 21  # 20 digits and a newline
+
+# How far truncate() reads back at a time looking for the end of an event
+READ_BACK_BYTES = 64 * 1024
+
+# (st_dev, st_ino, first offset, header size, open file) for the log file
+# last seen at EVENTS_FILE. Holding the file open keeps its inode from being
+# reused by a later compacted file.
+_log = None
+_log_lock = threading.Lock()
+
+# How often followers check the log for new events, and how often they send
+# a keep-alive when nothing has changed (seconds)
+POLL_INTERVAL = 0.5
+HEARTBEAT_INTERVAL = 15
+
+def publish(entity, action, record):
+    """Append a mutation event to the shared change log.
+
+    Each event is one JSON line. Followers use the byte offset just past the
+    line as the event id, so a reconnecting client can resume exactly where
+    it left off.
+
+    Args:
+        entity (str): 'customer', 'contact' or 'deal'
+        action (str): 'create', 'update' or 'delete'
+        record (dict): The record after the change (before it, for deletes)
+
+    Raises:
+        OSError: If the event couldn't be written
+    """
+    publish_many(entity, [(action, record)])
+
+def publish_many(entity, changes):
+    """Append several mutation events to the change log in one write.
+
+    The events are stored in order and back to back, as publish() would.
+    Other workers only learn of a change from the log, so a failure to
+    write it is raised for the change to fail rather than logged.
+
+    Args:
+        entity (str): 'customer', 'contact' or 'deal'
+        changes (list): (action, record) tuples
+
+    Raises:
+        OSError: If the events couldn't be written
+    """
+    ts = datetime.now().isoformat()
+    data = b''.join(
+        (json.dumps({'ts': ts, 'entity': entity, 'action': action, 'id': record.get('id'), 'record': record},
+                    separators=(',', ':')) + '\n').encode('utf-8')
+        for action, record in changes
+    )
+    if not data:
+        return
+
+    try:
+        while True:
+            with open(EVENTS_FILE, 'ab') as f:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if fcntl and os.fstat(f.fileno()).st_nlink == 0:
+                        # Compacted and replaced while we waited for the lock
+                        continue
+                    f.write(data)
+                    f.flush()
+                    break
+                finally:
+                    if fcntl:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+    except OSError as e:
+        logger.error(f"Failed to publish {len(changes)} {entity} events: {str(e)}")
+        raise
+
+def _header(f):
+    """Read (first offset, header size) from the start of an open log file."""
+    f.seek(0)
+    head = f.read(HEADER_SIZE)
+    if len(head) == HEADER_SIZE and head.startswith(HEADER_PREFIX):
+        return int(head[len(HEADER_PREFIX):]), HEADER_SIZE
+    return 0, 0
+
+def _current():
+    """Get (first offset, header size, file size) for the log file now at EVENTS_FILE."""
+    global _log
+    try:
+        stat = os.stat(EVENTS_FILE)
+    except OSError:
+        return 0, 0, 0
+    log = _log
+    if log is not None and log[:2] == (stat.st_dev, stat.st_ino):
+        return log[2], log[3], stat.st_size
+
+    with _log_lock:
+        try:
+            f = open(EVENTS_FILE, 'rb')
+        except OSError:
+            return 0, 0, 0
+        stat = os.fstat(f.fileno())
+        previous, _log = _log, (stat.st_dev, stat.st_ino) + _header(f) + (f,)
+        if previous is not None:
+            previous[4].close()
+        return _log[2], _log[3], stat.st_size
+
+def current_offset():
+    """Get the offset of the end of the change log."""
+    first, header_size, size = _current()
+    return first + size - header_size
+
+def first_offset():
+    """Get the offset of the oldest event still in the change log."""
+    return _current()[0]
+
+def read_events(offset=0, max_bytes=None):
+    """Read all complete events written at or after a byte offset.
+
+    Events before first_offset() have been compacted away, so reading from
+    an older offset starts at the oldest event kept.
+
+    Args:
+        offset (int): Where to start reading
+        max_bytes (int): Stop after about this many bytes (at the end of the
+            event they reach into), so a reader far behind catches up in pieces
+
+    Returns:
+        list: (next_offset, event) tuples in log order
+    """
+    try:
+        with open(EVENTS_FILE, 'rb') as f:
+            first, header_size = _header(f)
+            offset = max(offset, first)
+            f.seek(offset - first + header_size)
+            if max_bytes is None:
+                chunk = f.read()
+            else:
+                chunk = f.read(max_bytes)
+                if chunk and not chunk.endswith(b'\n'):
+                    chunk += f.readline()
+    except OSError:
+        return []
+
+    events = []
+    position = offset
+    for line in chunk.splitlines(keepends=True):
+        # A line without its newline is still being written by another worker
+        if not line.endswith(b'\n'):
+            break
+        position += len(line)
+        try:
+            events.append((position, json.loads(line)))
+        except json.JSONDecodeError:
+            logger.warning(f"Skipping malformed event ending at offset {position}")
+    return events
+
+def follow(offset, max_seconds=None):
+    """Yield events as they are appended to the change log.
+
+    Yields (next_offset, event) tuples, or (offset, None) as a keep-alive when
+    no event has arrived for HEARTBEAT_INTERVAL seconds. Stops after
+    max_seconds so long-lived streams hand their worker back periodically.
+    """
+    started = time.monotonic()
+    last_sent = started
+
+    while max_seconds is None or time.monotonic() - started < max_seconds:
+        # A reader resuming from before a compaction carries on from what is left
+        offset = max(offset, first_offset())
+        if current_offset() > offset:
+            for offset, event in read_events(offset):
+                last_sent = time.monotonic()
+                yield offset, event
+        elif time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+            last_sent = time.monotonic()
+            yield offset, None
+
+        time.sleep(POLL_INTERVAL)
+
+def truncate(before):
+    """Drop the events before an offset from the change log.
+
+    The events kept are copied to a new file that replaces the log, keeping
+    their offsets. Most of the copy is made without the log's lock; only
+    what was appended meanwhile is copied under it, so publishers wait for
+    the tail rather than the whole log. Without flock this does nothing.
+
+    Args:
+        before (int): Keep the events from here on, or from the start of the
+            event this falls inside
+
+    Returns:
+        int: Bytes of events dropped
+    """
+    if fcntl is None:
+        return 0
+    temp_path = f'{EVENTS_FILE}.compact-{os.getpid()}'
+    try:
+        with open(EVENTS_FILE, 'rb') as f:
+            first, header_size = _header(f)
+            # Back up to the end of the last complete event before the cut
+            position = max(0, min(before - first, os.fstat(f.fileno()).st_size - header_size))
+            while position > 0:
+                start = max(0, position - READ_BACK_BYTES)
+                f.seek(header_size + start)
+                newline = f.read(position - start).rfind(b'\n')
+                if newline != -1:
+                    position = start + newline + 1
+                    break
+                position = start
+            before = first + position
+            if before <= first:
+                return 0
+            f.seek(header_size + position)
+
+            with open(temp_path, 'wb') as out:
+                out.write(HEADER_PREFIX + b'%020d\n' % before)
+                shutil.copyfileobj(f, out)
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(f.fileno()).st_nlink == 0:
+                        # Another worker compacted it first
+                        return 0
+                    shutil.copyfileobj(f, out)
+                    out.flush()
+                    os.fsync(out.fileno())
+                    os.replace(temp_path, EVENTS_FILE)
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+    except FileNotFoundError:
+        return 0
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return before - first
@@ -1,8 +1,269 @@
 import os
+import re
 import json
-import requests
+import math
+import time
+import threading
+import metrics
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+class _Flight:
+    """One load in progress, shared by every caller asking for the same key"""
+    
+    __slots__ = ('done', 'value', 'error')
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class ReferenceDataCache:
+    """Thread-safe TTL + LRU cache with stale-while-revalidate refresh
+    
+    Entries younger than ttl are served directly. Entries older than ttl but
+    younger than stale_ttl are served immediately while a background thread
+    reloads them, so callers never wait on Genesys for data we already have.
+    Misses are single-flight: callers asking for a key that is already being
+    loaded wait for that load instead of making the same call again.
+    """
+    
+    def __init__(self, max_entries=256, ttl=300, stale_ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._entries = OrderedDict()  # key -> (value, loaded_at)
+        self._refreshing = set()
+        self._loading = {}  # key -> _Flight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.evictions = 0
+    
+    def get(self, key, loader):
+        """Get a cached value, calling loader() to fetch it when needed"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, loaded_at = entry
+                age = now - loaded_at
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if age < self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    if key not in self._refreshing:
+                        self._refreshing.add(key)
+                        threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                    return value
+            flight = self._loading.get(key)
+            if flight is None:
+                flight = self._loading[key] = _Flight()
+                self.misses += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        
+        try:
+            flight.value = loader()
+            self._store(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+            flight.done.set()
+    
+    def _refresh(self, key, loader):
+        """Reload a stale entry in the background"""
+        try:
+            value = loader()
+            if self._store(key, value):
+                with self._lock:
+                    self.refreshes += 1
+            else:
+                with self._lock:
+                    self.refresh_errors += 1
+        except Exception:
+            with self._lock:
+                self.refresh_errors += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+    
+    def _store(self, key, value):
+        """Cache a successful result, evicting the least recently used entries"""
+        # API failures come back as {'error': ...}; never cache those
+        if isinstance(value, dict) and 'error' in value:
+            return False
+        
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return True
+    
+    def clear(self):
+        """Drop all cached entries"""
+        with self._lock:
+            self._entries.clear()
+    
+    def stats(self):
+        """Get hit/miss counters for monitoring"""
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'stale_ttl_seconds': self.stale_ttl,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_ratio': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+                'refreshes': self.refreshes,
+                'refresh_errors': self.refresh_errors,
+                'evictions': self.evictions
+            }
+
+class CircuitBreaker:
+    """Fails calls fast while an upstream keeps failing, letting a probe through now and then
+    
+    The circuit opens after failure_threshold failures in a row, and calls
+    are refused at once instead of each waiting out another slow failure.
+    Every reset_timeout seconds while open, one call is let through as a
+    probe (half-open): if it succeeds the circuit closes, and if it fails
+    the circuit stays open for another reset_timeout.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self.opens = 0
+        self.probes = 0
+        self.fast_failures = 0
+    
+    def allow(self):
+        """Tell whether a call may go ahead, admitting a probe when one is due"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at >= self.reset_timeout:
+                # The probe re-arms the timer, so only one goes through per interval
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                self.probes += 1
+                return True
+            self.fast_failures += 1
+            return False
+    
+    def retry_after(self):
+        """Get the seconds until the next probe is let through (0 when closed)"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            return max(0, self.reset_timeout - (time.monotonic() - self._opened_at))
+    
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self.state == self.CLOSED:
+                    self.opens += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+    
+    def stats(self):
+        """Get the state and counters for monitoring"""
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self._failures,
+                'failure_threshold': self.failure_threshold,
+                'reset_timeout_seconds': self.reset_timeout,
+                'opens': self.opens,
+                'probes': self.probes,
+                'fast_failures': self.fast_failures
+            }
+
+# Users and queues change rarely, so one cache is shared by every
+# GenesysCloudIntegration instance in the worker
+reference_cache = ReferenceDataCache(
+    max_entries=int(os.environ.get('GENESYS_CACHE_MAX_ENTRIES', 256)),
+    ttl=float(os.environ.get('GENESYS_CACHE_TTL', 300)),
+    stale_ttl=float(os.environ.get('GENESYS_CACHE_STALE_TTL', 3600))
+)
+
+# Contacts and interactions change often, so they are only cached for a
+# moment: enough to share one call among agents opening the same record
+live_cache = ReferenceDataCache(
+    max_entries=int(os.environ.get('GENESYS_LIVE_CACHE_MAX_ENTRIES', 1024)),
+    ttl=float(os.environ.get('GENESYS_LIVE_CACHE_TTL', 2)),
+    stale_ttl=float(os.environ.get('GENESYS_LIVE_CACHE_TTL', 2))
+)
+
+# Shared by every call from the worker, since they all go to the same region
+circuit = CircuitBreaker(
+    failure_threshold=int(os.environ.get('GENESYS_CIRCUIT_FAILURES', 5)),
+    reset_timeout=float(os.environ.get('GENESYS_CIRCUIT_RESET', 30))
+)
+
+# Seconds to wait for Genesys to connect and to answer each call
+REQUEST_TIMEOUT = float(os.environ.get('GENESYS_TIMEOUT', 10))
+
+# Most Genesys calls a worker has in progress at once. Calls beyond this fail
+# at once, so a slow Genesys can hold at most this many of a worker's threads
+# and the rest stay free for CRM requests; keep it below gunicorn's threads.
+MAX_IN_FLIGHT = int(os.environ.get('GENESYS_MAX_IN_FLIGHT', 8))
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+# Path segments that carry ids are collapsed so metric label cardinality
+# stays bounded (e.g. /api/v2/users/:id)
+_ID_SEGMENT = re.compile(r'/(?=[^/]*\d)[0-9A-Za-z-]{8,}(?=/|$)')
+
+def _endpoint_label(endpoint):
+    return _ID_SEGMENT.sub('/:id', endpoint)
+
+def _upstream_failed(error):
+    """Tell whether a request error means Genesys itself is failing, rather than the request being refused"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return True  # Connection error or timeout
+    return response.status_code >= 500 or response.status_code == 429
+
 class GenesysCloudIntegration:
     """Class for integrating with Genesys Cloud APIs"""
     
@@ -28,7 +289,8 @@ class GenesysCloudIntegration:
             'ap-south-1': 'https://api.aps1.pure.cloud'
         }
         
-        self.base_url = self.base_url_map.get(self.region, 'https://api.mypurecloud.com')
+        # GENESYS_BASE_URL points the integration elsewhere, such as a proxy or a test stub
+        self.base_url = os.environ.get('GENESYS_BASE_URL') or self.base_url_map.get(self.region, 'https://api.mypurecloud.com')
         self.access_token = None
         self.token_expiry = None
     
@@ -57,8 +319,12 @@ class GenesysCloudIntegration:
         # Cast to strings to avoid type issues
         auth = (str(self.client_id), str(self.client_secret))
         
+        # requests is imported on first use so that workers on deployments
+        # without Genesys credentials never pay for loading it
+        import requests
+        
         try:
-            response = requests.post(url, data=payload, auth=auth)
+            response = requests.post(url, data=payload, auth=auth, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
             
             data = response.json()
@@ -76,31 +342,84 @@ class GenesysCloudIntegration:
         if not self.is_configured():
             return {'error': 'Genesys Cloud integration not configured'}
         
-        token = self._get_auth_token()
+        labels = {'method': method.upper(), 'endpoint': _endpoint_label(endpoint)}
+        if not _in_flight.acquire(blocking=False):
+            metrics.inc('crm_genesys_fast_failures_total', reason='busy', **labels)
+            return {'error': 'Too many Genesys Cloud calls in progress; try again shortly', 'retry_after': 1}
+        try:
+            if not circuit.allow():
+                retry_after = math.ceil(circuit.retry_after())
+                metrics.inc('crm_genesys_fast_failures_total', reason='circuit', **labels)
+                return {'error': f'Genesys Cloud is failing; not calling it again for {retry_after}s',
+                        'retry_after': retry_after}
+            return self._send(method, endpoint, params, data, labels)
+        finally:
+            _in_flight.release()
+    
+    def _send(self, method, endpoint, params, data, labels):
+        """Call Genesys Cloud, recording the outcome with the circuit breaker"""
+        import requests
+        
+        try:
+            token = self._get_auth_token()
+        except requests.exceptions.RequestException as e:
+            if _upstream_failed(e):
+                circuit.record_failure()
+            raise
         headers = {
             'Authorization': f'Bearer {token}',
             'Content-Type': 'application/json'
         }
         
         url = f"{self.base_url}{endpoint}"
+        started = time.perf_counter()
         
         try:
             if method.upper() == 'GET':
-                response = requests.get(url, headers=headers, params=params)
+                response = requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
             elif method.upper() == 'POST':
-                response = requests.post(url, headers=headers, json=data)
+                response = requests.post(url, headers=headers, json=data, timeout=REQUEST_TIMEOUT)
             elif method.upper() == 'PUT':
-                response = requests.put(url, headers=headers, json=data)
+                response = requests.put(url, headers=headers, json=data, timeout=REQUEST_TIMEOUT)
             elif method.upper() == 'DELETE':
-                response = requests.delete(url, headers=headers)
+                response = requests.delete(url, headers=headers, timeout=REQUEST_TIMEOUT)
             else:
                 return {'error': f'Unsupported method: {method}'}
             
             response.raise_for_status()
+            circuit.record_success()
+            if method.upper() != 'GET':
+                # Let the caller read its own write
+                live_cache.clear()
             return response.json() if response.content else {'status': 'success'}
         except requests.exceptions.RequestException as e:
             print(f"Genesys Cloud API error: {str(e)}")
+            metrics.inc('crm_genesys_errors_total', **labels)
+            if _upstream_failed(e):
+                circuit.record_failure()
+            else:
+                circuit.record_success()
             return {'error': str(e)}
+        finally:
+            metrics.observe('crm_genesys_request_duration_seconds', time.perf_counter() - started, **labels)
+    
+    def _cached_get(self, endpoint, params=None, cache=reference_cache):
+        """Make a GET request through a shared cache, the reference data cache by default"""
+        key = (self.base_url, self.client_id, endpoint, tuple(sorted((params or {}).items())))
+        return cache.get(key, lambda: self._make_api_request('GET', endpoint, params=params))
+    
+    def _live_get(self, endpoint, params=None):
+        """Make a GET request for data that changes often, through the short-lived cache"""
+        return self._cached_get(endpoint, params=params, cache=live_cache)
+    
+    @staticmethod
+    def cache_stats():
+        """Get reference data cache statistics, plus the live cache, circuit breaker and call limit under their own keys"""
+        stats = reference_cache.stats()
+        stats['live'] = live_cache.stats()
+        stats['circuit'] = circuit.stats()
+        stats['max_in_flight'] = MAX_IN_FLIGHT
+        return stats
     
     # User Management
     def get_users(self, limit=25, page_number=1):
@@ -109,11 +428,11 @@ class GenesysCloudIntegration:
             'pageSize': limit,
             'pageNumber': page_number
         }
-        return self._make_api_request('GET', '/api/v2/users', params=params)
+        return self._cached_get('/api/v2/users', params=params)
     
     def get_user(self, user_id):
         """Get a specific user from Genesys Cloud"""
-        return self._make_api_request('GET', f'/api/v2/users/{user_id}')
+        return self._cached_get(f'/api/v2/users/{user_id}')
     
     # Contact Management
     def get_contacts(self, limit=25, page_number=1):
@@ -123,11 +442,11 @@ class GenesysCloudIntegration:
             'pageNumber': page_number
         }
         # Note: This is an example - actual endpoint may vary based on Genesys Cloud API
-        return self._make_api_request('GET', '/api/v2/externalcontacts/contacts', params=params)
+        return self._live_get('/api/v2/externalcontacts/contacts', params=params)
     
     def get_contact(self, contact_id):
         """Get a specific contact from Genesys Cloud"""
-        return self._make_api_request('GET', f'/api/v2/externalcontacts/contacts/{contact_id}')
+        return self._live_get(f'/api/v2/externalcontacts/contacts/{contact_id}')
     
     def create_contact(self, contact_data):
         """Create a new contact in Genesys Cloud"""
@@ -144,11 +463,11 @@ class GenesysCloudIntegration:
             'pageSize': limit,
             'pageNumber': page_number
         }
-        return self._make_api_request('GET', '/api/v2/analytics/conversations/details', params=params)
+        return self._live_get('/api/v2/analytics/conversations/details', params=params)
     
     def get_interaction(self, interaction_id):
         """Get details of a specific interaction"""
-        return self._make_api_request('GET', f'/api/v2/analytics/conversations/{interaction_id}/details')
+        return self._live_get(f'/api/v2/analytics/conversations/{interaction_id}/details')
     
     # Queue Management
     def get_queues(self, limit=25, page_number=1):
@@ -157,7 +476,7 @@ class GenesysCloudIntegration:
             'pageSize': limit,
             'pageNumber': page_number
         }
-        return self._make_api_request('GET', '/api/v2/routing/queues', params=params)
+        return self._cached_get('/api/v2/routing/queues', params=params)
     
     # Screen Pop Integration
     def get_caller_details(self, phone_number):
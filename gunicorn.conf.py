@@ -0,0 +1,29 @@
+import gc
+import os
+
+# Picked up automatically by `gunicorn main:app` from the project root.
+
+# Import the app once in the master; workers are forked from it and share
+# its memory copy-on-write instead of each importing everything again
+preload_app = True
+
+# Serve each worker's requests from a pool of threads, so a request waiting
+# on Genesys Cloud holds one thread rather than the whole worker and CRM
+# requests keep being answered meanwhile. GENESYS_MAX_IN_FLIGHT keeps
+# Genesys calls to part of the pool; GUNICORN_THREADS=1 serves one request
+# at a time per worker, as the sync worker does.
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '16'))
+
+def on_starting(server):
+    """Open (building if needed) the mapped record files before any worker starts."""
+    import data_manager
+    import metrics
+    # Metrics from an earlier run would be counted again by this one
+    metrics.clear()
+    data_manager.warm_up()
+
+def when_ready(server):
+    # Keep the collector away from everything loaded so far: a GC pass in a
+    # worker would otherwise write to those objects and un-share their pages
+    gc.freeze()
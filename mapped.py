@@ -0,0 +1,183 @@
+import os
+import json
+import mmap
+import shutil
+import struct
+import marshal
+import hashlib
+import tempfile
+from array import array
+
+# Memory-mapped record files.
+#
+# A mapped file holds one collection in a binary form that every worker
+# mmaps read-only, so the records live once in the OS page cache instead of
+# once per worker, and opening a collection costs a few page faults rather
+# than a JSON parse. Layout (native byte order; the files are a local cache
+# rebuilt from the JSON files and never leave the machine):
+#
+#   header     magic, record count and the offset of each section
+#   meta       JSON: source file signature, change log offset, record type
+#   records    marshal'd CompactRecord.to_tuple() per record
+#   fragments  each record pre-rendered exactly as it appears in the JSON file
+#   offsets    (count + 1) uint64 offsets into records, then into fragments
+#   keys       16-byte id key per record, in record order
+#   index      (key, record number) pairs sorted by key, for lookups by id
+
+MAGIC = b'CRMMAP01'
+KEY_SIZE = 16
+_HEADER = struct.Struct('=8s8Q')
+_INDEX_ENTRY = struct.Struct(f'={KEY_SIZE}sQ')
+
+def record_key(encoded_id):
+    """Get the fixed-size key for an encoded record id."""
+    if isinstance(encoded_id, bytes) and len(encoded_id) == KEY_SIZE:
+        return encoded_id
+    return hashlib.blake2b(repr(encoded_id).encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+def render_fragment(data):
+    """Render one record exactly as json.dump(records, f, indent=2) lays it out."""
+    return ('  ' + json.dumps(data, indent=2).replace('\n', '\n  ')).encode('utf-8')
+
+def json_pieces(fragments):
+    """Yield the bytes of rendered records as a JSON array, byte-identical to json.dump(..., indent=2)."""
+    first = True
+    for fragment in fragments:
+        yield b'[\n' if first else b',\n'
+        yield fragment
+        first = False
+    yield b'[]' if first else b'\n]'
+
+def write_fragments(f, fragments):
+    """Write rendered records as a JSON array, byte-identical to json.dump(..., indent=2)."""
+    for piece in json_pieces(fragments):
+        f.write(piece)
+
+def _align(f):
+    padding = -f.tell() % 8
+    f.write(b'\0' * padding)
+    return f.tell()
+
+def write_mapped(path, entries, meta):
+    """Write a mapped record file atomically.
+
+    Args:
+        path (str): Destination file
+        entries: Iterable of (key, marshalled record, rendered fragment) tuples
+        meta (dict): JSON-serialisable metadata stored in the header
+    """
+    directory = os.path.dirname(path) or '.'
+    meta_bytes = json.dumps(meta).encode('utf-8')
+    record_offsets = array('Q', [0])
+    fragment_offsets = array('Q', [0])
+    keys = []
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.mapped-')
+    try:
+        with open(fd, 'w+b') as f, tempfile.TemporaryFile(dir=directory) as fragments:
+            f.write(b'\0' * _HEADER.size)
+            f.write(meta_bytes)
+            records_start = _align(f)
+            for key, blob, fragment in entries:
+                keys.append(key)
+                f.write(blob)
+                record_offsets.append(record_offsets[-1] + len(blob))
+                fragments.write(fragment)
+                fragment_offsets.append(fragment_offsets[-1] + len(fragment))
+
+            fragments_start = _align(f)
+            fragments.seek(0)
+            shutil.copyfileobj(fragments, f)
+
+            offsets_start = _align(f)
+            record_offsets.tofile(f)
+            fragment_offsets.tofile(f)
+            keys_start = f.tell()
+            f.write(b''.join(keys))
+
+            index_start = _align(f)
+            index = sorted((key, number) for number, key in enumerate(keys))
+            f.write(b''.join(_INDEX_ENTRY.pack(key, number) for key, number in index))
+
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, len(keys), len(meta_bytes), records_start, fragments_start,
+                                 offsets_start, keys_start, index_start, len(index)))
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class MappedRecords:
+    """Read-only view of a mapped record file, decoding records on access"""
+
+    def __init__(self, path, record_class):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.path = path
+        self.record_class = record_class
+        self.signature = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+        if len(self._map) < _HEADER.size:
+            raise ValueError(f"{path} is not a mapped record file")
+        (magic, count, meta_length, self._records_start, self._fragments_start,
+         offsets_start, self._keys_start, self._index_start, self._index_count) = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a mapped record file")
+
+        self._count = count
+        self.meta = json.loads(self._map[_HEADER.size:_HEADER.size + meta_length])
+        view = memoryview(self._map)
+        table_size = 8 * (count + 1)
+        self._record_offsets = view[offsets_start:offsets_start + table_size].cast('Q')
+        self._fragment_offsets = view[offsets_start + table_size:offsets_start + 2 * table_size].cast('Q')
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self, first=0, stop=None):
+        """Yield the records numbered first up to (not including) stop, in order."""
+        buffer, offsets, start = self._map, self._record_offsets, self._records_start
+        from_tuple, loads = self.record_class.from_tuple, marshal.loads
+        for number in range(first, self._count if stop is None else stop):
+            yield from_tuple(loads(buffer[start + offsets[number]:start + offsets[number + 1]]))
+
+    def key(self, number):
+        position = self._keys_start + number * KEY_SIZE
+        return self._map[position:position + KEY_SIZE]
+
+    def blob(self, number):
+        start = self._records_start
+        return self._map[start + self._record_offsets[number]:start + self._record_offsets[number + 1]]
+
+    def record(self, number):
+        return self.record_class.from_tuple(marshal.loads(self.blob(number)))
+
+    def fragment(self, number):
+        start = self._fragments_start
+        return self._map[start + self._fragment_offsets[number]:start + self._fragment_offsets[number + 1]]
+
+    def find(self, key):
+        """Binary-search the index for a key.
+
+        Returns:
+            int: The first record number with that key, or None
+        """
+        buffer, start, size = self._map, self._index_start, _INDEX_ENTRY.size
+        low, high = 0, self._index_count
+        while low < high:
+            middle = (low + high) // 2
+            position = start + middle * size
+            if buffer[position:position + KEY_SIZE] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._index_count:
+            found, number = _INDEX_ENTRY.unpack_from(buffer, start + low * size)
+            if found == key:
+                return number
+        return None
@@ -0,0 +1,280 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: scrapes aren't serialised, so two may fold the same file
+    fcntl = None
+
+# Each thread records into its own store, so the request path never takes a
+# lock. Each worker process periodically flushes the sum of its thread stores
+# to METRICS_DIR/<pid>.json, and a scrape merges every worker's file.
+METRICS_DIR = os.environ.get('CRM_METRICS_DIR', 'data/metrics')
+FLUSH_INTERVAL = 1.0
+
+# A scrape folds the files of workers that have exited into this one, so
+# their counts stay in the totals and counters never go backwards
+RETIRED_FILE = 'retired.json'
+LOCK_FILE = '.lock'
+
+# Histogram bucket upper bounds in seconds, shared by every latency metric
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+HELP = {
+    'crm_http_request_duration_seconds': ('histogram', 'HTTP request latency by route'),
+    'crm_http_request_bytes_total': ('counter', 'HTTP request body bytes received'),
+    'crm_http_response_bytes_total': ('counter', 'HTTP response body bytes sent'),
+    'crm_datastore_operation_seconds': ('histogram', 'Data store time by collection and phase (read, parse, build, scan, write)'),
+    'crm_datastore_writes_total': ('counter', 'JSON file rewrites by collection, each covering a batch of commits'),
+    'crm_datastore_commits_total': ('counter', 'Commits written by collection; divide by writes for the batch size'),
+    'crm_genesys_request_duration_seconds': ('histogram', 'Genesys Cloud API call latency'),
+    'crm_genesys_errors_total': ('counter', 'Genesys Cloud API calls that failed'),
+    'crm_genesys_fast_failures_total': ('counter', 'Genesys Cloud API calls refused without calling it, by reason (circuit open, or busy with too many calls)'),
+    'crm_webhook_delivery_seconds': ('histogram', 'Webhook batch delivery time by outcome (delivered or failed)'),
+    'crm_webhook_events_total': ('counter', 'Change events delivered to webhook subscriptions, after coalescing')
+}
+
+_local = threading.local()
+_stores = []
+_stores_lock = threading.Lock()
+# Totals of threads that have exited (threaded servers use one per request)
+_retired = {'counters': {}, 'histograms': {}}
+_last_flush = 0.0
+# The pid whose file this process has claimed, which a forked child hasn't
+_flushed_pid = None
+_flushed_lock = threading.Lock()
+
+def _store():
+    """Get this thread's private metric store, registering it on first use."""
+    store = getattr(_local, 'store', None)
+    if store is None:
+        store = _local.store = {'counters': {}, 'histograms': {}, 'thread': threading.current_thread()}
+        with _stores_lock:
+            _stores.append(store)
+    return store
+
+def inc(name, value=1, **labels):
+    """Increment a counter."""
+    counters = _store()['counters']
+    key = (name, tuple(sorted(labels.items())))
+    counters[key] = counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    """Record one observation in a histogram."""
+    histograms = _store()['histograms']
+    key = (name, tuple(sorted(labels.items())))
+    histogram = histograms.get(key)
+    if histogram is None:
+        # One slot per bucket plus +Inf, then the running sum
+        histogram = histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+    histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+@contextmanager
+def timer(name, **labels):
+    """Time a block of code into a histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+def _merge_into(totals, store):
+    for key, value in list(store['counters'].items()):
+        totals['counters'][key] = totals['counters'].get(key, 0) + value
+    for key, histogram in list(store['histograms'].items()):
+        histogram = list(histogram)
+        current = totals['histograms'].get(key)
+        if current is None:
+            totals['histograms'][key] = histogram
+        else:
+            totals['histograms'][key] = [a + b for a, b in zip(current, histogram)]
+
+def _process_totals():
+    """Sum every thread store in this worker."""
+    totals = {'counters': {}, 'histograms': {}}
+    with _stores_lock:
+        # Fold stores of finished threads into _retired; nothing writes to them
+        for store in [s for s in _stores if not s['thread'].is_alive()]:
+            _merge_into(_retired, store)
+            _stores.remove(store)
+        stores = list(_stores)
+        _merge_into(totals, _retired)
+    for store in stores:
+        _merge_into(totals, store)
+    return totals
+
+def _serialize(totals):
+    return {
+        'counters': [[name, labels, value] for (name, labels), value in totals['counters'].items()],
+        'histograms': [[name, labels, values] for (name, labels), values in totals['histograms'].items()]
+    }
+
+def _deserialize(data):
+    return {
+        'counters': {(name, tuple(map(tuple, labels))): value for name, labels, value in data['counters']},
+        'histograms': {(name, tuple(map(tuple, labels))): values for name, labels, values in data['histograms']}
+    }
+
+def _read(path):
+    with open(path, 'r') as f:
+        return _deserialize(json.load(f))
+
+def _write(path, totals):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(_serialize(totals), f)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def _locked():
+    """Hold the metrics directory's flock (closing the file releases it)."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, LOCK_FILE), 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+def _retire(paths):
+    """Fold worker files into the retired totals and remove them.
+
+    Call with _locked() held, so no scrape sees a file both folded and still
+    there, or neither.
+    """
+    retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+    try:
+        totals = _read(retired_path)
+    except (FileNotFoundError, ValueError):
+        totals = {'counters': {}, 'histograms': {}}
+
+    folded = []
+    for path in paths:
+        try:
+            _merge_into(totals, _read(path))
+        except FileNotFoundError:
+            continue
+        except ValueError:
+            # Files are replaced whole, so this one is corrupt; drop it
+            pass
+        folded.append(path)
+    if not folded:
+        return
+
+    _write(retired_path, totals)
+    for path in folded:
+        os.remove(path)
+
+def flush(force=False):
+    """Write this worker's totals for other workers' scrapes to merge."""
+    global _last_flush, _flushed_pid
+    now = time.monotonic()
+    if not force and now - _last_flush < FLUSH_INTERVAL:
+        return
+    _last_flush = now
+
+    try:
+        pid = os.getpid()
+        path = os.path.join(METRICS_DIR, f'{pid}.json')
+        with _flushed_lock:
+            if _flushed_pid != pid:
+                # A file already there is from an exited process given the
+                # same pid; keep its counts before this one replaces it
+                with _locked():
+                    _retire([path])
+                _flushed_pid = pid
+        _write(path, _process_totals())
+    except OSError:
+        pass
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def collect():
+    """Merge the metrics of every worker, past and present."""
+    flush(force=True)
+    totals = {'counters': {}, 'histograms': {}}
+
+    try:
+        with _locked():
+            paths = [os.path.join(METRICS_DIR, RETIRED_FILE)]
+            exited = []
+            for file_name in os.listdir(METRICS_DIR):
+                if not file_name.endswith('.json') or file_name == RETIRED_FILE:
+                    continue
+                path = os.path.join(METRICS_DIR, file_name)
+                try:
+                    pid = int(file_name[:-len('.json')])
+                except ValueError:
+                    continue
+                if _pid_alive(pid):
+                    paths.append(path)
+                else:
+                    exited.append(path)
+            _retire(exited)
+
+            for path in paths:
+                try:
+                    _merge_into(totals, _read(path))
+                except (OSError, ValueError):
+                    continue
+    except OSError:
+        return _process_totals()
+    return totals
+
+def clear():
+    """Remove the files of earlier runs, for a server starting afresh."""
+    try:
+        file_names = os.listdir(METRICS_DIR)
+    except OSError:
+        return
+    for file_name in file_names:
+        if file_name != LOCK_FILE:
+            try:
+                os.remove(os.path.join(METRICS_DIR, file_name))
+            except OSError:
+                pass
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def render():
+    """Render all metrics in the Prometheus text exposition format."""
+    totals = collect()
+    lines = []
+
+    for name in sorted({key[0] for key in totals['counters']} | {key[0] for key in totals['histograms']}):
+        kind, description = HELP.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+
+        for (metric, labels), value in sorted(totals['counters'].items()):
+            if metric == name:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+        for (metric, labels), values in sorted(totals['histograms'].items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), values[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {values[-1]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
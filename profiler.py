@@ -0,0 +1,184 @@
+import os
+import sys
+import time
+import threading
+import tracemalloc
+from collections import Counter
+from datetime import datetime
+
+# Profiling is per worker process: a session started through one gunicorn
+# worker only sees the requests that worker serves. When no session is
+# running the only cost is the request_finished() check below.
+DEFAULT_INTERVAL = 0.01
+DEFAULT_SECONDS = 30
+MAX_SECONDS = 600
+TRACEMALLOC_FRAMES = 10
+
+_lock = threading.Lock()
+_sessions = {}  # kind -> running session
+_results = {}   # kind -> result of the last finished session
+
+class _Session:
+    """Common bookkeeping for a window- or request-bounded profile"""
+
+    def __init__(self, kind, seconds=None, requests=None):
+        self.kind = kind
+        self.started_at = datetime.now()
+        # Request-bounded sessions still stop after MAX_SECONDS on an idle worker
+        window = seconds or (MAX_SECONDS if requests else DEFAULT_SECONDS)
+        self.deadline = time.monotonic() + min(window, MAX_SECONDS)
+        self.remaining_requests = requests
+
+    def status(self):
+        return {
+            'kind': self.kind,
+            'running': True,
+            'started_at': self.started_at.isoformat(),
+            'remaining_seconds': max(0.0, self.deadline - time.monotonic()),
+            'remaining_requests': self.remaining_requests
+        }
+
+class CPUSession(_Session):
+    """Statistical CPU profiler sampling every thread's stack"""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, **kwargs):
+        super().__init__('cpu', **kwargs)
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='cpu-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.samples[';'.join(reversed(stack))] += 1
+            self.sample_count += 1
+            if time.monotonic() >= self.deadline:
+                _finish(self)
+                return
+
+    def stop(self):
+        self._stop.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+        return {
+            'kind': 'cpu',
+            'started_at': self.started_at.isoformat(),
+            'finished_at': datetime.now().isoformat(),
+            'interval_seconds': self.interval,
+            'samples': self.sample_count,
+            # One "frame;frame;frame count" line per stack, as flamegraph.pl expects
+            'collapsed': '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common())
+        }
+
+class MemorySession(_Session):
+    """tracemalloc snapshot diff between the start and the end of a window"""
+
+    def __init__(self, top=25, **kwargs):
+        super().__init__('memory', **kwargs)
+        self.top = top
+        self._timer = None
+        self._baseline = None
+
+    def start(self):
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._baseline = tracemalloc.take_snapshot()
+        self._timer = threading.Timer(self.deadline - time.monotonic(), _finish, args=(self,))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def stop(self):
+        self._timer.cancel()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        def describe(stat):
+            frame = stat.traceback[0]
+            entry = {
+                'location': f"{frame.filename}:{frame.lineno}",
+                'size_bytes': stat.size,
+                'count': stat.count
+            }
+            if hasattr(stat, 'size_diff'):
+                entry['size_diff_bytes'] = stat.size_diff
+                entry['count_diff'] = stat.count_diff
+            return entry
+
+        return {
+            'kind': 'memory',
+            'started_at': self.started_at.isoformat(),
+            'finished_at': datetime.now().isoformat(),
+            'traced_current_bytes': current,
+            'traced_peak_bytes': peak,
+            'top_growth': [describe(stat) for stat in snapshot.compare_to(self._baseline, 'lineno')[:self.top]],
+            'top_allocations': [describe(stat) for stat in snapshot.statistics('lineno')[:self.top]]
+        }
+
+def _finish(session):
+    """Stop a session and keep its result, unless it was already stopped."""
+    with _lock:
+        if _sessions.get(session.kind) is not session:
+            return
+        del _sessions[session.kind]
+    _results[session.kind] = session.stop()
+
+def start(kind, seconds=None, requests=None, **options):
+    """Start a CPU or memory profiling session.
+
+    The session ends after `seconds` (default DEFAULT_SECONDS) or, when
+    `requests` is given, after that many requests have completed.
+    """
+    session_class = {'cpu': CPUSession, 'memory': MemorySession}.get(kind)
+    if session_class is None:
+        raise ValueError(f"Unknown profile kind: {kind}")
+    session = session_class(seconds=seconds, requests=requests, **options)
+
+    with _lock:
+        if kind in _sessions:
+            raise ValueError(f"A {kind} profile is already running")
+        _sessions[kind] = session
+    session.start()
+    return session.status()
+
+def stop(kind):
+    """Stop a running session early and return its result."""
+    session = _sessions.get(kind)
+    if session is None:
+        raise ValueError(f"No {kind} profile is running")
+    _finish(session)
+    return _results.get(kind)
+
+def status(kind):
+    """Get the running session's progress, or the last finished result."""
+    session = _sessions.get(kind)
+    if session is not None:
+        return session.status()
+    return _results.get(kind)
+
+def request_finished():
+    """Count a completed request towards request-bounded sessions."""
+    if not _sessions:
+        return
+    finished = []
+    with _lock:
+        # Requests finish on several threads at once
+        for session in _sessions.values():
+            if session.remaining_requests is not None:
+                session.remaining_requests -= 1
+                if session.remaining_requests <= 0:
+                    finished.append(session)
+    for session in finished:
+        _finish(session)
@@ -0,0 +1,245 @@
+import re
+import operator
+from collections import namedtuple
+from records import Customer, Contact, Deal
+
+# Filter expressions for /api/query.
+#
+# An expression combines comparisons with and, or, not and parentheses:
+#
+#     status = "Closed Won" and amount > 10000 and customer.industry = Retail
+#
+# A field is a record field, or customer.<field> on contacts and deals to
+# compare the customer the record belongs to (joined on customer_id).
+# Operators are = != < <= > >= and ~ (contains, ignoring case). Values are
+# numbers, quoted strings, bare words, true, false or null (absent).
+# Numbers compare numerically against fields holding numbers or numeric
+# strings, as deal amounts often are; strings compare as strings, so ISO
+# dates order correctly.
+#
+# parse() turns an expression into a tree of Comparison, And, Or and Not
+# nodes and predicate() turns the tree into one predicate over records. The
+# planner in data_manager looks among the conjuncts() for comparisons an
+# index can answer before falling back to a scan.
+
+ENTITIES = {'customers': Customer, 'contacts': Contact, 'deals': Deal}
+# Joined entity by field prefix, for each entity that can join
+JOINS = {
+    'contacts': {'customer': 'customers'},
+    'deals': {'customer': 'customers'}
+}
+MAX_LENGTH = 2000
+# Parentheses and nots nested inside each other; parsing and matching recurse
+# once per level, so this keeps them far from the interpreter's stack limit
+MAX_DEPTH = 50
+
+Comparison = namedtuple('Comparison', 'join field op value')
+And = namedtuple('And', 'terms')
+Or = namedtuple('Or', 'terms')
+Not = namedtuple('Not', 'term')
+
+_OPERATORS = {
+    '=': operator.eq, '!=': operator.ne,
+    '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge
+}
+_KEYWORDS = {'true': True, 'false': False, 'null': None}
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<number>-?\d+(?:\.\d+)?)(?![\w.:-])
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<op>!=|<=|>=|=|<|>|~)
+  | (?P<paren>[()])
+  | (?P<word>[\w][\w.:-]*)
+)''', re.VERBOSE)
+_ESCAPE = re.compile(r'\\(.)')
+
+class QueryError(ValueError):
+    """Raised for an expression that can't be parsed or names an unknown entity or field"""
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if not match:
+            raise QueryError(f"Unexpected character at position {position + 1}: {text[position]!r}")
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value) if '.' in value else int(value)
+        elif kind == 'string':
+            value = _ESCAPE.sub(r'\1', value[1:-1])
+        tokens.append((kind, value))
+        position = match.end()
+    return tokens
+
+class _Parser:
+    """Recursive descent over the tokens of one expression"""
+
+    def __init__(self, text, entity):
+        self.tokens = _tokenize(text)
+        self.position = 0
+        self.entity = entity
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        if token[0] is None:
+            raise QueryError("Unexpected end of expression")
+        self.position += 1
+        return token
+
+    def keyword(self, word):
+        kind, value = self.peek()
+        if kind == 'word' and value.lower() == word:
+            self.position += 1
+            return True
+        return False
+
+    def expression(self):
+        terms = [self.conjunction()]
+        while self.keyword('or'):
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else Or(tuple(terms))
+
+    def conjunction(self):
+        terms = [self.factor()]
+        while self.keyword('and'):
+            terms.append(self.factor())
+        return terms[0] if len(terms) == 1 else And(tuple(terms))
+
+    def factor(self):
+        if self.keyword('not'):
+            return Not(self.nested(self.factor))
+        if self.peek() == ('paren', '('):
+            self.take()
+            node = self.nested(self.expression)
+            if self.take() != ('paren', ')'):
+                raise QueryError("Expected )")
+            return node
+        return self.comparison()
+
+    def nested(self, parse):
+        if self.depth >= MAX_DEPTH:
+            raise QueryError(f"Expression is nested more than {MAX_DEPTH} levels deep")
+        self.depth += 1
+        try:
+            return parse()
+        finally:
+            self.depth -= 1
+
+    def comparison(self):
+        kind, name = self.take()
+        if kind != 'word':
+            raise QueryError(f"Expected a field name, got {name!r}")
+        join, field = self.field(name)
+        kind, op = self.take()
+        if kind != 'op':
+            raise QueryError(f"Expected an operator after {name}, got {op!r}")
+        kind, value = self.take()
+        if kind == 'word':
+            value = _KEYWORDS.get(value.lower(), value)
+        elif kind not in ('number', 'string'):
+            raise QueryError(f"Expected a value after {name} {op}")
+        if value is None and op not in ('=', '!='):
+            raise QueryError("null can only be compared with = or !=")
+        if isinstance(value, bool) and op not in ('=', '!='):
+            raise QueryError(f"{str(value).lower()} can only be compared with = or !=")
+        return Comparison(join, field, op, value)
+
+    def field(self, name):
+        join, _, field = name.rpartition('.')
+        entity = self.entity
+        if join:
+            entity = JOINS.get(self.entity, {}).get(join)
+            if entity is None:
+                raise QueryError(f"Unknown join {join!r} on {self.entity}")
+        if field not in ENTITIES[entity].FIELDS:
+            raise QueryError(f"Unknown field {name!r} on {self.entity}")
+        return join or None, field
+
+def parse(text, entity):
+    """Parse a filter expression over one entity's records.
+
+    Raises:
+        QueryError: If the expression is invalid
+    """
+    if entity not in ENTITIES:
+        raise QueryError(f"Unknown entity {entity!r}; expected one of {', '.join(ENTITIES)}")
+    if not text or not text.strip():
+        raise QueryError("Empty expression")
+    if len(text) > MAX_LENGTH:
+        raise QueryError(f"Expressions are limited to {MAX_LENGTH} characters")
+    parser = _Parser(text, entity)
+    node = parser.expression()
+    if parser.peek()[0] is not None:
+        raise QueryError(f"Unexpected {parser.peek()[1]!r} after a complete expression")
+    return node
+
+def conjuncts(node):
+    """Get the terms that must all hold for node to hold."""
+    return node.terms if isinstance(node, And) else (node,)
+
+def _number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+def _test(op, value):
+    """Get a function telling whether a field value compares true against value."""
+    if value is None:
+        return (lambda field: field is None) if op == '=' else (lambda field: field is not None)
+    if op == '~':
+        needle = str(value).casefold()
+        return lambda field: field is not None and needle in str(field).casefold()
+    compare = _OPERATORS[op]
+    if isinstance(value, bool):
+        return lambda field: compare(field is value, True)
+    if isinstance(value, (int, float)):
+        if op == '!=':
+            return lambda field: _number(field) != value
+        return lambda field: (number := _number(field)) is not None and compare(number, value)
+    if op in ('=', '!='):
+        return lambda field: compare(field, value)
+    return lambda field: isinstance(field, str) and compare(field, value)
+
+def predicate(node, lookups):
+    """Turn a parsed expression into a predicate over records.
+
+    Args:
+        node: The output of parse()
+        lookups (dict): Join name -> function getting the joined record (or
+            None) for a record, such as its customer
+
+    Returns:
+        function: record -> bool
+    """
+    if isinstance(node, And):
+        tests = [predicate(term, lookups) for term in node.terms]
+        return lambda record: all(test(record) for test in tests)
+    if isinstance(node, Or):
+        tests = [predicate(term, lookups) for term in node.terms]
+        return lambda record: any(test(record) for test in tests)
+    if isinstance(node, Not):
+        test = predicate(node.term, lookups)
+        return lambda record: not test(record)
+
+    field, test = node.field, _test(node.op, node.value)
+    if node.join is None:
+        return lambda record: test(record.get(field))
+    lookup = lookups[node.join]
+
+    def joined(record):
+        other = lookup(record)
+        return other is not None and test(other.get(field))
+    return joined
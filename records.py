@@ -0,0 +1,201 @@
+import sys
+from functools import lru_cache
+from operator import itemgetter
+from datetime import datetime, timedelta
+
+# Compact in-memory record model.
+#
+# Records are held as slot-free tuple subclasses instead of dicts, with:
+#   - canonical UUID strings stored as their 16 raw bytes
+#   - ISO timestamps stored as integer microseconds since the (naive) epoch
+#   - low-cardinality values such as status and industry interned
+# Anything that would not round-trip exactly (a non-canonical id, a
+# timestamp in another format) is kept as the original string, and unknown
+# keys are kept in a small dict, so to_dict() always reproduces the stored
+# JSON shape. Convert with to_dict() only at the API boundary.
+
+# Marks a field absent from the stored JSON. Ellipsis can never come out of
+# json.loads, and unlike a plain object() marshal can store it.
+_MISSING = Ellipsis
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_MICROSECONDS_PER_DAY = 86400 * 1000000
+
+def encode_id(value):
+    """Encode a canonical (lowercase, hyphenated) UUID string as 16 bytes; leave anything else as is."""
+    if (isinstance(value, str) and len(value) == 36 and
+            value[8] == value[13] == value[18] == value[23] == '-'):
+        digits = value.replace('-', '')
+        try:
+            encoded = bytes.fromhex(digits)
+        except ValueError:
+            return value
+        # fromhex skips whitespace, so check nothing was dropped
+        if len(encoded) == 16 and digits == digits.lower():
+            return encoded
+    return value
+
+def decode_id(value):
+    if isinstance(value, bytes):
+        digits = value.hex()
+        return f'{digits[:8]}-{digits[8:12]}-{digits[12:16]}-{digits[16:20]}-{digits[20:]}'
+    return value
+
+def encode_timestamp(value):
+    """Encode an ISO timestamp as integer microseconds when it round-trips exactly."""
+    if isinstance(value, str):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            return value
+        if parsed.tzinfo is None and parsed.isoformat() == value:
+            return (parsed - _EPOCH) // _MICROSECOND
+    return value
+
+def timestamp_key(value):
+    """Get a stored or given timestamp as integer microseconds for ordering, or None if it isn't one.
+
+    Encoded timestamps are returned as is. Other ISO strings are parsed, with
+    a time zone converted to local time like the naive timestamps records
+    are stamped with, and a bare date read as its midnight.
+    """
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return (parsed - _EPOCH) // _MICROSECOND
+
+@lru_cache(maxsize=4096)
+def _day_isoformat(days):
+    return (_EPOCH + timedelta(days=days)).date().isoformat()
+
+def decode_timestamp(value):
+    # Equivalent to (_EPOCH + value * _MICROSECOND).isoformat(), but the
+    # date part is cached since it is shared by every record from that day
+    if isinstance(value, int) and not isinstance(value, bool):
+        days, microseconds = divmod(value, _MICROSECONDS_PER_DAY)
+        seconds, microseconds = divmod(microseconds, 1000000)
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        if microseconds:
+            return f'{_day_isoformat(days)}T{hours:02d}:{minutes:02d}:{seconds:02d}.{microseconds:06d}'
+        return f'{_day_isoformat(days)}T{hours:02d}:{minutes:02d}:{seconds:02d}'
+    return value
+
+def encode_enum(value):
+    if isinstance(value, str):
+        return sys.intern(value)
+    return value
+
+# (encode, decode) pairs; None means the value is stored as is
+ID = (encode_id, decode_id)
+TIMESTAMP = (encode_timestamp, decode_timestamp)
+ENUM = (encode_enum, None)
+TEXT = (None, None)
+
+class CompactRecord(tuple):
+    """Base class for compact records; subclasses define FIELDS and CODECS
+
+    A record is a tuple of encoded field values followed by the extras dict
+    (or None). Subclassing tuple with empty __slots__ keeps instances free of
+    a per-instance __dict__ and makes building one from stored values a
+    single C call; fields are read through generated properties.
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+    CODECS = {}
+
+    @classmethod
+    def from_dict(cls, data):
+        values = []
+        for field, encode, _ in cls._CODEC_TABLE:
+            value = data.get(field, _MISSING)
+            if encode is not None and value is not _MISSING:
+                value = encode(value)
+            values.append(value)
+        extra = None
+        if not cls._FIELD_SET.issuperset(data):
+            extra = {key: value for key, value in data.items() if key not in cls._FIELD_SET}
+        values.append(extra)
+        return tuple.__new__(cls, values)
+
+    @classmethod
+    def from_tuple(cls, values):
+        """Rebuild a record from to_tuple() output."""
+        return tuple.__new__(cls, values)
+
+    def to_tuple(self):
+        """Get the encoded values as a plain tuple, as stored in mapped record files."""
+        return tuple(self)
+
+    def to_dict(self):
+        """Rebuild the record in its stored JSON shape."""
+        result = {}
+        for (field, _, decode), value in zip(self._CODEC_TABLE, self):
+            if value is not _MISSING:
+                result[field] = value if decode is None else decode(value)
+        if self._extra:
+            result.update(self._extra)
+        return result
+
+    def get(self, field, default=None):
+        """Read a field in its JSON form, like dict.get."""
+        if field in self._FIELD_SET:
+            value = getattr(self, field)
+            if value is _MISSING:
+                return default
+            decode = self.CODECS.get(field, TEXT)[1]
+            return value if decode is None else decode(value)
+        if self._extra:
+            return self._extra.get(field, default)
+        return default
+
+    def raw(self, field):
+        """Read a field in its encoded form (None when absent)."""
+        value = getattr(self, field, None)
+        return None if value is _MISSING else value
+
+    @classmethod
+    def getter(cls, *fields):
+        """Get a function returning a tuple of encoded fields from a record, for fast scans.
+
+        Absent fields read as _MISSING (Ellipsis) rather than None.
+        """
+        return itemgetter(*(cls.FIELDS.index(field) for field in fields))
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls.FIELDS)
+        cls._CODEC_TABLE = tuple((field,) + cls.CODECS.get(field, TEXT) for field in cls.FIELDS)
+        for position, field in enumerate(cls.FIELDS + ('_extra',)):
+            setattr(cls, field, property(itemgetter(position)))
+
+class Customer(CompactRecord):
+    __slots__ = ()
+    FIELDS = ('id', 'name', 'email', 'phone', 'address', 'website', 'industry', 'notes',
+              'created_at', 'updated_at')
+    CODECS = {'id': ID, 'industry': ENUM, 'created_at': TIMESTAMP, 'updated_at': TIMESTAMP}
+
+class Contact(CompactRecord):
+    __slots__ = ()
+    FIELDS = ('id', 'customer_id', 'name', 'email', 'phone', 'position', 'notes',
+              'created_at', 'updated_at')
+    CODECS = {'id': ID, 'customer_id': ID, 'position': ENUM,
+              'created_at': TIMESTAMP, 'updated_at': TIMESTAMP}
+
+class Deal(CompactRecord):
+    __slots__ = ()
+    FIELDS = ('id', 'customer_id', 'title', 'amount', 'status', 'expected_close_date', 'description',
+              'created_at', 'updated_at')
+    CODECS = {'id': ID, 'customer_id': ID, 'status': ENUM, 'expected_close_date': ENUM,
+              'created_at': TIMESTAMP, 'updated_at': TIMESTAMP}
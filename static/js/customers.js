@@ -211,8 +211,15 @@ async function saveCustomer() {
             result = await api.updateCustomer(customerId, customerData);
             showAlert('Customer updated successfully', 'success');
         } else {
-            // Create new customer
-            result = await api.createCustomer(customerData);
+            // Create new customer, confirming first if it looks like an existing one
+            try {
+                result = await api.createCustomer(customerData);
+            } catch (error) {
+                if (error.status !== 409) throw error;
+                const names = error.data.duplicates.map(match => match.customer.name).join(', ');
+                if (!confirm(`This looks like an existing customer: ${names}. Create it anyway?`)) return;
+                result = await api.createCustomer(customerData, true);
+            }
             showAlert('Customer created successfully', 'success');
         }
         
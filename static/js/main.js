@@ -28,12 +28,18 @@ const api = {
             // Handle API errors
             if (!response.ok) {
                 const errorData = await response.json();
-                throw new Error(errorData.error || 'API request failed');
+                const error = new Error(errorData.error || 'API request failed');
+                error.status = response.status;
+                error.data = errorData;
+                throw error;
             }
             
             return await response.json();
         } catch (error) {
-            showAlert(error.message, 'danger');
+            // Callers handle duplicate warnings themselves
+            if (error.status !== 409) {
+                showAlert(error.message, 'danger');
+            }
             throw error;
         }
     },
@@ -44,12 +50,27 @@ const api = {
         return await this.request(url);
     },
     
+    async suggestCustomers(query, limit = 10) {
+        return await this.request(`/api/customers/suggest?q=${encodeURIComponent(query)}&limit=${limit}`);
+    },
+    
     async getCustomer(id) {
         return await this.request(`/api/customers/${id}`);
     },
     
-    async createCustomer(data) {
-        return await this.request('/api/customers', 'POST', data);
+    async getCustomerFull(id) {
+        return await this.request(`/api/customers/${id}/full`);
+    },
+    
+    async query(entity, where, limit = null) {
+        let url = `/api/query?entity=${encodeURIComponent(entity)}&where=${encodeURIComponent(where)}`;
+        if (limit) url += `&limit=${limit}`;
+        return await this.request(url);
+    },
+    
+    async createCustomer(data, allowDuplicate = false) {
+        const url = allowDuplicate ? '/api/customers?allow_duplicate=true' : '/api/customers';
+        return await this.request(url, 'POST', data);
     },
     
     async updateCustomer(id, data) {
@@ -189,6 +210,10 @@ const api = {
         });
     },
     
+    async getCustomerInteractions(customerId, limit = 20) {
+        return await this.request(`/api/customers/${customerId}/interactions?limit=${limit}`);
+    },
+    
     async getGenesysQueues(limit = 25, page = 1) {
         return await this.request(`/api/genesys/queues?limit=${limit}&page=${page}`);
     }
@@ -334,6 +359,80 @@ function setupBackup() {
     }
 }
 
+// Live updates pushed from /api/stream
+const liveCollections = {
+    customer: 'customers',
+    contact: 'contacts',
+    deal: 'deals'
+};
+
+function isFiltered(inputIds) {
+    return inputIds.some(id => {
+        const input = document.getElementById(id);
+        return input && input.value;
+    });
+}
+
+function refreshSection(collection) {
+    // Leave filtered views alone; they are reloaded when the filter changes
+    if (collection === 'customers') {
+        if (!isFiltered(['customer-search']) && typeof renderCustomers === 'function') {
+            renderCustomers(globalState.customers);
+        }
+        populateCustomerDropdowns();
+    } else if (collection === 'contacts') {
+        if (!isFiltered(['contact-search', 'contact-customer-filter']) && typeof renderContacts === 'function') {
+            renderContacts(globalState.contacts);
+        }
+    } else if (collection === 'deals') {
+        if (!isFiltered(['deal-search', 'deal-customer-filter', 'deal-status-filter']) && typeof renderDeals === 'function') {
+            renderDeals(globalState.deals);
+        }
+    }
+}
+
+function applyChange(change) {
+    // A restore replaces whole collections; reload rather than patch
+    if (change.entity === 'dataset') {
+        if (typeof loadCustomers === 'function') loadCustomers();
+        if (typeof loadContacts === 'function') loadContacts();
+        if (typeof loadDeals === 'function') loadDeals();
+        return;
+    }
+
+    const collection = liveCollections[change.entity];
+    if (!collection) return;
+
+    const records = globalState[collection].filter(record => record.id !== change.id);
+    if (change.action !== 'delete') {
+        const index = globalState[collection].findIndex(record => record.id === change.id);
+        records.splice(index === -1 ? records.length : index, 0, change.record);
+    }
+
+    globalState[collection] = records;
+    refreshSection(collection);
+}
+
+function setupLiveUpdates() {
+    if (typeof EventSource === 'undefined') return;
+
+    const source = new EventSource('/api/stream');
+    source.addEventListener('change', (e) => {
+        try {
+            applyChange(JSON.parse(e.data));
+        } catch (error) {
+            console.error('Error applying live update:', error);
+        }
+    });
+    // EventSource gives up when the server refuses the stream (503 while
+    // too many are open); try again later instead of going without updates
+    source.addEventListener('error', () => {
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(setupLiveUpdates, 30000);
+        }
+    });
+}
+
 // Initialize the application
 async function initApp() {
     setupNavigation();
@@ -358,7 +457,10 @@ async function initApp() {
         if (typeof initCustomers === 'function') initCustomers();
         if (typeof initContacts === 'function') initContacts();
         if (typeof initDeals === 'function') initDeals();
-        
+
+        // Keep the tables current without reloading
+        setupLiveUpdates();
+
     } catch (error) {
         console.error('Error initializing app:', error);
         showAlert('Failed to load data. Please try refreshing the page.', 'danger');
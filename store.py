@@ -0,0 +1,1046 @@
+import json
+import os
+import re
+import time
+import zlib
+import marshal
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from operator import itemgetter
+import events
+import metrics
+from mapped import MappedRecords, json_pieces, record_key, render_fragment, write_fragments, write_mapped
+from records import encode_id
+
+try:
+    import fcntl
+except ImportError:  # Windows: concurrent rebuilds just do redundant work
+    fcntl = None
+
+# Shared record store.
+#
+# Each collection is served from a memory-mapped record file (see mapped.py)
+# that every worker maps read-only, plus a small per-worker delta of the
+# changes made since that file was written. The delta is kept current from
+# the shared change log, so writes from other workers show up on the next
+# access. Once the delta grows past DELTA_LIMIT records a worker folds it
+# into a fresh mapped file and the others switch over to it.
+#
+# The JSON files stay the source of truth and must only be changed through
+# data_manager or a backup restore: every write still rewrites them (from
+# the pre-rendered fragments, so unchanged records are copied rather than
+# re-encoded), and mapped files are rebuilt from them whenever they are
+# missing, stale, or replaced by a restore.
+#
+# A collection can be split into shards by a hash of the record ID, each
+# with its own JSON file (customers.0-of-4.json, ...), mapped file, delta
+# and write queue. A write then rewrites only the shards it touches, and
+# writes to different shards are flushed in parallel. With one shard (the
+# default) the collection is the single file it always was. The single file
+# doubles as the interchange format: backups are taken and restored as one
+# file per collection, and prepare() splits a single file, or the shards of
+# another shard count, into the configured layout.
+#
+# With CRM_SCAN_WORKERS set, a filtered scan (CollectionView.filter) of a
+# sharded collection matches each shard's mapped file in its own worker
+# process, and only the small deltas are matched in the request's process.
+# A streaming scan (CollectionView.scan) splits the mapped files into ranges
+# of SCAN_RANGE records instead, so it runs in parallel unsharded too.
+#
+# Every change makes a new view rather than altering the current one, so a
+# view is a point-in-time version that readers can scan for as long as they
+# like without locks while writers carry on. A version is reclaimed (its
+# mapped file too, once compaction has replaced it) when the last reader
+# drops its view; snapshot() gets versions of several collections that
+# were all current at the same instant.
+#
+# Writes are group committed: a commit is applied to the worker's view at
+# once, but the JSON file is rewritten (and fsynced) once for every commit
+# queued by then, and its events are published together. A writer returns
+# only after a rewrite including its changes is on disk, so concurrent
+# requests share one rewrite instead of queueing for one each. Workers take
+# turns at a shard's file under an flock, each publishing its changes
+# before rewriting from a view that has every change published before it.
+
+MAPPED_DIR = 'data/mapped'
+DELTA_LIMIT = int(os.environ.get('CRM_MAPPED_DELTA_LIMIT', '1000'))
+FORMAT_VERSION = 1
+
+# Set CRM_FSYNC=0 to skip fsync, trading durability for speed (e.g. in tests)
+FSYNC = os.environ.get('CRM_FSYNC', '1') != '0'
+# Set CRM_GROUP_COMMIT=0 to rewrite the JSON file inside every commit instead
+GROUP_COMMIT = os.environ.get('CRM_GROUP_COMMIT', '1') != '0'
+# How long a rewrite waits for more commits while another request is busy
+# with the collection (seconds)
+GROUP_COMMIT_WINDOW = float(os.environ.get('CRM_GROUP_COMMIT_WINDOW_MS', '2')) / 1000
+# Worker processes that scan shards at once; 0 scans in the request's process
+SCAN_WORKERS = int(os.environ.get('CRM_SCAN_WORKERS', '0'))
+# Records matched per task by a streaming scan
+SCAN_RANGE = 5000
+
+_scan_pool = None
+_scan_pool_lock = threading.Lock()
+# Mapped files opened by this process as a scan worker, by path
+_scan_files = {}
+
+def _collection_name(file_path):
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+def _file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+def _fsync_dir(path):
+    """Make a rename in a directory durable; not every platform can open one."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _replace_file(file_path, fragments):
+    """Atomically replace a JSON collection file with rendered records, fsynced unless FSYNC is off."""
+    temp_path = f'{file_path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    with open(temp_path, 'wb') as f:
+        write_fragments(f, fragments)
+        if FSYNC:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+    if FSYNC:
+        _fsync_dir(os.path.dirname(file_path) or '.')
+
+def shard_of(key, shards):
+    """Get the number of the shard holding a record key."""
+    return zlib.crc32(key) % shards if shards > 1 else 0
+
+def shard_files(file_path, shards):
+    """Get the JSON file of each shard of a collection stored at file_path."""
+    if shards == 1:
+        return [file_path]
+    base, extension = os.path.splitext(file_path)
+    return [f'{base}.{number}-of-{shards}{extension}' for number in range(shards)]
+
+def _shard_layouts(file_path):
+    """Find the shard files next to file_path, for any shard count.
+
+    Returns:
+        dict: {shard count: paths of the shard files that exist}
+    """
+    base, extension = os.path.splitext(file_path)
+    pattern = re.compile(rf'{re.escape(os.path.basename(base))}\.(\d+)-of-(\d+){re.escape(extension)}$')
+    directory = os.path.dirname(file_path) or '.'
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return {}
+    layouts = {}
+    for name in names:
+        match = pattern.match(name)
+        if match and int(match.group(1)) < int(match.group(2)):
+            layouts.setdefault(int(match.group(2)), []).append(os.path.join(directory, name))
+    return layouts
+
+def stored_files(file_path):
+    """Get the files a collection's data is in right now, in record order.
+
+    That is the single file if it exists (a restore or a generated dataset
+    writes one), or else the most recently written complete set of shards.
+
+    Returns:
+        list: File paths, empty if the collection has no files yet
+    """
+    if os.path.exists(file_path):
+        return [file_path]
+    complete = [shard_files(file_path, count) for count, paths in _shard_layouts(file_path).items()
+                if len(paths) == count]
+    if not complete:
+        return []
+    return max(complete, key=lambda paths: max(os.path.getmtime(path) for path in paths))
+
+def read_json(file_path):
+    """Yield the bytes of a collection as its single JSON file, even if it is stored in shards."""
+    return json_pieces(render_fragment(data) for path in stored_files(file_path) for data in load_json(path))
+
+def _scan_executor():
+    """Get the scan worker pool, starting it on first use."""
+    global _scan_pool
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            # Workers only read mapped files, so forking is safe and cheap
+            context = multiprocessing.get_context('fork') if hasattr(os, 'fork') else None
+            _scan_pool = ProcessPoolExecutor(SCAN_WORKERS, mp_context=context)
+        return _scan_pool
+
+def _scan_mapped(path, record_class, signature, match, args, first=0, stop=None):
+    """Find the records of a mapped file that match, in a scan worker.
+
+    Only records numbered first up to stop are matched, if given.
+
+    Returns:
+        list: The matching record numbers, or None if the file at path is
+        no longer the version the caller has (compaction replaced it)
+    """
+    mapped = _scan_files.get(path)
+    if mapped is None or mapped.signature != signature:
+        try:
+            mapped = MappedRecords(path, record_class)
+        except (OSError, ValueError):
+            return None
+        if mapped.signature != signature:
+            return None
+        _scan_files[path] = mapped
+    return [number for number, record in enumerate(mapped.records(first, stop), first) if match(record, *args)]
+
+def snapshot(*collections):
+    """Get a view of each collection, all current at the same instant.
+
+    The views are read until two passes in a row find the same ones, which
+    means no collection changed in between. No lock is taken, so writers
+    are never held up.
+
+    Returns:
+        tuple: One CollectionView per collection, in the order given
+    """
+    views = tuple(collection.records() for collection in collections)
+    while True:
+        current = tuple(collection.records() for collection in collections)
+        if all(view is previous for view, previous in zip(current, views)):
+            return current
+        views = current
+
+def mapped_offsets():
+    """Get the change log offset each mapped file was built at, by path.
+
+    Workers replay the change log on top of a mapped file from its offset,
+    and never from an older one, so the log must be kept from the oldest.
+    """
+    offsets = {}
+    if not os.path.isdir(MAPPED_DIR):
+        return offsets
+    for name in os.listdir(MAPPED_DIR):
+        path = os.path.join(MAPPED_DIR, name)
+        if name.startswith('.') or not name.endswith('.bin'):
+            continue
+        try:
+            offsets[path] = MappedRecords(path, None).meta.get('events_offset', 0)
+        except (OSError, ValueError):
+            # Removed or being replaced; whatever replaces it is built at the log's end
+            continue
+    return offsets
+
+def load_json(file_path):
+    """Load a JSON collection file, timing the read and the parse separately."""
+    collection = _collection_name(file_path)
+    try:
+        with metrics.timer('crm_datastore_operation_seconds', collection=collection, op='read'):
+            with open(file_path, 'rb') as f:
+                raw = f.read()
+        with metrics.timer('crm_datastore_operation_seconds', collection=collection, op='parse'):
+            return json.loads(raw)
+    except (json.JSONDecodeError, FileNotFoundError):
+        return []
+
+class _BuildLock:
+    """Inter-process lock so only one worker rebuilds a mapped file at a time"""
+
+    def __init__(self, name, blocking=True):
+        self.path = os.path.join(MAPPED_DIR, f'.{name}.lock')
+        self.blocking = blocking
+        self.acquired = False
+
+    def __enter__(self):
+        os.makedirs(MAPPED_DIR, exist_ok=True)
+        self._file = open(self.path, 'a')
+        if not fcntl:
+            self.acquired = True
+            return self
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | (0 if self.blocking else fcntl.LOCK_NB))
+            self.acquired = True
+        except BlockingIOError:
+            pass
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl and self.acquired:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+class _WriteLock:
+    """Inter-process lock on a shard's JSON file, re-entrant within a process
+
+    Held from the refresh before a rewrite until its changes are published,
+    and while a mapped file is rebuilt from the JSON file, so no worker
+    writes or reads the file without every change already published.
+    """
+
+    def __init__(self, name):
+        self.path = os.path.join(MAPPED_DIR, f'.{name}.write.lock')
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self):
+        self._lock.acquire()
+        self._depth += 1
+        if self._depth > 1:
+            return
+        try:
+            os.makedirs(MAPPED_DIR, exist_ok=True)
+            self._file = open(self.path, 'a')
+            if fcntl:
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._depth -= 1
+            self._lock.release()
+            raise
+
+    def release(self):
+        self._depth -= 1
+        if not self._depth:
+            if fcntl:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+class _Pending:
+    """A commit applied to a shard's view but not yet written to its JSON file"""
+
+    __slots__ = ('changes', 'published', 'done', 'error')
+
+    def __init__(self, changes, published):
+        self.changes = changes
+        self.published = published
+        self.done = False
+        self.error = None
+
+class _CommitLock:
+    """Re-entrant collection lock that makes writers wait for their commits on the way out
+
+    Commits made while the lock is held are queued; once the thread's
+    outermost with block ends, the lock is released first and then the
+    thread waits for its last commit to each shard to be written, so other
+    requests can join the same writes meanwhile.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._local.depth -= 1
+        held = None
+        if not self._local.depth:
+            held = getattr(self._local, 'held', None)
+            self._local.held = None
+        self._lock.release()
+        if held:
+            errors = []
+            for shard, pending in held.items():
+                try:
+                    shard.wait(pending)
+                except Exception as e:
+                    errors.append(e)
+            if errors:
+                raise errors[0]
+
+    def hold(self, shard, pending):
+        """Have the current thread wait for pending when it lets go of the lock.
+
+        Commits to a shard are written in order, so only the latest per shard
+        needs waiting for.
+        """
+        held = getattr(self._local, 'held', None)
+        if held is None:
+            held = self._local.held = {}
+        held[shard] = pending
+
+    def busy(self):
+        """Tell whether another thread holds the lock."""
+        if self._lock.acquire(blocking=False):
+            self._lock.release()
+            return False
+        return True
+
+class ShardView:
+    """One immutable version of a shard: a mapped file plus the changes on top of it
+
+    changed maps keys of records in the mapped file to their new record (None
+    once deleted); added holds records that are not in the mapped file, in
+    insertion order. position is the change log offset the view reflects.
+    """
+
+    def __init__(self, mapped, changed, added, position):
+        self.mapped = mapped
+        self.changed = changed
+        self.added = added
+        self.position = position
+
+    def __iter__(self):
+        mapped, changed = self.mapped, self.changed
+        if changed:
+            for number in range(len(mapped)):
+                key = mapped.key(number)
+                if key in changed:
+                    record = changed[key]
+                    if record is not None:
+                        yield record
+                else:
+                    yield mapped.record(number)
+        else:
+            yield from mapped
+        yield from self.added.values()
+
+    def __len__(self):
+        deleted = sum(1 for record in self.changed.values() if record is None)
+        return len(self.mapped) - deleted + len(self.added)
+
+    def get(self, key):
+        """Get the record with a key, or None."""
+        if key in self.added:
+            return self.added[key]
+        if key in self.changed:
+            return self.changed[key]
+        number = self.mapped.find(key)
+        return None if number is None else self.mapped.record(number)
+
+    def delta_size(self):
+        return len(self.changed) + len(self.added)
+
+    def filter(self, match, args=(), numbers=None):
+        """Get the records for which match(record, *args) is true, in order.
+
+        Args:
+            numbers (list): The matching record numbers in the mapped file,
+                if a scan worker found them already; records changed since
+                are matched again here
+        """
+        if numbers is None:
+            return [record for record in self if match(record, *args)]
+        mapped, changed = self.mapped, self.changed
+        hits = [(number, mapped.record(number)) for number in numbers if mapped.key(number) not in changed]
+        if changed:
+            hits.extend((mapped.find(key), record) for key, record in changed.items()
+                        if record is not None and match(record, *args))
+            hits.sort(key=itemgetter(0))
+        return ([record for _, record in hits] +
+                [record for record in self.added.values() if match(record, *args)])
+
+    def scan_range(self, match, args, first, stop, numbers=None):
+        """Get the records of the mapped file numbered first up to stop that match and haven't changed since.
+
+        Args:
+            numbers (list): The matching record numbers in the range, if a
+                scan worker found them already
+        """
+        mapped, changed = self.mapped, self.changed
+        if numbers is None:
+            hits = ((number, record) for number, record in enumerate(mapped.records(first, stop), first)
+                    if match(record, *args))
+            return [record for number, record in hits if not changed or mapped.key(number) not in changed]
+        return [mapped.record(number) for number in numbers if not changed or mapped.key(number) not in changed]
+
+    def delta_filter(self, match, args=()):
+        """Get the changed and added records that match, which scans of the mapped file leave out."""
+        return ([record for record in self.changed.values() if record is not None and match(record, *args)] +
+                [record for record in self.added.values() if match(record, *args)])
+
+    def with_changes(self, changes, position=None):
+        """Get a new view with (key, record or None) changes applied in order."""
+        changed, added = dict(self.changed), dict(self.added)
+        for key, record in changes:
+            if key in added:
+                if record is None:
+                    del added[key]
+                else:
+                    added[key] = record
+            elif key in changed or self.mapped.find(key) is not None:
+                changed[key] = record
+            elif record is not None:
+                added[key] = record
+        return ShardView(self.mapped, changed, added, self.position if position is None else position)
+
+    def fragments(self):
+        """Yield every record rendered for the JSON file, in order."""
+        mapped, changed = self.mapped, self.changed
+        for number in range(len(mapped)):
+            key = mapped.key(number)
+            if key in changed:
+                record = changed[key]
+                if record is not None:
+                    yield render_fragment(record.to_dict())
+            else:
+                yield mapped.fragment(number)
+        for record in self.added.values():
+            yield render_fragment(record.to_dict())
+
+    def entries(self):
+        """Yield (key, marshalled record, fragment) for writing a new mapped file."""
+        mapped, changed = self.mapped, self.changed
+        for number in range(len(mapped)):
+            key = mapped.key(number)
+            if key in changed:
+                record = changed[key]
+                if record is not None:
+                    yield key, marshal.dumps(record.to_tuple()), render_fragment(record.to_dict())
+            else:
+                yield key, mapped.blob(number), mapped.fragment(number)
+        for key, record in self.added.items():
+            yield key, marshal.dumps(record.to_tuple()), render_fragment(record.to_dict())
+
+class CollectionView:
+    """One immutable version of a collection: a ShardView per shard
+
+    Records iterate shard by shard. position is the change log offset every
+    shard reflects.
+    """
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.position = min(shard.position for shard in shards)
+
+    def __iter__(self):
+        for shard in self.shards:
+            yield from shard
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def get(self, key):
+        """Get the record with a key, or None."""
+        return self.shards[shard_of(key, len(self.shards))].get(key)
+
+    def fragments(self):
+        """Yield every record rendered for the JSON file, in order."""
+        for shard in self.shards:
+            yield from shard.fragments()
+
+    def json(self):
+        """Yield the bytes of the collection as its single JSON file as of this view, in pieces."""
+        return json_pieces(self.fragments())
+
+    def filter(self, match, *args):
+        """Get the records for which match(record, *args) is true, in order.
+
+        With SCAN_WORKERS set, the shards are scanned in worker processes at
+        once, so match must be a module-level function and args picklable.
+        """
+        global _scan_pool
+        if not SCAN_WORKERS or len(self.shards) < 2:
+            return [record for record in self if match(record, *args)]
+        pool = _scan_executor()
+        try:
+            found = [pool.submit(_scan_mapped, shard.mapped.path, shard.mapped.record_class,
+                                 shard.mapped.signature, match, args) for shard in self.shards]
+            found = [future.result() for future in found]
+        except BrokenProcessPool:
+            # A worker died; start a new pool next time and scan here for now
+            with _scan_pool_lock:
+                if _scan_pool is pool:
+                    _scan_pool = None
+            found = [None] * len(self.shards)
+        return [record for shard, numbers in zip(self.shards, found) for record in shard.filter(match, args, numbers)]
+
+    def scan(self, match, *args, timeout=None):
+        """Yield lists of the records for which match(record, *args) is true, as they are found.
+
+        Records changed since the mapped files were written come first; the
+        mapped files follow in ranges of SCAN_RANGE records. With SCAN_WORKERS
+        set the ranges are matched in worker processes and yielded as each
+        finishes, so records are not in collection order, and match must be
+        a module-level function and args picklable. Ranges not yet matched
+        are cancelled when the caller stops iterating.
+
+        Raises:
+            TimeoutError: If the scan takes longer than timeout seconds
+        """
+        global _scan_pool
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for shard in self.shards:
+            hits = shard.delta_filter(match, args)
+            if hits:
+                yield hits
+        ranges = [(shard, first, min(first + SCAN_RANGE, len(shard.mapped)))
+                  for shard in self.shards for first in range(0, len(shard.mapped), SCAN_RANGE)]
+
+        if SCAN_WORKERS:
+            pool = _scan_executor()
+            futures = {}
+            scanned = set()
+            try:
+                for shard, first, stop in ranges:
+                    futures[pool.submit(_scan_mapped, shard.mapped.path, shard.mapped.record_class,
+                                        shard.mapped.signature, match, args, first, stop)] = (shard, first, stop)
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                for future in as_completed(futures, timeout=remaining):
+                    shard, first, stop = futures.pop(future)
+                    scanned.add((shard, first))
+                    # None when compaction replaced the file; this view still maps the old one
+                    hits = shard.scan_range(match, args, first, stop, future.result())
+                    if hits:
+                        yield hits
+                return
+            except BrokenProcessPool:
+                # A worker died; start a new pool next time and scan what's left here
+                with _scan_pool_lock:
+                    if _scan_pool is pool:
+                        _scan_pool = None
+                ranges = [(shard, first, stop) for shard, first, stop in ranges if (shard, first) not in scanned]
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        for shard, first, stop in ranges:
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError(f"Scan did not finish within {timeout} seconds")
+            hits = shard.scan_range(match, args, first, stop)
+            if hits:
+                yield hits
+
+class _Shard:
+    """One JSON file of a collection, with its mapped file, current view and write queue"""
+
+    def __init__(self, collection, file_path):
+        self.collection = collection
+        self.file_path = file_path
+        self.name = _collection_name(file_path)
+        self.mapped_path = os.path.join(MAPPED_DIR, f'{self.name}.bin')
+        self.view = None
+        self.write_lock = _WriteLock(self.name)
+        # Commits not yet written, oldest first. One thread at a time writes
+        # them (the one that set flushing); the rest wait on flushed.
+        self.unflushed = []
+        self.flushing = False
+        self.flushed = threading.Condition(threading.Lock())
+
+    def wait(self, pending):
+        """Block until a commit is written, writing it along with any others queued if no one else is."""
+        with self.flushed:
+            while not pending.done:
+                if not self.flushing:
+                    self.flushing = True
+                    break
+                self.flushed.wait()
+        if not pending.done:
+            try:
+                self.flush()
+            finally:
+                with self.flushed:
+                    self.flushing = False
+                    self.flushed.notify_all()
+        if pending.error is not None:
+            raise pending.error
+
+    def flush(self):
+        """Publish the queued commits, then write them in one rewrite of the JSON file.
+
+        Only the thread that set flushing calls this, so writes to a shard
+        happen one at a time and in order.
+        """
+        collection = self.collection
+        if GROUP_COMMIT and GROUP_COMMIT_WINDOW and collection.lock.busy():
+            # Someone is mid-request and likely about to commit; let them join
+            time.sleep(GROUP_COMMIT_WINDOW)
+        # Other workers rewrite this file from their own views, so hold its
+        # write lock from the refresh until our changes are logged: the view
+        # written then has every change they have published, and they see
+        # ours before they next write. The lock is taken inside the
+        # collection lock, like a rebuild's, but kept after leaving it.
+        with collection.lock:
+            self.write_lock.acquire()
+            try:
+                batch = list(self.unflushed)
+                collection._refresh()
+                view = self.view
+            except BaseException:
+                self.write_lock.release()
+                raise
+        error = None
+        try:
+            if batch:
+                events.publish_many(collection.entity, [change for pending in batch for change in pending.published])
+                with metrics.timer('crm_datastore_operation_seconds', collection=collection.name, op='write'):
+                    _replace_file(self.file_path, view.fragments())
+        except Exception as e:
+            error = e
+        finally:
+            self.write_lock.release()
+        if not batch:
+            return
+
+        if error is not None:
+            with collection.lock:
+                # Commits queued since build on the failed ones, so fail them
+                # too, and reopen without any of them. If only the rewrite
+                # failed the batch is already logged, and every worker's next
+                # rewrite keeps it.
+                failed, self.unflushed = self.unflushed, []
+                self.view = None
+                collection._view = None
+                collection._aggregates = {}
+            for pending in failed:
+                pending.error = error
+                pending.done = True
+            return
+
+        with collection.lock:
+            del self.unflushed[:len(batch)]
+        for pending in batch:
+            pending.done = True
+        metrics.inc('crm_datastore_writes_total', collection=collection.name)
+        metrics.inc('crm_datastore_commits_total', len(batch), collection=collection.name)
+
+    def _meta(self, events_offset):
+        return {
+            'format': FORMAT_VERSION,
+            'record_type': self.collection.record_class.__name__,
+            'events_offset': events_offset,
+            'source_signature': _file_signature(self.file_path)
+        }
+
+    def _usable(self, mapped, after):
+        meta = mapped.meta
+        if meta.get('format') != FORMAT_VERSION or meta.get('record_type') != self.collection.record_class.__name__:
+            return False
+        offset = meta.get('events_offset', 0)
+        log_end = events.current_offset()
+        if offset < after or log_end < offset or offset < events.first_offset():
+            return False
+        # A changed JSON file is only explained by changes logged since
+        return meta.get('source_signature') == _file_signature(self.file_path) or log_end > offset
+
+    def _try_open(self, after):
+        try:
+            mapped = MappedRecords(self.mapped_path, self.collection.record_class)
+        except (OSError, ValueError):
+            return None
+        if not self._usable(mapped, after):
+            return None
+        return ShardView(mapped, {}, {}, mapped.meta['events_offset'])
+
+    def open(self, after=0):
+        """Open the mapped file, rebuilding it from JSON if it is missing or stale."""
+        view = self._try_open(after)
+        if view:
+            return view
+
+        # The write lock keeps the JSON file and the log offset in step
+        with self.write_lock, _BuildLock(self.name):
+            # Another worker may have rebuilt it while we waited for the lock
+            view = self._try_open(after)
+            if view:
+                return view
+
+            # Take the offset first: events after it are replayed on top, and
+            # replaying a change the JSON file already has is harmless
+            offset = events.current_offset()
+            meta = self._meta(offset)
+            raw = load_json(self.file_path)
+            with metrics.timer('crm_datastore_operation_seconds', collection=self.collection.name, op='build'):
+                write_mapped(self.mapped_path, self._entries_from_json(raw), meta)
+            del raw
+            mapped = MappedRecords(self.mapped_path, self.collection.record_class)
+        return ShardView(mapped, {}, {}, offset)
+
+    def _entries_from_json(self, raw):
+        record_class = self.collection.record_class
+        for data in raw:
+            record = record_class.from_dict(data)
+            yield record_key(record.id), marshal.dumps(record.to_tuple()), render_fragment(data)
+
+    def compact(self, view):
+        """Fold the delta into a new mapped file, unless another worker is already doing so."""
+        with _BuildLock(self.name, blocking=False) as lock:
+            if not lock.acquired:
+                return view
+            with metrics.timer('crm_datastore_operation_seconds', collection=self.collection.name, op='build'):
+                write_mapped(self.mapped_path, view.entries(), self._meta(view.position))
+            mapped = MappedRecords(self.mapped_path, self.collection.record_class)
+        return ShardView(mapped, {}, {}, view.position)
+
+class Collection:
+    """A JSON collection, in one file or several shards, served from shared mapped files plus per-worker deltas"""
+
+    def __init__(self, file_path, record_class, entity, aggregates=None, shards=1):
+        self.file_path = file_path
+        self.name = _collection_name(file_path)
+        self.record_class = record_class
+        self.entity = entity
+        self.files = shard_files(file_path, shards)
+        self._shards = [_Shard(self, path) for path in self.files]
+        self._prepared = False
+        self._view = None
+        # Optional running summaries by name (such as aggregates.DealTotals or
+        # dedupe.DuplicateIndex), each built by one scan when first asked for
+        # and then updated from each change
+        self._aggregate_classes = aggregates or {}
+        self._aggregates = {}
+        self.lock = _CommitLock()
+
+    def key(self, record_id):
+        """Get the lookup key for a record ID as it appears in the API."""
+        return record_key(encode_id(record_id))
+
+    def records(self):
+        """Get the current view of the collection.
+
+        Views are immutable, so callers can iterate one while other threads write.
+        """
+        view = self._view
+        if (view is not None and events.current_offset() == view.position and
+                all(_file_signature(shard.mapped_path) == part.mapped.signature
+                    for shard, part in zip(self._shards, view.shards))):
+            return view
+        with self.lock:
+            return self._refresh()
+
+    def get(self, record_id):
+        """Get a record by ID, or None."""
+        return self.records().get(self.key(record_id))
+
+    def commit(self, changes, published=()):
+        """Apply (key, record or None) changes, rewrite the shards they touch and publish the changes.
+
+        The changes are visible to this worker at once. The caller returns
+        from its outermost `with self.lock` block (from this call, if it
+        doesn't hold the lock) only once they are on disk and published.
+
+        Args:
+            changes (list): (key, record or None) tuples
+            published (list): (action, record dict) tuples for the change log
+
+        Returns:
+            CollectionView: The view including the changes
+
+        Raises:
+            OSError: On leaving the lock, if a JSON file couldn't be written
+        """
+        count = len(self._shards)
+        with self.lock:
+            self._refresh()
+            by_shard = {}
+            for key, record in changes:
+                by_shard.setdefault(shard_of(key, count), ([], []))[0].append((key, record))
+            for action, data in published:
+                by_shard.setdefault(shard_of(self.key(data.get('id')), count), ([], []))[1].append((action, data))
+
+            queued = []
+            for number, (shard_changes, shard_published) in by_shard.items():
+                shard = self._shards[number]
+                self._track(shard.view, shard_changes)
+                shard.view = shard.view.with_changes(shard_changes)
+                pending = _Pending(shard_changes, shard_published)
+                shard.unflushed.append(pending)
+                self.lock.hold(shard, pending)
+                queued.append((shard, pending))
+            self._view = CollectionView(tuple(shard.view for shard in self._shards))
+            if not GROUP_COMMIT:
+                for shard, pending in queued:
+                    shard.wait(pending)
+            return self._view
+
+    def aggregate(self, name):
+        """Get a running aggregate, building it with one scan if needed.
+
+        The aggregate is updated in place as changes arrive, so hold self.lock
+        while reading it.
+        """
+        with self.lock:
+            view = self._refresh()
+            if name not in self._aggregates:
+                aggregate = self._aggregate_classes[name]()
+                for record in view:
+                    aggregate.add(record)
+                self._aggregates[name] = aggregate
+            return self._aggregates[name]
+
+    def invalidate(self):
+        """Drop the current view so the next access reopens the mapped files."""
+        with self.lock:
+            for shard in self._shards:
+                shard.view = None
+            self._view = None
+            self._aggregates = {}
+
+    def prepare(self):
+        """Move the collection's data into its shard files, creating any that are missing.
+
+        Data found in any other layout (the single file, say after a restore,
+        or the shards of another shard count) is split or merged into this
+        one. The new files are all written before the old ones are removed,
+        so an interrupted move is simply redone.
+
+        Returns:
+            bool: Whether data was moved
+        """
+        with _BuildLock(self.name):
+            sources = stored_files(self.file_path)
+            moved = bool(sources) and sources != self.files
+            if moved:
+                buckets = [[] for _ in self.files]
+                for path in sources:
+                    for data in load_json(path):
+                        buckets[shard_of(self.key(data.get('id')), len(self.files))].append(data)
+                for shard, bucket in zip(self._shards, buckets):
+                    _replace_file(shard.file_path, (render_fragment(data) for data in bucket))
+                    # Its mapped file could be from an earlier time with this layout
+                    if os.path.exists(shard.mapped_path):
+                        os.remove(shard.mapped_path)
+
+            leftovers = [path for paths in _shard_layouts(self.file_path).values() for path in paths]
+            if os.path.exists(self.file_path):
+                leftovers.append(self.file_path)
+            for path in leftovers:
+                if path not in self.files:
+                    os.remove(path)
+                    mapped_path = os.path.join(MAPPED_DIR, f'{_collection_name(path)}.bin')
+                    if os.path.exists(mapped_path):
+                        os.remove(mapped_path)
+
+            for path in self.files:
+                if not os.path.exists(path):
+                    _replace_file(path, [])
+        self._prepared = True
+        return moved
+
+    def _track(self, view, changes):
+        """Update the aggregates for changes about to be applied on top of a shard's view.
+
+        Each change is counted as the difference from the record it replaces,
+        so replaying one of our own commits from the change log is a no-op.
+        """
+        if not self._aggregates:
+            return
+        aggregates = list(self._aggregates.values())
+        pending = {}
+        for key, record in changes:
+            old = pending[key] if key in pending else view.get(key)
+            for aggregate in aggregates:
+                if old is not None:
+                    aggregate.remove(old)
+                if record is not None:
+                    aggregate.add(record)
+            pending[key] = record
+
+    def _refresh(self):
+        """Bring every shard's view up to date with its mapped file and the change log."""
+        if not self._prepared:
+            self.prepare()
+        shards = self._shards
+        count = len(shards)
+        views = [shard.view for shard in shards]
+        # The view each shard's aggregates were counted on. A shard reopened
+        # onto a mapped file another worker wrote keeps its old view here,
+        # and the changes since it are counted against that instead of
+        # rebuilding every aggregate with a scan.
+        counted = list(views)
+        reopened = [False] * count
+        for number, shard in enumerate(shards):
+            view = views[number]
+            if view is None or _file_signature(shard.mapped_path) != view.mapped.signature:
+                views[number] = shard.open()
+                if view is None:
+                    self._aggregates = {}
+                reopened[number] = True
+        log_end = events.current_offset()
+        first = events.first_offset()
+        for number, shard in enumerate(shards):
+            if log_end < views[number].position or views[number].position < first:
+                # The change log was truncated, or compacted past events not
+                # yet replayed, so the delta can't be trusted. Start again
+                # from the current mapped file, which open() only rebuilds
+                # from JSON if it is missing, corrupt or just as far behind.
+                views[number] = shard.open()
+                self._aggregates = {}
+                reopened[number] = True
+        if not self._aggregates:
+            counted = list(views)
+
+        changes = [[] for _ in shards]
+        uncounted = [[] for _ in shards]
+        end = None
+        for offset, event in events.read_events(min(view.position for view in views + counted)):
+            end = offset
+            if event.get('entity') == 'dataset':
+                # A restore replaced the JSON files underneath us
+                if offset > min(view.position for view in views + counted):
+                    self.prepare()
+                    views = [shard.open(after=offset) for shard in shards]
+                    self._aggregates = {}
+                    counted = list(views)
+                    reopened = [True] * count
+                    changes = [[] for _ in shards]
+                    uncounted = [[] for _ in shards]
+                continue
+            if event.get('entity') != self.entity:
+                continue
+            key = self.key(event.get('id'))
+            number = shard_of(key, count)
+            view, base = views[number], counted[number]
+            if offset <= view.position and (base is view or offset <= base.position):
+                continue
+            if event.get('action') == 'delete':
+                change = (key, None)
+            else:
+                change = (key, self.record_class.from_dict(event.get('record') or {}))
+            if offset > view.position:
+                changes[number].append(change)
+            if base is not view and offset > base.position:
+                uncounted[number].append(change)
+
+        for number, shard in enumerate(shards):
+            view = views[number]
+            counting = counted[number] is view
+            queued = [change for pending in shard.unflushed for change in pending.changes]
+            if not counting:
+                # The old view has the queued commits on top, so counting
+                # them again after the changes since leaves the aggregates
+                # matching the new view with the queued commits put back
+                self._track(counted[number], uncounted[number] + queued)
+            if end is not None and end > view.position:
+                if counting:
+                    self._track(view, changes[number])
+                view = view.with_changes(changes[number], end)
+            if queued and (reopened[number] or changes[number]):
+                # Queued commits aren't in the mapped file or the change log
+                # yet, and are newer than anything replayed, so put them back
+                # on top
+                if counting:
+                    self._track(view, queued)
+                view = view.with_changes(queued)
+            # Queued commits may still fail, so keep them out of shared files
+            if view.delta_size() > DELTA_LIMIT and not shard.unflushed:
+                view = shard.compact(view)
+            shard.view = views[number] = view
+
+        current = self._view
+        if current is None or any(view is not part for view, part in zip(views, current.shards)):
+            self._view = CollectionView(tuple(views))
+        return self._view
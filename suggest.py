@@ -0,0 +1,227 @@
+import re
+import sys
+import heapq
+import itertools
+from bisect import bisect_left, insort
+from collections import Counter
+from mapped import record_key
+
+# Customer name autocomplete.
+#
+# Names are split into words, and the distinct words are kept in a sorted
+# list that serves as a compact prefix trie: the words starting with a
+# prefix are one contiguous run found by binary search. Each word maps to
+# the customers whose name contains it, and a trigram index over the words
+# finds near-misses for typo tolerance. Matches rank by how well they match,
+# then by most recently updated.
+#
+# The index is a collection aggregate (see store.Collection.aggregate): it is
+# built with one scan and kept current as customers change.
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# Words checked by edit distance per misspelt query word, most similar first
+FUZZY_CANDIDATES = 200
+
+_WORD = re.compile(r'\w+')
+
+def tokenize(value):
+    """Split a name or query into casefolded words."""
+    if not isinstance(value, str):
+        return []
+    return [sys.intern(word) for word in _WORD.findall(value.casefold())]
+
+def max_typos(word):
+    """Edits tolerated in a query word: none for very short words, more for long ones."""
+    if len(word) < 3:
+        return 0
+    return 1 if len(word) < 6 else 2
+
+def _grams(word):
+    # Padded at the start only, so a word shares every gram of its prefixes
+    padded = f'  {word}'
+    return {padded[i:i + 3] for i in range(len(word))}
+
+def prefix_distance(query, word, limit):
+    """Get the edit distance between query and the closest prefix of word.
+
+    Returns:
+        int: The distance, or limit + 1 once it is known to exceed limit
+    """
+    word = word[:len(query) + limit]
+    previous = list(range(len(word) + 1))
+    for i, query_char in enumerate(query, 1):
+        current = [i]
+        for j, word_char in enumerate(word, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (query_char != word_char)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous)
+
+def _recency(record):
+    updated = record.raw('updated_at')
+    # Timestamps that didn't encode to microseconds rank as oldest
+    return updated if isinstance(updated, int) else 0
+
+class SuggestIndex:
+    """Word, prefix and trigram index over customer names"""
+
+    def __init__(self):
+        self.vocabulary = []  # distinct words, sorted
+        self.postings = {}    # word -> keys of customers whose name has it
+        self.first = {}       # word -> keys of customers whose name starts with it
+        self.grams = {}       # trigram -> words containing it
+        self.recency = {}     # key -> updated_at
+        # Keys by recency, oldest first; sorted on first use, since the
+        # initial scan adds customers in file order
+        self.order = []
+        self._order_sorted = False
+
+    def add(self, record):
+        words = tokenize(record.get('name'))
+        if not words:
+            return
+        key = record_key(record.raw('id'))
+        self.recency[key] = _recency(record)
+        if self._order_sorted:
+            insort(self.order, key, key=self.recency.__getitem__)
+        else:
+            self.order.append(key)
+        self.first.setdefault(words[0], set()).add(key)
+        for word in set(words):
+            if word not in self.postings:
+                self.postings[word] = set()
+                insort(self.vocabulary, word)
+                for gram in _grams(word):
+                    self.grams.setdefault(gram, set()).add(word)
+            self.postings[word].add(key)
+
+    def remove(self, record):
+        words = tokenize(record.get('name'))
+        if not words:
+            return
+        key = record_key(record.raw('id'))
+        if self._order_sorted:
+            position = bisect_left(self.order, self.recency[key], key=self.recency.__getitem__)
+            while self.order[position] != key:
+                position += 1
+            del self.order[position]
+        else:
+            self.order.remove(key)
+        del self.recency[key]
+        first = self.first.get(words[0])
+        if first is not None:
+            first.discard(key)
+            if not first:
+                del self.first[words[0]]
+        for word in set(words):
+            posting = self.postings.get(word)
+            if posting is None:
+                continue
+            posting.discard(key)
+            if not posting:
+                del self.postings[word]
+                del self.vocabulary[bisect_left(self.vocabulary, word)]
+                for gram in _grams(word):
+                    self.grams[gram].discard(word)
+                    if not self.grams[gram]:
+                        del self.grams[gram]
+
+    def _prefixed(self, prefix):
+        """Yield the indexed words starting with prefix."""
+        vocabulary = self.vocabulary
+        position = bisect_left(vocabulary, prefix)
+        while position < len(vocabulary) and vocabulary[position].startswith(prefix):
+            yield vocabulary[position]
+            position += 1
+
+    def _similar(self, query):
+        """Yield the indexed words with a prefix within max_typos edits of query."""
+        limit = max_typos(query)
+        if not limit:
+            yield from self._prefixed(query)
+            return
+        grams = _grams(query)
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.grams.get(gram, ()))
+        # Each edit changes at most three trigrams
+        needed = max(1, len(grams) - 3 * limit)
+        for word, count in shared.most_common(FUZZY_CANDIDATES):
+            if count < needed:
+                break
+            if prefix_distance(query, word, limit) <= limit:
+                yield word
+
+    def _word_sets(self, words, expand, postings):
+        """Get, per query word, the keys of customers with a name word matching it.
+
+        Returns:
+            list: One set per query word, or None if some word matches nothing
+        """
+        sets = []
+        for query in words:
+            found = [postings[word] for word in expand(query) if word in postings]
+            if not found:
+                return None
+            # A single posting is used as is rather than copied
+            sets.append(found[0] if len(found) == 1 else set().union(*found))
+        return sets
+
+    def _newest(self, sets, count, exclude):
+        """Get up to count keys that are in every set but not in exclude, newest first."""
+        if not self._order_sorted:
+            self.order.sort(key=self.recency.__getitem__)
+            self._order_sorted = True
+        smallest = min(sets, key=len)
+        others = [keys for keys in sets if keys is not smallest]
+
+        def wanted(key):
+            return key not in exclude and all(key in keys for keys in others)
+
+        # When the match is broad, walking customers newest first finds
+        # enough of them long before ranking the whole match would finish
+        if len(smallest) ** 2 > count * len(self.order):
+            found = []
+            for key in itertools.islice(reversed(self.order), len(smallest)):
+                if key in smallest and wanted(key):
+                    found.append(key)
+                    if len(found) == count:
+                        return found
+        return heapq.nlargest(count, filter(wanted, smallest), key=self.recency.__getitem__)
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        """Find customers whose name matches a partial, possibly misspelt, query.
+
+        Every query word must start a word of the name. Names whose first
+        word matches the first query word rank first ('prefix'), then other
+        names matching every word ('word'), then names matching only within
+        a few typos ('fuzzy'); ties go to the most recently updated.
+
+        Returns:
+            list: Up to limit (key, match) tuples, best first
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+        results = []
+        seen = set()
+
+        def take(sets, match):
+            for key in self._newest(sets, limit - len(results), seen):
+                results.append((key, match))
+                seen.add(key)
+
+        matched = self._word_sets(words, self._prefixed, self.postings)
+        if matched:
+            starting = self._word_sets(words[:1], self._prefixed, self.first)
+            if starting:
+                take(matched + starting, 'prefix')
+            if len(results) < limit:
+                take(matched, 'word')
+        if len(results) < limit:
+            fuzzy = self._word_sets(words, self._similar, self.postings)
+            if fuzzy:
+                take(fuzzy, 'fuzzy')
+        return results
@@ -0,0 +1,357 @@
+import os
+import json
+import hmac
+import time
+import uuid
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import events
+import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: every worker would deliver, so delivery stays off
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Outbound change webhooks.
+#
+# The change log (events.py) is the delivery queue: every mutation is
+# already appended there before it returns, so mutations never wait on a
+# destination. Each subscription keeps a cursor into the log, persisted in
+# STATE_FILE, and only moves it past events its destination has accepted,
+# so nothing is lost across restarts and a destination that is down just
+# falls behind.
+#
+# One worker at a time delivers, whichever holds an flock on LOCK_FILE; the
+# others keep trying so another takes over if it exits. Its dispatcher
+# thread reads each subscription's pending events, coalesces changes to the
+# same record into one event (create then update is sent as one create with
+# the latest record, create then delete as nothing) and posts them in
+# batches of up to BATCH_SIZE, on a pool of DELIVERY_WORKERS threads so a
+# slow destination doesn't hold up the others. A failed batch is retried
+# with exponential backoff and jitter.
+SUBSCRIPTIONS_FILE = 'data/webhooks.json'
+STATE_FILE = 'data/webhook_state.json'
+LOCK_FILE = 'data/webhooks.lock'
+# Held by whichever worker is changing SUBSCRIPTIONS_FILE
+SUBSCRIPTIONS_LOCK_FILE = 'data/webhooks.json.lock'
+
+ENTITIES = ('customer', 'contact', 'deal', 'dataset')
+ACTIONS = ('create', 'update', 'delete', 'restore')
+
+BATCH_SIZE = int(os.environ.get('CRM_WEBHOOK_BATCH_SIZE', 100))
+DELIVERY_WORKERS = int(os.environ.get('CRM_WEBHOOK_WORKERS', 4))
+TIMEOUT = float(os.environ.get('CRM_WEBHOOK_TIMEOUT', 10))
+# Seconds before the first retry, doubling per failure up to MAX_BACKOFF
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+# How often the dispatcher checks the log, and how often the other workers
+# try to take over delivery (seconds)
+POLL_INTERVAL = 0.5
+LOCK_RETRY_INTERVAL = 5.0
+# Log bytes read per subscription per pass
+READ_BYTES = 1024 * 1024
+
+_lock = threading.Lock()
+_started_pid = None
+
+# Subscriptions
+
+def load_subscriptions():
+    """Load webhook subscriptions from the JSON file."""
+    try:
+        with open(SUBSCRIPTIONS_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return []
+
+def _write_json(file_path, data):
+    temp_path = f'{file_path}.tmp-{os.getpid()}-{threading.get_ident()}'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp_path, file_path)
+
+@contextmanager
+def _subscriptions_locked():
+    """Hold this process's lock and, across workers, SUBSCRIPTIONS_LOCK_FILE's flock."""
+    with _lock:
+        os.makedirs(os.path.dirname(SUBSCRIPTIONS_LOCK_FILE), exist_ok=True)
+        with open(SUBSCRIPTIONS_LOCK_FILE, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Closing the file releases the flock
+            yield
+
+def _public(subscription):
+    """A subscription as shown through the API, without its secret"""
+    shown = {key: value for key, value in subscription.items() if key != 'secret'}
+    shown['signed'] = bool(subscription.get('secret'))
+    return shown
+
+def _choices(values, allowed, name):
+    if values is None:
+        return list(allowed)
+    if isinstance(values, str):
+        values = [values]
+    unknown = [value for value in values if value not in allowed]
+    if unknown or not values:
+        raise ValueError(f"{name} must be a list drawn from {', '.join(allowed)}")
+    return list(values)
+
+def create_subscription(data):
+    """Subscribe a URL to changes, starting from the next one.
+
+    Args:
+        data (dict): url, and optionally entities, actions and a secret used
+            to sign each delivery (X-CRM-Signature: sha256=<HMAC of the body>)
+
+    Returns:
+        dict: The new subscription, without its secret
+
+    Raises:
+        ValueError: If a field is invalid
+    """
+    url = data.get('url')
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')):
+        raise ValueError("url must be an http:// or https:// URL")
+    subscription = {
+        'id': str(uuid.uuid4()),
+        'url': url,
+        'entities': _choices(data.get('entities'), ENTITIES, 'entities'),
+        'actions': _choices(data.get('actions'), ACTIONS, 'actions'),
+        'secret': data.get('secret') or None,
+        'since_offset': events.current_offset(),
+        'created_at': datetime.now().isoformat()
+    }
+    with _subscriptions_locked():
+        subscriptions = load_subscriptions()
+        subscriptions.append(subscription)
+        _write_json(SUBSCRIPTIONS_FILE, subscriptions)
+    return _public(subscription)
+
+def delete_subscription(subscription_id):
+    """Delete a subscription.
+
+    Returns:
+        bool: True if it existed
+    """
+    with _subscriptions_locked():
+        subscriptions = load_subscriptions()
+        remaining = [subscription for subscription in subscriptions if subscription['id'] != subscription_id]
+        if len(remaining) == len(subscriptions):
+            return False
+        _write_json(SUBSCRIPTIONS_FILE, remaining)
+    return True
+
+def load_state():
+    """Load each subscription's delivery cursor, failure count and next attempt time."""
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def status():
+    """Get every subscription with its delivery progress."""
+    state = load_state()
+    log_end = events.current_offset()
+    result = []
+    for subscription in load_subscriptions():
+        progress = state.get(subscription['id'], {})
+        offset = progress.get('offset', subscription['since_offset'])
+        shown = _public(subscription)
+        shown.update({
+            'pending_bytes': max(0, log_end - offset),
+            'failures': progress.get('failures', 0),
+            'next_attempt': progress.get('next_attempt'),
+            'last_error': progress.get('last_error'),
+            'delivered': progress.get('delivered', 0)
+        })
+        result.append(shown)
+    return result
+
+def oldest_cursor():
+    """Get the change log offset the furthest-behind subscription delivers from next, or None without any."""
+    state = load_state()
+    offsets = [state.get(subscription['id'], {}).get('offset', subscription['since_offset'])
+               for subscription in load_subscriptions()]
+    return min(offsets, default=None)
+
+# Delivery
+
+def _matches(subscription, event):
+    return event.get('entity') in subscription['entities'] and event.get('action') in subscription['actions']
+
+def next_batch(subscription, offset, batch_size=BATCH_SIZE):
+    """Collect the next batch of coalesced events for a subscription.
+
+    Returns:
+        tuple: (events to send, log offset just past the last event they cover)
+    """
+    pending = OrderedDict()  # (entity, id) -> outgoing event, in order of first change
+    end = offset
+    for next_offset, event in events.read_events(offset, max_bytes=READ_BYTES):
+        if _matches(subscription, event):
+            key = (event['entity'], event.get('id'))
+            previous = pending.get(key)
+            if previous is None and len(pending) >= batch_size:
+                break
+            outgoing = {
+                'event_id': next_offset,
+                'ts': event.get('ts'),
+                'entity': event['entity'],
+                'action': event['action'],
+                'id': event.get('id'),
+                'record': event.get('record')
+            }
+            if previous is not None and previous['action'] == 'create':
+                if event['action'] == 'delete':
+                    # Never seen downstream, so there is nothing to tell it
+                    del pending[key]
+                    end = next_offset
+                    continue
+                outgoing['action'] = 'create'
+            pending[key] = outgoing
+        end = next_offset
+    return list(pending.values()), end
+
+def _backoff(failures):
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+
+def deliver(subscription, batch):
+    """POST a batch to a subscription's URL.
+
+    Raises:
+        requests.RequestException: If it could not be delivered
+    """
+    import requests
+
+    body = json.dumps({'subscription': subscription['id'], 'events': batch}, separators=(',', ':')).encode('utf-8')
+    headers = {
+        'Content-Type': 'application/json',
+        # Unique per batch, so a receiver can drop a retry it already applied
+        'X-CRM-Delivery': f"{subscription['id']}:{batch[-1]['event_id']}"
+    }
+    if subscription.get('secret'):
+        digest = hmac.new(subscription['secret'].encode('utf-8'), body, hashlib.sha256).hexdigest()
+        headers['X-CRM-Signature'] = f'sha256={digest}'
+    response = requests.post(subscription['url'], data=body, headers=headers, timeout=TIMEOUT)
+    response.raise_for_status()
+
+class _Dispatcher:
+    """Sends every subscription's pending events while this worker holds LOCK_FILE"""
+
+    def __init__(self):
+        self.state = {}
+        self.in_flight = set()
+        self.state_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.executor = ThreadPoolExecutor(max_workers=DELIVERY_WORKERS, thread_name_prefix='webhook')
+
+    def run(self):
+        lock_file = None
+        while True:
+            try:
+                if lock_file is None:
+                    lock_file = self._acquire()
+                    if lock_file is None:
+                        time.sleep(LOCK_RETRY_INTERVAL)
+                        continue
+                    self.state = load_state()
+                self.dispatch()
+            except Exception as e:
+                logger.error(f"Webhook dispatcher error: {str(e)}")
+            self.wake.wait(POLL_INTERVAL)
+            self.wake.clear()
+
+    def _acquire(self):
+        os.makedirs(os.path.dirname(LOCK_FILE), exist_ok=True)
+        lock_file = open(LOCK_FILE, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        logger.info(f"Delivering webhooks from process {os.getpid()}")
+        return lock_file
+
+    def dispatch(self):
+        """Start a delivery for each subscription that has events waiting and is due."""
+        subscriptions = load_subscriptions()
+        log_end = events.current_offset()
+        now = time.time()
+        with self.state_lock:
+            # Forget subscriptions that were deleted
+            ids = {subscription['id'] for subscription in subscriptions}
+            for subscription_id in [key for key in self.state if key not in ids]:
+                del self.state[subscription_id]
+
+        for subscription in subscriptions:
+            with self.state_lock:
+                if subscription['id'] in self.in_flight:
+                    continue
+                progress = self.state.setdefault(subscription['id'], {'offset': subscription['since_offset']})
+                if progress['offset'] >= log_end or progress.get('next_attempt', 0) > now:
+                    continue
+                self.in_flight.add(subscription['id'])
+            self.executor.submit(self._send, subscription, progress['offset'])
+
+    def _send(self, subscription, offset):
+        started = time.perf_counter()
+        try:
+            batch, end = next_batch(subscription, offset)
+            if batch:
+                deliver(subscription, batch)
+                metrics.inc('crm_webhook_events_total', len(batch))
+                metrics.observe('crm_webhook_delivery_seconds', time.perf_counter() - started, outcome='delivered')
+            with self.state_lock:
+                progress = self.state.get(subscription['id'])
+                if progress is not None:
+                    progress.update(offset=end, failures=0, next_attempt=0, last_error=None,
+                                    delivered=progress.get('delivered', 0) + len(batch))
+                    self._save()
+            if end < events.current_offset():
+                # More is waiting; don't sit out a poll interval before the next batch
+                self.wake.set()
+        except Exception as e:
+            metrics.observe('crm_webhook_delivery_seconds', time.perf_counter() - started, outcome='failed')
+            with self.state_lock:
+                progress = self.state.get(subscription['id'])
+                if progress is not None:
+                    progress['failures'] = progress.get('failures', 0) + 1
+                    progress['next_attempt'] = time.time() + _backoff(progress['failures'])
+                    progress['last_error'] = str(e)
+                    self._save()
+            logger.warning(f"Webhook delivery to {subscription['url']} failed: {str(e)}")
+        finally:
+            with self.state_lock:
+                self.in_flight.discard(subscription['id'])
+            metrics.flush()
+
+    def _save(self):
+        try:
+            _write_json(STATE_FILE, self.state)
+        except OSError as e:
+            logger.error(f"Failed to save webhook state: {str(e)}")
+
+def start():
+    """Start this process's dispatcher thread, once per process.
+
+    Safe to call on every request; after a fork the child starts its own.
+    """
+    global _started_pid
+    if _started_pid == os.getpid() or fcntl is None:
+        return
+    with _lock:
+        if _started_pid == os.getpid():
+            return
+        _started_pid = os.getpid()
+    threading.Thread(target=_Dispatcher().run, name='webhook-dispatcher', daemon=True).start()